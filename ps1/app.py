@@ -3,11 +3,14 @@ from datetime import datetime
 import tkinter as tk
 from tkinter import messagebox
 from tkinter import ttk
-import socket
 import time
 import os
 from dotenv import load_dotenv
 import json
+import wire_v2
+import compression
+import dispatcher
+import transport
 
 load_dotenv()
 #
@@ -19,7 +22,8 @@ class App(tk.Tk):
     Attributes:
     - current_user (str): The username of the currently logged in user.
     - messages (list): A list of dictionaries representing messages.
-    - accounts (list): A list of usernames.
+    - accounts (list): A list of usernames, kept up to date by the server's account directory pushes.
+    - directory_version (int): The version of the account directory that accounts reflects.
     - socket (socket): The socket object for server communication.
     - is_logged_in (bool): Whether the user is logged in.
     - is_connected (bool): Whether the client is connected to the server.
@@ -27,6 +31,15 @@ class App(tk.Tk):
     - host (str): The host address of the server.
     - port (int): The port number of the server.
     - is_json (bool): Whether to use JSON or wire protocol for communication.
+    - wire_version (int): The wire protocol version to ask the server for when not using JSON.
+    - negotiated_version (int): The wire protocol version the current connection speaks.
+    - compression (str): The compression codec to ask the server for, or None to not compress.
+    - compression_threshold (int): The smallest frame body, in bytes, the client compresses.
+    - negotiated_compression (bool): Whether the current connection is compressed.
+    - dispatcher (Dispatcher): The requests waiting for their replies, which are matched to them by request id.
+    - search_results (list): The usernames found by the current account search, in sorted order.
+    - search_cursor (str): The cursor of the next page of the current account search, empty when there is none.
+    - search_page_size (int): The number of usernames to ask for per page of an account search.
 
     """
     def __init__(self):
@@ -38,6 +51,8 @@ class App(tk.Tk):
         self.current_user = None
         self.messages = []
         self.accounts = []
+        self.directory_version = 0
+        self.directory_resyncing = False
         self.socket = None
         self.is_logged_in = False
         self.is_connected = False
@@ -45,6 +60,18 @@ class App(tk.Tk):
         self.host = os.environ.get("HOST_SERVER")
         self.port = int(os.environ.get("PORT_SERVER"))
         self.is_json = True
+        self.wire_version = 2
+        self.negotiated_version = 1
+        self.dispatcher = dispatcher.Dispatcher()
+        self.compression = compression.CODEC
+        self.compression_threshold = 1024
+        self.negotiated_compression = False
+        # Most bytes a compressed frame from the server may expand to
+        self.max_decompressed = 64 * 1024 * 1024
+        self.search_results = []
+        self.search_cursor = ""
+        self.search_page_size = 20
+        self.search_request_cursor = ""
 
         # Setup UI container
         self.container = tk.Frame(self)
@@ -94,11 +121,15 @@ class App(tk.Tk):
 
         while not self.is_connected:
             try:
-                print(f"Attempting to connect to {self.host}:{self.port}")
-                self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.socket.connect((self.host, self.port))
+                print(f"Attempting to connect to {transport.format_address(self.host, self.port)}")
+                # HOST_SERVER may be "unix:<path>" to reach a server on the same host over its Unix domain socket
+                self.socket = transport.connect(self.host, self.port)
+                self.negotiate_compression()
+                if not self.is_json:
+                    self.negotiate_wire_version()
                 self.is_connected = True
                 print("Connected to server.")
+                self.subscribe_directory()
                 # Once connected, start read thread
                 self.after(500, lambda: threading.Thread(target=self.read_from_server, daemon=True).start())
                 return True
@@ -107,18 +138,227 @@ class App(tk.Tk):
                 print(f"Current host: {self.host}, port: {self.port}")
                 time.sleep(1)
 
+    def negotiate_wire_version(self):
+        """Asks the server to switch the connection to self.wire_version of the wire protocol
+        Notes:
+            - Servers that only speak version 1 reply with an error, and the connection stays on version 1
+        """
+        self.negotiated_version = 1
+        if self.wire_version == 1:
+            return
+        request = "VE" + str(self.wire_version)
+        self.socket.sendall((str(len(request)) + request).encode('utf-8'))
+
+        if self.read_negotiation_reply() == "VET" + str(self.wire_version):
+            self.negotiated_version = self.wire_version
+        print(f"Using wire protocol version {self.negotiated_version}")
+
+    def negotiate_compression(self):
+        """Asks the server to compress the connection with self.compression
+        Notes:
+            - Servers that do not support compression reply with an error, and the connection stays uncompressed
+        """
+        self.negotiated_compression = False
+        if not self.compression:
+            return
+        if self.is_json:
+            request = json.dumps({"type": "CM", "codec": self.compression})
+        else:
+            request = "CM" + self.compression
+        self.socket.sendall((str(len(request)) + request).encode('utf-8'))
+
+        reply = self.read_negotiation_reply()
+        if self.is_json:
+            self.negotiated_compression = json.loads(reply).get("type") == "CMT"
+        else:
+            self.negotiated_compression = reply == "CMT" + self.compression
+        print(f"Compression {'on' if self.negotiated_compression else 'off'}")
+
+    def read_negotiation_reply(self):
+        """Reads the reply to a negotiation request, which is always a small length-prefixed frame
+
+        Returns:
+            string: The body of the reply
+        """
+        str_bytes = ""
+        recv_data = self.socket.recv(1)
+        while recv_data and recv_data.isdigit():
+            str_bytes += recv_data.decode("utf-8")
+            recv_data = self.socket.recv(1)
+        reply = recv_data
+        while len(reply) < int(str_bytes):
+            reply += self.socket.recv(int(str_bytes) - len(reply))
+        return reply.decode("utf-8")
+
+    def read_compressed_frame(self):
+        """Reads the rest of a compressed length-prefixed frame, after its leading "Z"
+
+        Returns:
+            string: The decompressed frame body
+        """
+        str_bytes = ""
+        recv_data = self.socket.recv(1)
+        while recv_data and recv_data != b" ":
+            str_bytes += recv_data.decode("utf-8")
+            recv_data = self.socket.recv(1)
+        body = b""
+        while len(body) < int(str_bytes):
+            data = self.socket.recv(int(str_bytes) - len(body))
+            if not data:
+                raise ConnectionError("Server connection closed")
+            body += data
+        return compression.decompress(body, self.max_decompressed).decode("utf-8")
+
+    def subscribe_directory(self):
+        """Asks the server for a copy of the account directory and to push every change to it
+        Notes:
+            - Changes that arrive before the copy are ignored, since the copy already includes them
+        """
+        self.directory_resyncing = True
+        if self.is_json:
+            self.write_to_server({"type": "SU"})
+        else:
+            self.write_to_server("SU")
+
+    def handle_directory(self, accounts, version):
+        """Replaces the local copy of the account directory
+
+        Args:
+            accounts (list): Every username
+            version (int): The directory version of the copy
+        """
+        self.accounts = accounts
+        self.directory_version = version
+        self.directory_resyncing = False
+
+    def handle_directory_change(self, change_type, version, username):
+        """Applies an account directory change pushed by the server to the local copy
+
+        Args:
+            change_type (string): "ACA" when the account was created, "ACD" when it was deleted
+            version (int): The directory version after the change
+            username (string): The account that changed
+        Notes:
+            - If a change was missed, which the server does when the client is too slow to keep up,
+            a fresh copy of the directory is requested instead
+        """
+        if self.directory_resyncing:
+            return
+        if version != self.directory_version + 1:
+            self.subscribe_directory()
+            return
+        self.directory_version = version
+        if change_type == "ACA":
+            if username not in self.accounts:
+                self.accounts = self.accounts + [username]
+        elif username in self.accounts:
+            self.accounts = [account for account in self.accounts if account != username]
+
+    def search_accounts(self, prefix, cursor=""):
+        """Asks the server for a page of the usernames starting with prefix
+
+        Args:
+            prefix (string): The prefix to search for
+            cursor (string): The cursor of the page to get, empty for the first page
+        """
+        self.search_request_cursor = cursor
+        if self.is_json:
+            self.write_to_server({"type": "LS", "prefix": prefix, "cursor": cursor, "limit": self.search_page_size})
+        else:
+            self.write_to_server(f"LS{prefix} {cursor} {self.search_page_size}")
+
+    def handle_search_page(self, accounts, cursor):
+        """Adds a page of account search results and updates the search page if it is showing
+
+        Args:
+            accounts (list): The usernames on the page
+            cursor (string): The cursor of the next page, empty when there is none
+        """
+        if self.search_request_cursor:
+            self.search_results = self.search_results + accounts
+        else:
+            self.search_results = accounts
+        self.search_cursor = cursor
+        current_frame = list(self.frames.values())[0] if self.frames else None
+        if current_frame and isinstance(current_frame, SearchAccount):
+            current_frame.after(0, current_frame.display_accounts)
+
     def read_from_server(self):
         if self.is_json:
             self.read_from_server_json()
+        elif self.negotiated_version == 2:
+            self.read_from_server_v2()
         else:
             self.read_from_server_wp()
 
 
-    def write_to_server(self, message):
-        if self.is_json:
-            return self.write_to_server_json(message)
-        else:
-            return self.write_to_server_wp(message)
+    def write_to_server(self, message, on_reply=None):
+        """Sends a request to the server
+
+        Args:
+            message (dict or string): The request, a dict when using json and a string otherwise
+            on_reply (function): Called from the read thread with the reply once it arrives, or with None if the
+            connection is lost first
+
+        Returns:
+            boolean: True or false depending on if the message was sent successfully
+        """
+        return self.write_many_to_server([message], on_reply)
+
+    def write_many_to_server(self, messages, on_reply=None):
+        """Sends a burst of requests to the server in a single write, without waiting for any of their replies
+
+        Args:
+            messages (list): The requests, dicts when using json and strings otherwise
+            on_reply (function): Called from the read thread with each reply as it arrives
+
+        Returns:
+            boolean: True or false depending on if the messages were sent successfully
+        Notes:
+            - Every request carries its own request id, which the server echoes in its reply, so the replies
+            are matched to their requests however they are interleaved with pushes from the server
+        """
+        if not self.is_connected:
+            print("Not connected to server")
+            return False
+        request_ids = [self.dispatcher.register(on_reply) for _ in messages]
+        try:
+            if self.is_json:
+                frames = [self.encode_request_json(message, request_id) for message, request_id in zip(messages, request_ids)]
+            else:
+                frames = [self.encode_request_wp(message, request_id) for message, request_id in zip(messages, request_ids)]
+            self.socket.sendall(b"".join(frames))
+            for message in messages:
+                print(f"Sent: {message}")
+            return True
+        except Exception as e:
+            for request_id in request_ids:
+                self.dispatcher.cancel(request_id)
+            print("Failed to write to the server:", e)
+            return False
+
+    def reply_handler(self, frame, function):
+        """Wraps function(reply) as an on_reply function that runs it on the UI thread, as long as frame still exists
+
+        Args:
+            frame (tk.Frame): The page waiting for the reply, which may be gone by the time it arrives
+            function (function): Called with the reply
+        """
+        def on_reply(reply):
+            self.after(0, lambda: frame.winfo_exists() and function(reply))
+        return on_reply
+
+    def reply_succeeded(self, reply):
+        """Tells whether a reply handed to an on_reply function reports success
+
+        Args:
+            reply (dict or string): The reply, or None if the connection was lost before it arrived
+        """
+        if reply is None:
+            return False
+        if isinstance(reply, dict):
+            return not reply.get("errorMsg")
+        return reply[:2] != "ER"
 
 
     def read_from_server_wp(self):
@@ -130,6 +370,9 @@ class App(tk.Tk):
             try:
                 str_bytes = ""
                 recv_data = self.socket.recv(1)
+                if recv_data == b"Z" and self.negotiated_compression:
+                    self.handle_reads(self.read_compressed_frame())
+                    continue
                 while recv_data:
                     if len(recv_data.decode("utf-8")) > 0:
                         if (recv_data.decode("utf-8")).isnumeric():
@@ -162,16 +405,77 @@ class App(tk.Tk):
             except Exception as e:
                 print("Error reading from server:", e)
                 self.is_connected = False
+                self.dispatcher.fail_all(None)
                 self.after(300, lambda :threading.Thread(target=self.connect_to_server, daemon=True).start())
                 break
 
 
+    def read_from_server_v2(self):
+        """Reads messages from the server using version 2 of the wire protocol
+        Notes:
+            - Reads whatever the server sent into a buffer and calls handle_reads_v2 on every complete frame
+        """
+        buf = bytearray()
+        while self.is_connected:
+            try:
+                data = self.socket.recv(4096)
+                if not data:
+                    print("Server connection closed")
+                    self.is_connected = False
+                    break
+                buf += data
+                max_decompressed = self.max_decompressed if self.negotiated_compression else None
+                for opcode, request_id, fields in wire_v2.extract_frames(buf, max_decompressed):
+                    self.handle_reads_v2(opcode, request_id, fields)
+
+            except Exception as e:
+                print("Error reading from server:", e)
+                self.is_connected = False
+                self.dispatcher.fail_all(None)
+                self.after(300, lambda :threading.Thread(target=self.connect_to_server, daemon=True).start())
+                break
+
+    def handle_reads_v2(self, opcode, request_id, fields):
+        """Handles a version 2 frame from the server by converting it to the json form and passing it to handle_reads_json
+
+        Args:
+            opcode (string): The 3 letter reply type
+            request_id (int): The id of the request the frame answers, 0 for pushes
+            fields (list): The fields of the frame
+        """
+        json_data = {"type": opcode}
+        match opcode:
+            case "SEL":
+                json_data.update(messageId=int(fields[0]), sender=fields[1], timestamp=fields[2], message=fields[3])
+            case "LAT":
+                json_data["accounts"] = fields
+            case "LST":
+                json_data.update(cursor=fields[0], accounts=fields[1:])
+            case "SUT":
+                json_data.update(version=int(fields[0]), accounts=fields[1:])
+            case "ACA" | "ACD":
+                json_data.update(version=int(fields[0]), username=fields[1])
+            case "RET":
+                json_data["messages"] = [
+                    {"messageId": int(fields[i]), "sender": fields[i + 1], "timestamp": fields[i + 2], "message": fields[i + 3]}
+                    for i in range(1, len(fields), 4)
+                ]
+            case _:
+                if opcode.startswith("ER"):
+                    json_data.update(success=False, errorMsg=fields[0] if fields else opcode)
+        self.handle_reads_json(json_data)
+        self.dispatcher.complete(request_id, json_data)
+
     # functions to handle reads for wire protocol and json
     def handle_reads(self, server_message):
+        """Handles a reply or push from the server, then hands replies to whoever sent their request"""
         if self.is_json:
+            request_id = server_message.pop(dispatcher.JSON_KEY, None)
             self.handle_reads_json(server_message)
         else:
+            request_id, server_message = dispatcher.split_request_id(server_message)
             self.handle_reads_wp(server_message)
+        self.dispatcher.complete(request_id, server_message)
 
 
     def handle_reads_wp(self, server_message):
@@ -189,6 +493,10 @@ class App(tk.Tk):
             "LIT" - Login successful
             "LOT" - Logout successful
             "LAT" - List of accounts
+            "LST" - Page of an account search
+            "SUT" - Copy of the account directory
+            "ACA" - Account created
+            "ACD" - Account deleted
             "RET" - Retrieve messages
             "DMT" - Delete message
         """
@@ -222,6 +530,15 @@ class App(tk.Tk):
                 self.reset_state()
             case "LAT":
                 self.accounts = data.split(" ")
+            case "LST":
+                cursor, *accounts = data.split(" ")
+                self.handle_search_page([account for account in accounts if account], cursor)
+            case "SUT":
+                version, *accounts = data.split(" ")
+                self.handle_directory([account for account in accounts if account], int(version))
+            case "ACA" | "ACD":
+                version, username = data.split(" ")
+                self.handle_directory_change(request_type, int(version), username)
             case "RET":
                 parts = data.split(" ")
                 num_read = int(parts[0])
@@ -281,48 +598,43 @@ class App(tk.Tk):
 
 
     #
-    def write_to_server_wp(self, message):
-        """Writes messages to the server using json
+    def encode_request_wp(self, message, request_id):
+        """Frames a request in the wire protocol, in the version negotiated for the connection
 
         Args:
-            message_dict (string): Contains a message to send to the server
+            message (string): The request
+            request_id (int): The id the server echoes in its reply
 
         Returns:
-            boolean: True or false depending on if the message was sent successfully
+            bytes: The frame, ready to be sent
         """
-        if not self.is_connected:
-            print("Not connected to server")
-            return False
-        try:
-            return_data = str(len(message)) + message
-            self.socket.sendall(return_data.encode('utf-8'))
-            print(f"Sent: {message}")
-            return True
-        except Exception as e:
-            print("Failed to write to the server.")
-            print(e)
-            return False
-
-    def write_to_server_json(self, message_dict):
-        """Writes messages to the server using json
+        if self.negotiated_version == 2:
+            opcode, fields = wire_v2.v1_request_fields(message)
+            frame = wire_v2.encode_frame(opcode, request_id, fields)
+            if self.negotiated_compression:
+                frame = wire_v2.compress_frame(frame, self.compression_threshold)
+            return frame
+        message = dispatcher.tag_request(message, request_id)
+        return_data = (str(len(message)) + message).encode('utf-8')
+        if self.negotiated_compression:
+            return_data = compression.compress_frame(return_data, self.compression_threshold)
+        return return_data
+
+    def encode_request_json(self, message_dict, request_id):
+        """Frames a request in json
 
         Args:
-            message_dict (dict): Contains a json message to send to the server
+            message_dict (dict): The request
+            request_id (int): The id the server echoes in its reply
 
         Returns:
-            boolean: True or false depending on if the message was sent successfully
+            bytes: The frame, ready to be sent
         """
-        if not self.is_connected:
-            print("Not connected to server")
-            return False
-        try:
-            json_message = json.dumps(message_dict)
-            return_data = str(len(json_message)) + json_message
-            self.socket.sendall(return_data.encode('utf-8'))
-            return True
-        except Exception as e:
-            print("Failed to write to server:", e)
-            return False
+        json_message = json.dumps({**message_dict, dispatcher.JSON_KEY: request_id})
+        return_data = (str(len(json_message)) + json_message).encode('utf-8')
+        if self.negotiated_compression:
+            return_data = compression.compress_frame(return_data, self.compression_threshold)
+        return return_data
 
     def read_from_server_json(self):
         """Reads messages from the server using json
@@ -334,6 +646,9 @@ class App(tk.Tk):
             try:
                 str_bytes = ""
                 recv_data = self.socket.recv(1)
+                if recv_data == b"Z" and self.negotiated_compression:
+                    self.handle_reads(json.loads(self.read_compressed_frame()))
+                    continue
                 while recv_data:
                     if len(recv_data.decode("utf-8")) > 0:
                         if (recv_data.decode("utf-8")).isnumeric():
@@ -356,12 +671,13 @@ class App(tk.Tk):
 
                 message = ret_data.decode('utf-8')
                 json_data = json.loads(message)
-                self.handle_reads_json(json_data)
+                self.handle_reads(json_data)
 
             except Exception as e:
                 print("Error reading from server:", e)
                 self.after(300, lambda :threading.Thread(target=self.connect_to_server, daemon=True).start())
                 self.is_connected = False
+                self.dispatcher.fail_all(None)
                 break
 
     def handle_reads_json(self, json_data):
@@ -380,6 +696,10 @@ class App(tk.Tk):
             "LIT" - Login successful
             "LOT" - Logout successful
             "LAT" - List of accounts
+            "LST" - Page of an account search
+            "SUT" - Copy of the account directory
+            "ACA" - Account created
+            "ACD" - Account deleted
             "RET" - Retrieve messages
             "DMT" - Delete message
         """
@@ -407,6 +727,12 @@ class App(tk.Tk):
                 self.reset_state()
             case "LAT":
                 self.accounts = json_data.get("accounts", [])
+            case "LST":
+                self.handle_search_page(json_data.get("accounts", []), json_data.get("cursor", ""))
+            case "SUT":
+                self.handle_directory(json_data.get("accounts", []), json_data["version"])
+            case "ACA" | "ACD":
+                self.handle_directory_change(request_type, json_data["version"], json_data["username"])
             case "RET":
                 messages = json_data.get("messages", [])
                 new_messages = []
@@ -465,26 +791,8 @@ class Onboarding(tk.Frame):
         self.button_create_account = tk.Button(self, text="Create Account", command=self.handle_create_account)
         self.button_create_account.grid(row=2, column=2)
 
-        self.update_accounts()
-
-
-    # updates accounts on login page to ensure that users are updated correctly
-    def update_accounts(self):
-        if self.controller.is_json:
-            self.controller.write_to_server_json({"type": "LA"})
-        else:
-            self.controller.write_to_server("LA")
-        self.after_id = self.after(1000, self.update_accounts)
-
-    # cleanup function to cancel any pending after calls
-    def cleanup(self):
-        if self.after_id:
-            self.after_cancel(self.after_id)
-            self.after_id = None
-
     # leave to navigation page
     def leave_to_navigation(self):
-        self.cleanup()
         self.controller.show_frame(Navigation)
 
     # gpt hash function
@@ -521,10 +829,9 @@ class Onboarding(tk.Frame):
                 }
             else:
                 return_value = "LI" + username + " " + hashed_password
-            if self.controller.write_to_server(return_value):
-                self.cleanup()
+            # Check the login once the server answers it
+            if self.controller.write_to_server(return_value, on_reply=self.controller.reply_handler(self, lambda reply: self.check_login_success())):
                 self.controller.current_user = username
-                self.after(500, self.check_login_success)
             else:
                 messagebox.showerror("Error", "Login failed. Please try again.")
         else:
@@ -569,14 +876,16 @@ class Onboarding(tk.Frame):
             }
         else:
             return_value = "CR" + username + " " + hashed_password
-        if self.controller.write_to_server(return_value):
-            # Store these for after we get CRT response
-            self.pending_username = username
-            self.pending_password = hashed_password
-            self.after(100, self.complete_account_creation)
+        # Store these for after we get CRT response
+        self.pending_username = username
+        self.pending_password = hashed_password
+        self.controller.write_to_server(return_value, on_reply=self.controller.reply_handler(self, self.complete_account_creation))
 
-    def complete_account_creation(self):
+    def complete_account_creation(self, reply):
         # Only proceed with login if we got CRT confirmation
+        if not self.controller.reply_succeeded(reply):
+            messagebox.showerror("Error", "Account creation failed. Please try again.")
+            return
         if self.pending_username and self.pending_password:
             if self.controller.is_json:
                 login_value = {
@@ -587,8 +896,7 @@ class Onboarding(tk.Frame):
             else:
                 login_value = "LI" + self.pending_username + " " + self.pending_password
             self.controller.current_user = self.pending_username
-            if self.controller.write_to_server(login_value):
-                self.after(200, self.check_login_success)
+            self.controller.write_to_server(login_value, on_reply=self.controller.reply_handler(self, lambda reply: self.check_login_success()))
 
 
 class Navigation(tk.Frame):
@@ -737,21 +1045,10 @@ class Chat(tk.Frame):
         self.status_label = tk.Label(self, text="")
         self.status_label.grid(row=3, column=0, columnspan=3, pady=10)
 
-        self.update_accounts()
-
     #
     def back_to_navigation(self):
-        self.after_cancel(self.after_id)
         self.controller.show_frame(Navigation)
 
-    # update accounts to ensure that the user is up to date
-    def update_accounts(self):
-        if self.controller.is_json:
-            self.controller.write_to_server_json({"type": "LA"})
-        else:
-            self.controller.write_to_server("LA")
-        self.after_id = self.after(500, self.update_accounts)
-
 
     # Handle sending messages
     def on_button_click(self):
@@ -778,13 +1075,20 @@ class Chat(tk.Frame):
         else:
             send_value = f"SE{self.controller.current_user} {username} {timestamp} {message}"
 
-        if self.controller.write_to_server(send_value):
-            self.status_label.config(text="Message sent successfully!", fg="green")
+        if self.controller.write_to_server(send_value, on_reply=self.controller.reply_handler(self, self.show_send_result)):
+            self.status_label.config(text="Sending...", fg="black")
             self.entry_textbox.delete(0, tk.END)
             self.username_textbox.delete(0, tk.END)
         else:
             self.status_label.config(text="Failed to send message.", fg="red")
 
+    def show_send_result(self, reply):
+        # Report what the server said once it answers the send
+        if self.controller.reply_succeeded(reply):
+            self.status_label.config(text="Message sent successfully!", fg="green")
+        else:
+            self.status_label.config(text="Failed to send message.", fg="red")
+
 class MessageDisplay(tk.Frame):
     """
     Page to display messages received frame
@@ -931,11 +1235,24 @@ class MessageDisplay(tk.Frame):
             print("Message deleted successfully")
 
 class SearchAccount(tk.Frame):
+    """
+    Page to search for accounts by username prefix
+
+    Notes:
+    - The server does the search and sends the results a page at a time, the "More" button asks for the next page
+
+    Args:
+        tk (tk.Frame): The parent Tk.frame that called the frame
+
+    Attributes:
+        - parent: The parent Tk.frame that called the frame
+        - controller: The controller object that is used to control the app
+        - search_term: The prefix of the current search
+    """
     def __init__(self, parent, controller):
         tk.Frame.__init__(self, parent)
         self.controller = controller
-        self.accounts = self.controller.accounts
-        self.is_first_display = True
+        self.search_term = ""
 
         self.grid_columnconfigure(1, weight=1)
         self.grid_rowconfigure(2, weight=1)
@@ -959,44 +1276,32 @@ class SearchAccount(tk.Frame):
         self.results_text = tk.Text(self, wrap=tk.WORD, height=10)
         self.results_text.grid(row=2, column=0, columnspan=3, sticky="nsew", padx=10, pady=10)
 
-        self.update_accounts()
+        self.more_button = tk.Button(self, text="More", command=self.next_page, state="disabled")
+        self.more_button.grid(row=3, column=2, pady=5, padx=10)
+
+        # Start by listing the first page of every account
+        self.controller.search_accounts(self.search_term)
 
     def back_to_navigation(self):
-        self.after_cancel(self.after_id)
         self.controller.show_frame(Navigation)
 
-    def update_accounts(self):
-        if self.controller.is_json:
-            self.controller.write_to_server_json({"type": "LA"})
-        else:
-            self.controller.write_to_server("LA")
-        self.display_accounts()
-        self.after_id = self.after(500, self.update_accounts)
-
-    def display_accounts(self, filter_text=None):
-        # Always display if we have a filter_text, regardless of whether accounts changed
-        if not filter_text and not self.is_first_display and self.controller.accounts == self.accounts:
-            return
-
-        self.is_first_display = False
-        self.accounts = self.controller.accounts.copy()
+    def display_accounts(self):
         self.results_text.config(state='normal')
         self.results_text.delete(1.0, tk.END)
 
-        displayed_accounts = self.accounts
-
-        if filter_text:
-            displayed_accounts = [user for user in displayed_accounts if filter_text.lower() in user.lower()]
-
-        for username in displayed_accounts:
+        for username in self.controller.search_results:
             self.results_text.insert(tk.END, f"Username: {username}\n")
 
         self.results_text.config(state='disabled')
+        self.more_button.config(state="normal" if self.controller.search_cursor else "disabled")
 
     def search_account(self):
-        search_term = self.username_textbox.get()
-        self.display_accounts(search_term)
+        self.search_term = self.username_textbox.get()
+        self.controller.search_accounts(self.search_term)
 
+    def next_page(self):
+        if self.controller.search_cursor:
+            self.controller.search_accounts(self.search_term, self.controller.search_cursor)
 
 
 if __name__ == "__main__":
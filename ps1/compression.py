@@ -0,0 +1,159 @@
+# Optional zlib compression of frames, negotiated per connection
+#
+# Right after connecting, before anything else, a client asks for compression with the version 1 request
+# "CMzlib" (json: {"type": "CM", "codec": "zlib"}) and the server agrees with "CMTzlib" (json: "CMT"). From then
+# on either side may compress a frame it sends whose body is at least its own threshold, and it only does so
+# when the compressed body is smaller:
+#   - a length-prefixed frame (wire protocol version 1 and json) is sent as "Z", the byte length of the
+#     compressed body in decimal, a space, and then the compressed body
+#   - a wire protocol version 2 frame sets wire_v2.COMPRESSED_FLAG in the body length of its header
+# Servers that do not support compression reply with an error, and the connection stays uncompressed.
+
+import threading
+import time
+import zlib
+
+CODEC = "zlib"
+# Marks a compressed length-prefixed frame. Uncompressed frames always start with a digit.
+MARKER = ord("Z")
+
+# Counters for this process, to weigh the bytes compression saves against the cpu time it costs. Bodies
+# that did not get smaller still count towards compress_cpu_ns.
+stats = {
+    "compressed_frames": 0,
+    "uncompressible_frames": 0,
+    "compress_bytes_in": 0,
+    "compress_bytes_out": 0,
+    "compress_cpu_ns": 0,
+    "decompressed_frames": 0,
+    "decompress_bytes_in": 0,
+    "decompress_bytes_out": 0,
+    "decompress_cpu_ns": 0,
+}
+# Frames may be compressed and decompressed on several threads at once, see REQUEST_THREADS in server.py
+stats_lock = threading.Lock()
+
+def compress(body, level=6):
+    """
+    Compresses a frame body.
+
+    Parameters
+    ----------
+    body: bytes-like
+        The frame body
+    level: int
+        The zlib compression level
+
+    Returns
+    -------
+    bytes or None
+        The compressed body, or None if compressing did not make it smaller
+    """
+    start_ns = time.thread_time_ns()
+    compressed = zlib.compress(body, level)
+    with stats_lock:
+        stats["compress_cpu_ns"] += time.thread_time_ns() - start_ns
+        if len(compressed) >= len(body):
+            stats["uncompressible_frames"] += 1
+            return None
+        stats["compressed_frames"] += 1
+        stats["compress_bytes_in"] += len(body)
+        stats["compress_bytes_out"] += len(compressed)
+    return compressed
+
+def decompress(data, max_length):
+    """
+    Decompresses a frame body.
+
+    Parameters
+    ----------
+    data: bytes-like
+        The compressed body
+    max_length: int
+        The most bytes the body may decompress to, which guards against tiny frames that expand to huge ones
+
+    Returns
+    -------
+    bytes
+        The frame body
+
+    Raises
+    ------
+    ValueError
+        If the data is not a complete zlib stream or expands past max_length
+    """
+    start_ns = time.thread_time_ns()
+    decompressor = zlib.decompressobj()
+    try:
+        body = decompressor.decompress(data, max_length)
+    except zlib.error as e:
+        raise ValueError(f"bad compressed frame: {e}")
+    with stats_lock:
+        stats["decompress_cpu_ns"] += time.thread_time_ns() - start_ns
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise ValueError("compressed frame is truncated or too large")
+        stats["decompressed_frames"] += 1
+        stats["decompress_bytes_in"] += len(data)
+        stats["decompress_bytes_out"] += len(body)
+    return body
+
+def compress_frame(payload, threshold, level=6):
+    """
+    Compresses a length-prefixed frame if its body is at least threshold bytes and compresses well.
+
+    Parameters
+    ----------
+    payload: bytes
+        The frame, a decimal length prefix followed by the body
+    threshold: int
+        The smallest body, in bytes, worth compressing
+
+    Returns
+    -------
+    bytes
+        The compressed frame, or payload itself if it was left alone
+    """
+    prefix_end = 0
+    while prefix_end < len(payload) and 48 <= payload[prefix_end] <= 57:
+        prefix_end += 1
+    if len(payload) - prefix_end < threshold:
+        return payload
+    compressed = compress(memoryview(payload)[prefix_end:], level)
+    if compressed is None:
+        return payload
+    return b"Z" + str(len(compressed)).encode("ascii") + b" " + compressed
+
+def split_compressed_frame(buf, start):
+    """
+    Finds a compressed length-prefixed frame in a receive buffer.
+
+    Parameters
+    ----------
+    buf: bytearray
+        The receive buffer
+    start: int
+        Index of the "Z" that starts the frame
+
+    Returns
+    -------
+    tuple or None
+        The index of the first byte of the compressed body and the index one past its end, or None if the
+        frame has not fully arrived yet
+
+    Raises
+    ------
+    ValueError
+        If the byte length is malformed
+    """
+    pos = start + 1
+    while pos < len(buf) and 48 <= buf[pos] <= 57:
+        pos += 1
+    if pos == len(buf):
+        return None
+    if pos == start + 1 or buf[pos] != 32:
+        raise ValueError("compressed frame is missing its byte length")
+    body_start = pos + 1
+    end = body_start + int(buf[start + 1:pos])
+    if end > len(buf):
+        return None
+    return body_start, end
@@ -0,0 +1,114 @@
+# Request ids, so a client can keep many requests in flight
+#
+# A client may tag any request with an id, and the server echoes it in the reply to that request:
+#   - wire protocol version 1: the frame body starts with "#", the id and a space, as in "#17 SEalice bob ...",
+#     and the reply body starts the same way, as in "#17 SET". Request bodies otherwise start with their type,
+#     so untagged requests are read as before.
+#   - json: the request has a "requestId" key, which the reply carries back unchanged
+#   - wire protocol version 2: the request id in the frame header, see wire_v2.py
+# Pushes, such as SEL, never carry an id. With ids, a client can write a burst of requests at once and match
+# every reply to its request as it comes in, instead of waiting for each reply before sending the next
+# request, and it does not depend on the server answering in order.
+
+import threading
+
+PREFIX = "#"
+JSON_KEY = "requestId"
+# The v2 header holds 32 bits, and 0 is left for pushes
+MAX_REQUEST_ID = 2 ** 32 - 1
+
+def tag_request(body, request_id):
+    """Puts a request id in front of a version 1 frame body."""
+    return f"{PREFIX}{request_id} {body}"
+
+def split_request_id(body):
+    """
+    Splits the request id off a version 1 frame body.
+
+    Parameters
+    ----------
+    body: str
+        The frame body, without its length prefix
+
+    Returns
+    -------
+    tuple
+        The request id as sent, or None if the body has none, and the rest of the body
+
+    Raises
+    ------
+    ValueError
+        If the body starts like a tagged body but the id is not followed by a space
+    """
+    if body[:1] != PREFIX:
+        return None, body
+    request_id, space, rest = body[1:].partition(" ")
+    if not space:
+        raise ValueError("request id is not followed by a space")
+    return request_id, rest
+
+class Dispatcher:
+    """
+    Matches replies to the requests a client has in flight, by request id.
+
+    Attributes:
+    - pending (dict): Maps the id of every request waiting for its reply to the function to call with the reply,
+      or None to just forget the request once its reply arrives.
+    - next_id (int): The id the next request gets. Ids count up from 1 and wrap around after MAX_REQUEST_ID.
+    """
+    def __init__(self):
+        self.pending = {}
+        self.next_id = 1
+        # Requests are registered by whoever sends them and completed by the thread that reads replies
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def register(self, on_reply=None):
+        """Reserves an id for a request about to be sent, and returns it."""
+        with self.lock:
+            request_id = self.next_id
+            self.next_id = self.next_id % MAX_REQUEST_ID + 1
+            self.pending[request_id] = on_reply
+        return request_id
+
+    def cancel(self, request_id):
+        """Forgets a request, for example one that could not be sent."""
+        with self.lock:
+            self.pending.pop(request_id, None)
+
+    def complete(self, request_id, *reply):
+        """
+        Hands a reply to the function registered for its request.
+
+        Parameters
+        ----------
+        request_id: int, str or None
+            The id the reply carries, None if it carries none
+        reply:
+            Passed on to the function
+
+        Returns
+        -------
+        bool
+            False if the reply does not answer a request in flight, as with pushes
+        """
+        if request_id is None:
+            return False
+        with self.lock:
+            if int(request_id) not in self.pending:
+                return False
+            on_reply = self.pending.pop(int(request_id))
+        if on_reply is not None:
+            on_reply(*reply)
+        return True
+
+    def fail_all(self, *reply):
+        """Completes every request in flight with the same reply, for when the connection is lost."""
+        with self.lock:
+            pending = list(self.pending.values())
+            self.pending.clear()
+        for on_reply in pending:
+            if on_reply is not None:
+                on_reply(*reply)
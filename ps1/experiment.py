@@ -1,5 +1,3 @@
-
-import socket
 import time
 import json
 import threading
@@ -8,10 +6,39 @@ import os
 from datetime import datetime
 from dotenv import load_dotenv
 
+from framing import extract_frames
+import dispatcher
+import transport
+
 load_dotenv()
 
+class PendingRequest:
+    """
+    A request waiting for its reply.
+
+    Attributes:
+    - sent_ns (int): time.perf_counter_ns() just before the request was written to the socket.
+    - received_ns (int): time.perf_counter_ns() right after the recv that read the last byte of the reply frame.
+    - reply (str): The reply frame, without its length prefix.
+    - done (threading.Event): Set by the read thread once the reply is in.
+    """
+    def __init__(self):
+        self.sent_ns = None
+        self.received_ns = None
+        self.reply = None
+        self.done = threading.Event()
+
+    def finish(self, reply, received_ns):
+        """Completes the request with its reply. Called by the read thread, or with no reply if the connection closed."""
+        self.received_ns = received_ns
+        self.reply = reply
+        self.done.set()
+
+    def latency_ns(self):
+        return self.received_ns - self.sent_ns
+
 class LatencyTester:
-    def __init__(self, host=None, port=None, is_json=True, num_iterations=100):
+    def __init__(self, host=None, port=None, is_json=True, num_iterations=100, burst_size=100):
         """
         Initialize latency tester for server communication.
         """
@@ -19,13 +46,14 @@ class LatencyTester:
         self.port = port or int(os.environ.get("PORT_SERVER"))
         self.is_json = is_json
         self.num_iterations = num_iterations
+        self.burst_size = burst_size
         self.socket = None
         self.is_connected = False
 
-        # Latency tracking
+        # Requests waiting for a reply, matched to it by request id
+        self.dispatcher = dispatcher.Dispatcher()
+        # Latency of every measured request, in nanoseconds
         self.latencies = []
-        self.send_time = None
-        self.current_iteration = 0
 
     def enhash(self, password):
         """Simple hash function to match client-side hashing."""
@@ -34,13 +62,13 @@ class LatencyTester:
 
     def connect_to_server(self):
         """Establish a socket connection."""
-        print(f"Attempting to connect to {self.host}:{self.port}")
+        print(f"Attempting to connect to {transport.format_address(self.host, self.port)}")
 
         while not self.is_connected:
             try:
-                print(f"Attempting to connect to {self.host}:{self.port}")
-                self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.socket.connect((self.host, self.port))
+                print(f"Attempting to connect to {transport.format_address(self.host, self.port)}")
+                # A "unix:<path>" host connects over the server's Unix domain socket, see transport.py
+                self.socket = transport.connect(self.host, self.port)
                 self.is_connected = True
                 print("Connected to server.")
 
@@ -53,82 +81,110 @@ class LatencyTester:
                 time.sleep(1)
 
     def read_from_server(self):
-        """Reads messages from the server"""
+        """
+        Reads frames from the server and completes the pending request each reply carries the id of. Pushes
+        carry no request id and are skipped.
+
+        The receive time is taken as soon as recv returns the bytes that complete the frame, before the
+        buffer is parsed, the reply is decoded or the waiting thread wakes up.
+        """
+        buf = bytearray()
         while self.is_connected:
             try:
-                str_bytes = ""
-                recv_data = self.socket.recv(1)
-                while recv_data:
-                    if len(recv_data.decode("utf-8")) > 0:
-                        if (recv_data.decode("utf-8")).isnumeric():
-                            str_bytes += recv_data.decode("utf-8")
-                        else:
-                            break
-                    recv_data = self.socket.recv(1)
-
-                num_bytes = int(str_bytes)
-                cur_bytes = 1
-                ret_data = recv_data
-
-                if not str_bytes:
-                    print("No length prefix received")
-                    continue
-
-                while (cur_bytes < num_bytes):
-                    data = self.socket.recv(num_bytes - cur_bytes)
-                    if not data:
-                        print("Server connection closed")
-                        self.is_connected = False
-                        break
-                    ret_data += data
-                    cur_bytes += len(data.decode("utf-8"))
-
-                message = ret_data.decode('utf-8')
-                print(f"Received: {message[:num_bytes]}")
-
-                # Calculate latency for experiment messages
-                if self.send_time is not None:
-                    latency = (time.time() - self.send_time) * 1000  # Convert to milliseconds
-                    self.latencies.append(latency)
-                    self.current_iteration += 1
-                    self.send_time = None
-
+                data = self.socket.recv(65536)
+                received_ns = time.perf_counter_ns()
+                if not data:
+                    print("Server connection closed")
+                    break
+                buf += data
+                frames = extract_frames(buf)
+                for frame in frames:
+                    if self.is_json:
+                        request_id = json.loads(frame).get(dispatcher.JSON_KEY)
+                    else:
+                        request_id, frame = dispatcher.split_request_id(frame)
+                    self.dispatcher.complete(request_id, frame, received_ns)
             except Exception as e:
                 print("Error reading from server:", e)
+                break
+        self.is_connected = False
+        # Wake up anyone still waiting, the replies are not coming
+        self.dispatcher.fail_all(None, None)
+
+    def encode_request(self, message, request_id):
+        """Frames a message with its request id, in the protocol under test."""
+        # Prepare message based on protocol
+        if self.is_json:
+            message_str = json.dumps({**message, dispatcher.JSON_KEY: request_id})
+        else:
+            # Wire protocol message formatting
+            if message['type'] == 'CR':
+                message_str = f"CR{message['username']} {message['password']}"
+            elif message['type'] == 'LI':
+                message_str = f"LI{message['username']} {message['password']}"
+            elif message['type'] == 'SE':
+                message_str = f"SE{message['from_username']} {message['to_username']} {message['timestamp']} {message['message']}"
+            else:
+                raise ValueError(f"Unsupported message type: {message['type']}")
+            message_str = dispatcher.tag_request(message_str, request_id)
+
+        # Prepare payload with length prefix, which counts characters
+        return (str(len(message_str)) + message_str).encode('utf-8')
+
+    def write_to_server(self, *messages):
+        """
+        Send messages to the server, all in one write.
 
-    def write_to_server(self, message):
-        """Send a message to the server."""
+        Returns a PendingRequest for every message, which completes when its reply arrives, or None if sending failed.
+        """
         if not self.is_connected:
             print("Not connected to server")
-            return False
+            return None
+        requests = [PendingRequest() for _ in messages]
+        # Register the requests before sending, so a reply can never arrive ahead of its request
+        request_ids = [self.dispatcher.register(request.finish) for request in requests]
         try:
-            # Prepare message based on protocol
-            if self.is_json:
-                message_str = json.dumps(message)
-            else:
-                # Wire protocol message formatting
-                if message['type'] == 'CR':
-                    message_str = f"CR{message['username']} {message['password']}"
-                elif message['type'] == 'LI':
-                    message_str = f"LI{message['username']} {message['password']}"
-                elif message['type'] == 'SE':
-                    message_str = f"SE{message['from_username']} {message['to_username']} {message['timestamp']} {message['message']}"
-                else:
-                    raise ValueError(f"Unsupported message type: {message['type']}")
-
-            # Prepare payload with length prefix
-            payload = str(len(message_str.encode('utf-8'))) + message_str
-
-            # Track send time for latency calculation
-            self.send_time = time.time()
-
-            # Send message
-            self.socket.sendall(payload.encode('utf-8'))
-            print(f"Sent: {payload}")
-            return True
+            payload = b"".join(self.encode_request(message, request_id) for message, request_id in zip(messages, request_ids))
+            sent_ns = time.perf_counter_ns()
+            for request in requests:
+                request.sent_ns = sent_ns
+            self.socket.sendall(payload)
+            return requests
         except Exception as e:
+            for request_id in request_ids:
+                self.dispatcher.cancel(request_id)
             print(f"Failed to write to the server: {e}")
-            return False
+            return None
+
+    def request(self, message, timeout=10):
+        """Sends a message and blocks until its reply arrives. Returns the completed PendingRequest or None."""
+        requests = self.write_to_server(message)
+        if requests is None or not requests[0].done.wait(timeout) or requests[0].reply is None:
+            return None
+        return requests[0]
+
+    def burst(self, messages, timeout=10):
+        """
+        Sends messages in one write without waiting for any reply in between, and blocks until every reply
+        arrives. Returns the nanoseconds from sending to the last reply, or None.
+        """
+        requests = self.write_to_server(*messages)
+        if requests is None:
+            return None
+        for request in requests:
+            if not request.done.wait(timeout) or request.reply is None:
+                return None
+        return max(request.received_ns for request in requests) - requests[0].sent_ns
+
+    def se_message(self, text):
+        """Builds an SE request from Tester to TestReceiver."""
+        return {
+            'type': 'SE',
+            'from_username': 'Tester',
+            'to_username': 'TestReceiver',
+            'timestamp': str(datetime.now()).replace(" ", ""),
+            'message': text
+        }
 
     def send_messages(self):
         """
@@ -140,93 +196,66 @@ class LatencyTester:
                     "error": "Could not connect to server"}
 
         try:
-            # Create Tester account
-            tester_create_msg = {
-                'type': 'CR',
-                'username': 'Tester',
-                'password': self.enhash('testerpass')
-            }
-            if not self.write_to_server(tester_create_msg):
-                return {"error": "Failed to create Tester account"}
-
-            # Wait for account creation
-            while self.current_iteration == 0 and self.is_connected:
-                time.sleep(0.1)
-
-            # Create TestReceiver account
-            receiver_create_msg = {
-                'type': 'CR',
-                'username': 'TestReceiver',
-                'password': self.enhash('receiverpass')
-            }
-            if not self.write_to_server(receiver_create_msg):
-                return {"error": "Failed to create TestReceiver account"}
-
-            # Wait for account creation
-            while self.current_iteration == 1 and self.is_connected:
-                time.sleep(0.1)
-
-            # Login Tester
-            tester_login_msg = {
-                'type': 'LI',
-                'username': 'Tester',
-                'password': self.enhash('testerpass')
-            }
-            if not self.write_to_server(tester_login_msg):
-                return {"error": "Failed to login Tester"}
-
-            # Wait for login
-            while self.current_iteration == 2 and self.is_connected:
-                time.sleep(0.1)
+            # Create the Tester and TestReceiver accounts, which may be left over from an earlier run,
+            # and login Tester
+            setup = [
+                {'type': 'CR', 'username': 'Tester', 'password': self.enhash('testerpass')},
+                {'type': 'CR', 'username': 'TestReceiver', 'password': self.enhash('receiverpass')},
+                {'type': 'LI', 'username': 'Tester', 'password': self.enhash('testerpass')},
+            ]
+            for message in setup:
+                if self.request(message) is None:
+                    return {"error": f"No reply to the {message['type']} request"}
 
             # Send test messages
             for i in range(self.num_iterations):
-                # Prepare send message
-                timestamp = str(datetime.now()).replace(" ", "")
-                send_msg = {
-                    'type': 'SE',
-                    'from_username': 'Tester',
-                    'to_username': 'TestReceiver',
-                    'timestamp': timestamp,
-                    'message': f'Test message {i}'
-                }
-
-                # Send message
-                if not self.write_to_server(send_msg):
+                # Send message and wait for the response
+                request = self.request(self.se_message(f'Test message {i}'))
+                if request is None:
                     break
+                self.latencies.append(request.latency_ns())
 
-                # Wait for response
-                while self.current_iteration < i + 3 and self.is_connected:
-                    time.sleep(0.1)
+            # Send a burst of messages at once, which should take about one round trip instead of one per message
+            burst_ns = self.burst([self.se_message(f'Burst message {i}') for i in range(self.burst_size)])
 
         except Exception as e:
             print(f"Unexpected error during testing: {e}")
             return {"error": str(e)}
+        finally:
+            self.is_connected = False
+            self.socket.close()
 
-        # Calculate and return statistics
+        # Calculate and return statistics, in milliseconds to the microsecond
+        latencies_ms = [latency / 1e6 for latency in self.latencies]
         return {
             "protocol": "JSON" if self.is_json else "Wire Protocol",
-            "min_latency_ms": min(self.latencies) if self.latencies else None,
-            "max_latency_ms": max(self.latencies) if self.latencies else None,
-            "mean_latency_ms": statistics.mean(self.latencies) if self.latencies else None,
-            "median_latency_ms": statistics.median(self.latencies) if self.latencies else None,
-            "iterations": len(self.latencies)
+            "min_latency_ms": round(min(latencies_ms), 3) if latencies_ms else None,
+            "max_latency_ms": round(max(latencies_ms), 3) if latencies_ms else None,
+            "mean_latency_ms": round(statistics.mean(latencies_ms), 3) if latencies_ms else None,
+            "median_latency_ms": round(statistics.median(latencies_ms), 3) if latencies_ms else None,
+            "p99_latency_ms": round(sorted(latencies_ms)[int(len(latencies_ms) * 0.99)], 3) if latencies_ms else None,
+            "iterations": len(latencies_ms),
+            "burst_size": self.burst_size,
+            "burst_total_ms": round(burst_ns / 1e6, 3) if burst_ns is not None else None,
+            "burst_per_request_ms": round(burst_ns / 1e6 / self.burst_size, 3) if burst_ns is not None else None,
         }
 
 def run_comprehensive_test():
     """
     Run comprehensive latency tests for both JSON and wire protocol.
+
+    The server picks the codec of each connection, so both tests run against the same server.
     """
     print("Running Comprehensive Latency Tests...")
 
     # Test JSON Protocol
     print("\n--- Testing JSON Protocol ---")
-    json_tester = LatencyTester(is_json=True, num_iterations=10)
+    json_tester = LatencyTester(is_json=True, num_iterations=1000)
     json_results = json_tester.send_messages()
 
     # Test Wire Protocol
     print("\n--- Testing Wire Protocol ---")
-    wp_tester = LatencyTester(is_json=False, num_iterations=10)
+    wp_tester = LatencyTester(is_json=False, num_iterations=1000)
     wp_results = wp_tester.send_messages()
 
     # Print Results
@@ -239,4 +268,4 @@ def run_comprehensive_test():
         print(f"{key}: {value}")
 
 if __name__ == "__main__":
-    run_comprehensive_test()
\ No newline at end of file
+    run_comprehensive_test()
@@ -0,0 +1,104 @@
+# Framing of version 1 of the custom wire protocol and of json
+#
+# Every frame is its body preceded by the body's length in decimal digits, with nothing in between. The length
+# counts characters, not bytes, so a body with multibyte utf-8 characters takes more bytes than its length says.
+# On a connection that negotiated compression (see compression.py), a frame may be compressed instead.
+#
+# The server and the client tools all read frames with extract_frames, so it is kept apart from server.py, which
+# sets up the server as it is imported.
+
+import compression
+
+def frame_end(buf, start, num_chars):
+    """
+    Finds where a frame body ends in a receive buffer.
+
+    Parameters
+    ----------
+    buf: bytearray
+        The receive buffer
+    start: int
+        Index of the first byte of the frame body
+    num_chars: int
+        The length prefix of the frame, which counts characters rather than bytes
+
+    Returns
+    -------
+    int or None
+        The index one past the last byte of the frame, or None if the frame has not fully arrived yet
+    """
+    end = start + num_chars
+    if end > len(buf):
+        return None
+    # Fast path: when every byte is ascii, characters and bytes line up
+    if buf[start:end].isascii():
+        return end
+    # Otherwise walk the utf-8 lead bytes to find the end of the last character
+    pos = start
+    for _ in range(num_chars):
+        if pos >= len(buf):
+            return None
+        lead = buf[pos]
+        if lead < 0x80:
+            pos += 1
+        elif lead < 0xE0:
+            pos += 2
+        elif lead < 0xF0:
+            pos += 3
+        else:
+            pos += 4
+    if pos > len(buf):
+        return None
+    return pos
+
+def extract_frames(buf, max_decompressed=None):
+    """
+    Pulls every complete length-prefixed frame out of a receive buffer.
+
+    Parameters
+    ----------
+    buf: bytearray
+        The receive buffer of a connection. Complete frames are removed from the front of it, and any
+        partial frame is left in place until the rest of it arrives.
+    max_decompressed: int or None
+        The most bytes a compressed frame may decompress to, or None if the connection did not negotiate
+        compression
+
+    Returns
+    -------
+    list
+        The decoded bodies of the complete frames, in the order they were received.
+
+    Raises
+    ------
+    ValueError
+        If the buffer does not start with a decimal length prefix or a valid compressed frame
+    """
+    frames = []
+    start = 0
+    while start < len(buf):
+        if buf[start] == compression.MARKER and max_decompressed is not None:
+            span = compression.split_compressed_frame(buf, start)
+            if span is None:
+                break
+            body = compression.decompress(memoryview(buf)[span[0]:span[1]], max_decompressed)
+            frames.append(body.decode("utf-8"))
+            start = span[1]
+            continue
+        # The length prefix is a run of decimal digits directly followed by the frame body
+        pos = start
+        while pos < len(buf) and 48 <= buf[pos] <= 57:
+            pos += 1
+        if pos == len(buf):
+            # Prefix has not been terminated yet
+            break
+        if pos == start:
+            raise ValueError("frame is missing its length prefix")
+        end = frame_end(buf, pos, int(buf[start:pos]))
+        if end is None:
+            break
+        frames.append(buf[pos:end].decode("utf-8"))
+        start = end
+    # Flush out the complete frames from the buffer so that things remain synced
+    del buf[:start]
+    return frames
@@ -0,0 +1,284 @@
+# Durable storage for the server's in-memory account store
+#
+# Every mutation of the store is appended to a journal as one json record per line. Records are handed to a
+# background writer thread that writes and fsyncs everything that piled up since its last pass, so many
+# mutations share one fsync (group commit). Every snapshot_every records the whole store is written to a
+# compact snapshot and a new journal segment is started, so a restart only loads the snapshot and replays the
+# journal written after it. The snapshot is written by the writer thread too, from a copy of the store the server
+# takes between requests, so serving does not wait for it. When a write fails the error is logged and counted,
+# and the records stay queued until a later pass writes them.
+#
+# Files in the journal directory:
+#   snapshot.json   - the latest snapshot, including the number of the first segment written after it
+#   journal.<n>.log - journal segments
+
+import json
+import os
+import threading
+import eventlog
+
+SNAPSHOT_FILE = "snapshot.json"
+
+log = eventlog.get_logger("ps1.journal")
+
+class Journal:
+    """
+    Append-only journal with group-commit fsync batching and periodic snapshots.
+
+    Attributes:
+    - directory (str): Where the journal segments and snapshot are stored.
+    - fsync_interval (float): Seconds between writer passes. Mutations made in the last fsync_interval seconds
+      before a crash can be lost.
+    - snapshot_every (int): Number of records after which the server should take a snapshot.
+    - records_since_snapshot (int): Records appended, or replayed, since the last snapshot was started.
+    - snapshot_error (Exception or None): What the last snapshot that failed raised. The journal goes on, and
+      the next snapshot covers it.
+    - write_error (OSError or None): What the last pass of the writer thread raised, or None if it wrote
+      everything. Records that were not written stay pending, and every pass tries them again.
+    - write_failures, snapshot_failures (int): Passes that could not write the journal, and snapshots that could
+      not be written, since the journal was opened.
+    """
+    def __init__(self, directory, fsync_interval=0.01, snapshot_every=100000):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.snapshot_every = snapshot_every
+        self.records_since_snapshot = 0
+        self.snapshot_error = None
+        self.write_error = None
+        self.write_failures = 0
+        self.snapshot_failures = 0
+
+        # pending_lock guards the pending records and snapshots, io_lock guards the segment file
+        self.pending = []
+        self.pending_lock = threading.Lock()
+        self.io_lock = threading.Lock()
+        # size is how much of the segment was fsynced, anything after it is the unfinished part of a failed write
+        self.segment = None
+        self.file = None
+        self.size = 0
+        self.stopped = threading.Event()
+        self.writer = None
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f"journal.{segment}.log")
+
+    def segments(self):
+        """Returns the numbers of the journal segments on disk, in order."""
+        numbers = []
+        for name in os.listdir(self.directory):
+            parts = name.split(".")
+            if len(parts) == 3 and parts[0] == "journal" and parts[2] == "log" and parts[1].isdigit():
+                numbers.append(int(parts[1]))
+        return sorted(numbers)
+
+    def load(self):
+        """
+        Reads back what is stored on disk.
+
+        Returns
+        -------
+        tuple
+            The latest snapshot (or None if there is none), and a generator over the journal records written
+            after it, in order
+        """
+        snapshot = None
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+        first_segment = snapshot["segment"] if snapshot else 0
+        return snapshot, self.replay([n for n in self.segments() if n >= first_segment])
+
+    def replay(self, segments):
+        for segment in segments:
+            with open(self.segment_path(segment), encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A torn write at the end of a segment from a crash, nothing after it was committed
+                        break
+                    self.records_since_snapshot += 1
+                    yield record
+
+    def open(self):
+        """Starts a new journal segment after the existing ones and starts the writer thread."""
+        self.segment = max(self.segments(), default=-1) + 1
+        self.file = open(self.segment_path(self.segment), "ab")
+        self.size = 0
+        self.writer = threading.Thread(target=self.run_writer, daemon=True)
+        self.writer.start()
+
+    def append(self, record):
+        """Queues a record to be written and fsynced by the writer thread."""
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self.pending_lock:
+            self.pending.append(line)
+        self.records_since_snapshot += 1
+
+    def needs_snapshot(self):
+        return self.records_since_snapshot >= self.snapshot_every
+
+    def run_writer(self):
+        while not self.stopped.wait(self.fsync_interval):
+            self.commit()
+
+    def commit(self):
+        """
+        Writes and fsyncs every pending record with a single fsync, and writes the pending snapshots in between.
+        If writing fails, the records that were not written stay pending, in order, for the next pass.
+        """
+        with self.io_lock:
+            with self.pending_lock:
+                pending, self.pending = self.pending, []
+            lines = []
+            for i, item in enumerate(pending):
+                if isinstance(item, str):
+                    lines.append(item)
+                    continue
+                # The records before the snapshot go to the segment it covers
+                if not self.write_lines(lines, pending[i:]):
+                    return
+                lines = []
+                try:
+                    self.switch_segment(item())
+                except Exception as e:
+                    self.snapshot_error = e
+                    self.snapshot_failures += 1
+                    log.error("snapshot_failed", directory=self.directory, error=repr(e))
+            self.write_lines(lines, [])
+
+    def write_lines(self, lines, unwritten):
+        """
+        Writes and fsyncs records to the current segment.
+
+        Parameters
+        ----------
+        lines: list
+            The records to write
+        unwritten: list
+            The pending records and snapshots that come after them
+
+        Returns
+        -------
+        bool
+            True if the records reached the disk. Otherwise they and the unwritten items are put back at the head
+            of the pending list, and the next pass writes them again.
+        """
+        try:
+            if self.file is None:
+                # The last write failed, so drop whatever part of it reached the segment before writing it again
+                self.file = open(self.segment_path(self.segment), "ab")
+                self.file.truncate(self.size)
+            if lines:
+                self.file.write("".join(lines).encode("utf-8"))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.size = os.fstat(self.file.fileno()).st_size
+        except OSError as e:
+            self.write_error = e
+            self.write_failures += 1
+            log.error("journal_write_failed", segment=self.segment, records=len(lines), error=repr(e))
+            self.close_segment()
+            with self.pending_lock:
+                self.pending[:0] = lines + unwritten
+            return False
+        self.write_error = None
+        return True
+
+    def close_segment(self):
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError:
+                # Whatever did not reach the segment is written again, after the part that did is cut off
+                pass
+            self.file = None
+
+    def start_snapshot(self, build_state):
+        """
+        Has the writer thread write a snapshot of the store and start a new journal segment, without waiting for it.
+
+        Parameters
+        ----------
+        build_state: function
+            Called on the writer thread, it returns the compact state of the store. The state must reflect every
+            record appended before this call, and none appended after it.
+        """
+        with self.pending_lock:
+            self.pending.append(build_state)
+        self.records_since_snapshot = 0
+
+    def write_snapshot(self, state):
+        """
+        Writes a snapshot of the store and starts a new journal segment, waiting until it is done.
+
+        Parameters
+        ----------
+        state: dict
+            The compact state of the store. It must reflect every record appended so far.
+        """
+        self.start_snapshot(lambda: state)
+        self.commit()
+
+    def switch_segment(self, state):
+        """
+        Writes a snapshot of the store and starts a new journal segment, once every record the snapshot covers
+        was written.
+
+        Parameters
+        ----------
+        state: dict
+            The compact state of the store
+
+        Notes
+        -----
+        The snapshot is written to a temporary file and renamed into place, so a crash never leaves a
+        half-written snapshot. Segments covered by the snapshot are deleted afterwards. If the snapshot cannot be
+        written, the covered segments stay and are replayed from the previous snapshot.
+        """
+        next_file = open(self.segment_path(self.segment + 1), "ab")
+        self.close_segment()
+        covered = self.segment
+        self.segment += 1
+        self.file = next_file
+        self.size = 0
+
+        state["segment"] = self.segment
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(state, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+        for segment in self.segments():
+            if segment <= covered:
+                os.remove(self.segment_path(segment))
+
+    def get_stats(self):
+        """
+        Reports how far behind the writer thread is.
+
+        Returns
+        -------
+        dict
+            journal_pending: records and snapshots waiting to be written
+            journal_write_failures, journal_snapshot_failures: passes that could not write the journal, and
+            snapshots that could not be written
+        """
+        return {
+            "journal_pending": len(self.pending),
+            "journal_write_failures": self.write_failures,
+            "journal_snapshot_failures": self.snapshot_failures,
+        }
+
+    def close(self):
+        """Stops the writer thread and commits whatever is still pending."""
+        self.stopped.set()
+        if self.writer is not None:
+            self.writer.join()
+        if self.file is not None:
+            self.commit()
+            self.close_segment()
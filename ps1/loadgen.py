@@ -0,0 +1,408 @@
+"""
+Load generator for the ps1 server.
+
+Opens many client connections from several worker processes, each of which drives its share of the
+connections from one asyncio event loop, and has them send a mix of CR, LI, SE and RE requests for a fixed
+duration. Two modes are supported:
+- closed loop (default): every connection sends its next request as soon as the reply to its last one
+  arrives, which finds the most requests per second the server can answer
+- fixed rate (--rate): requests go out on a fixed schedule whatever the server does, and each latency is
+  measured from the time the request was due to be sent. A server that falls behind shows up as higher
+  latency instead of quietly lowering the rate.
+
+Latencies go into HDR-style histograms, which keep the same relative precision from microseconds to minutes
+in a few thousand counters and can be merged across processes before the percentiles are read off.
+
+Example:
+    python loadgen.py --connections 2000 --processes 4 --mix SE=70,RE=20,LI=5,CR=5 --duration 10
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import time
+from collections import deque
+
+from dotenv import load_dotenv
+
+from framing import extract_frames
+import wire_v2
+import transport
+
+load_dotenv()
+
+TIMESTAMP = "2025-02-14-00:00:00"
+REQUEST_TYPES = ("CR", "LI", "SE", "RE")
+# Frames the server sends on its own, which are not replies to a request
+PUSH_OPCODES = ("SEL", "ACA", "ACD")
+# Most connections a worker sets up at the same time, to stay within the server's listen backlog
+SETUP_CONCURRENCY = 200
+# Seconds to wait on the other workers, beyond the length of the run, before giving up on them
+WORKER_TIMEOUT = 300
+
+class LatencyHistogram:
+    """
+    HDR-style histogram of latencies in nanoseconds.
+
+    Values below 2**precision_bits are counted exactly. Larger values are grouped by their power of two, and
+    each power of two is split into 2**(precision_bits - 1) equal sub-buckets, so every value is known to
+    within 1 / 2**(precision_bits - 1) of itself (under 1% with the default of 8 bits).
+
+    Attributes:
+    - counts (list): The count of each bucket, grown as larger values are recorded.
+    - count (int): Number of recorded values.
+    - total (int): Sum of the recorded values.
+    - min, max (int): Smallest and largest recorded value.
+    """
+    def __init__(self, precision_bits=8):
+        self.precision_bits = precision_bits
+        self.half = 1 << (precision_bits - 1)
+        self.counts = []
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def bucket(self, value):
+        shift = value.bit_length() - self.precision_bits
+        if shift <= 0:
+            return value
+        return shift * self.half + (value >> shift)
+
+    def highest_equivalent(self, bucket):
+        """Returns the largest value counted in a bucket."""
+        if bucket < 2 * self.half:
+            return bucket
+        shift = bucket // self.half - 1
+        return ((bucket - shift * self.half + 1) << shift) - 1
+
+    def record(self, value):
+        value = max(int(value), 0)
+        bucket = self.bucket(value)
+        if bucket >= len(self.counts):
+            self.counts.extend([0] * (bucket + 1 - len(self.counts)))
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Adds the counts of another histogram with the same precision_bits to this one."""
+        if len(other.counts) > len(self.counts):
+            self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+        for bucket, bucket_count in enumerate(other.counts):
+            self.counts[bucket] += bucket_count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def percentile(self, pct):
+        """Returns the value that pct percent of the recorded values are at or below, to the histogram's precision."""
+        if self.count == 0:
+            return 0
+        target = max(1, round(self.count * pct / 100))
+        seen = 0
+        for bucket, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= target:
+                return min(self.highest_equivalent(bucket), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+def parse_mix(spec):
+    """Parses a mix such as "SE=70,RE=20,LI=5,CR=5" into a list of (request type, weight) pairs."""
+    mix = []
+    for item in spec.split(","):
+        request_type, weight = item.split("=")
+        request_type = request_type.strip().upper()
+        if request_type not in REQUEST_TYPES:
+            raise ValueError(f"unknown request type {request_type}, expected one of {', '.join(REQUEST_TYPES)}")
+        mix.append((request_type, float(weight)))
+    return mix
+
+def encode_request(codec, body):
+    """Encodes a request given in the wp text form in the codec "wp", "json" or "v2"."""
+    if codec == "v2":
+        opcode, fields = wire_v2.v1_request_fields(body)
+        return wire_v2.encode_frame(opcode, 1, fields)
+    if codec == "json":
+        opcode, fields = wire_v2.v1_request_fields(body)
+        body = json.dumps(dict(zip(wire_v2.REQUEST_FIELDS[opcode], fields), type=opcode))
+    return (str(len(body)) + body).encode("utf-8")
+
+def decode_replies(codec, buf):
+    """
+    Pulls every complete frame out of a receive buffer, and returns whether each reply succeeded. Pushes
+    from the server are left out.
+    """
+    replies = []
+    if codec == "v2":
+        for opcode, request_id, fields in wire_v2.extract_frames(buf):
+            if opcode not in PUSH_OPCODES:
+                replies.append(opcode[:2] != "ER")
+    elif codec == "json":
+        for frame in extract_frames(buf):
+            reply = json.loads(frame)
+            if reply.get("type") not in PUSH_OPCODES:
+                replies.append(not reply.get("errorMsg"))
+    else:
+        for frame in extract_frames(buf):
+            if frame[:3] not in PUSH_OPCODES:
+                replies.append(frame[:2] != "ER")
+    return replies
+
+class LoadConnection:
+    """
+    One client connection of the load generator, which may have several requests in flight.
+    """
+    def __init__(self, reader, writer, codec):
+        self.reader = reader
+        self.writer = writer
+        self.codec = codec
+        self.inb = bytearray()
+        self.replies = deque()
+
+    async def send(self, body):
+        self.writer.write(encode_request(self.codec, body))
+        await self.writer.drain()
+
+    async def next_reply(self):
+        """Waits for the reply to the oldest request in flight, and returns whether it succeeded."""
+        while not self.replies:
+            chunk = await self.reader.read(65536)
+            if not chunk:
+                raise ConnectionError("server closed the connection")
+            self.inb += chunk
+            self.replies.extend(decode_replies(self.codec, self.inb))
+        return self.replies.popleft()
+
+    async def request(self, body):
+        await self.send(body)
+        return await self.next_reply()
+
+    def close(self):
+        self.writer.close()
+
+class WorkerStats:
+    """Latency histograms and error counts of one worker, per request type and in total."""
+    def __init__(self):
+        self.histograms = {request_type: LatencyHistogram() for request_type in REQUEST_TYPES}
+        self.errors = {request_type: 0 for request_type in REQUEST_TYPES}
+        self.failed_connections = 0
+
+    def record(self, request_type, latency_ns, success):
+        self.histograms[request_type].record(latency_ns)
+        if not success:
+            self.errors[request_type] += 1
+
+    def merge(self, other):
+        for request_type in REQUEST_TYPES:
+            self.histograms[request_type].merge(other.histograms[request_type])
+            self.errors[request_type] += other.errors[request_type]
+        self.failed_connections += other.failed_connections
+
+class RequestMaker:
+    """Builds the requests of one connection, drawing their types from the mix."""
+    def __init__(self, config, username, rng):
+        self.config = config
+        self.username = username
+        self.rng = rng
+        self.types = [request_type for request_type, weight in config["mix"]]
+        self.weights = [weight for request_type, weight in config["mix"]]
+        self.message = "x" * config["message_size"]
+        self.created = 0
+
+    def next(self):
+        request_type = self.rng.choices(self.types, self.weights)[0]
+        if request_type == "CR":
+            self.created += 1
+            return request_type, f"CR{self.username}_{self.created} pass"
+        if request_type == "LI":
+            return request_type, f"LI{self.username} pass"
+        if request_type == "SE":
+            to_username = self.rng.choice(self.config["usernames"])
+            return request_type, f"SE{self.username} {to_username} {TIMESTAMP} {self.message}"
+        return request_type, f"RE{self.username} {self.config['read_count']}"
+
+async def open_connection(config, username, setup_limit):
+    """Connects, switches to the configured codec, and creates and logs in to the connection's account."""
+    async with setup_limit:
+        reader, writer = await transport.open_connection(config["host"], config["port"])
+        conn = LoadConnection(reader, writer, "wp")
+        if config["codec"] == "v2":
+            await conn.send("VE2")
+            if not await conn.next_reply():
+                raise ConnectionError("server does not speak wire protocol version 2")
+        conn.codec = config["codec"]
+        # The account may be left over from an earlier run, in which case logging in is enough
+        await conn.request(f"CR{username} pass")
+        if not await conn.request(f"LI{username} pass"):
+            raise ConnectionError(f"could not log in as {username}")
+        return conn
+
+async def run_closed_loop(conn, maker, stats, deadline_ns):
+    while time.perf_counter_ns() < deadline_ns:
+        request_type, body = maker.next()
+        start_ns = time.perf_counter_ns()
+        success = await conn.request(body)
+        stats.record(request_type, time.perf_counter_ns() - start_ns, success)
+
+async def run_fixed_rate(conn, maker, stats, start_ns, deadline_ns, interval_ns):
+    in_flight = deque()
+    sending = True
+
+    async def send_on_schedule():
+        nonlocal sending
+        # Spread the connections' schedules out instead of having them all send at once
+        due_ns = start_ns + int(maker.rng.random() * interval_ns)
+        while due_ns < deadline_ns:
+            wait_ns = due_ns - time.perf_counter_ns()
+            if wait_ns > 0:
+                await asyncio.sleep(wait_ns / 1e9)
+            request_type, body = maker.next()
+            in_flight.append((request_type, due_ns))
+            await conn.send(body)
+            due_ns += interval_ns
+        sending = False
+
+    async def receive():
+        while sending or in_flight:
+            if not in_flight:
+                await asyncio.sleep(interval_ns / 1e9)
+                continue
+            success = await conn.next_reply()
+            request_type, due_ns = in_flight.popleft()
+            # Measured from when the request was due, so time spent queued behind a slow server counts
+            stats.record(request_type, time.perf_counter_ns() - due_ns, success)
+
+    await asyncio.gather(send_on_schedule(), receive())
+
+async def drive_connections(worker_id, config, start_barrier):
+    stats = WorkerStats()
+    setup_limit = asyncio.Semaphore(SETUP_CONCURRENCY)
+    usernames = [f"{config['prefix']}{worker_id}_{i}" for i in range(config["connections"][worker_id])]
+    results = await asyncio.gather(*(open_connection(config, username, setup_limit) for username in usernames), return_exceptions=True)
+    connections = []
+    for username, result in zip(usernames, results):
+        if isinstance(result, BaseException):
+            stats.failed_connections += 1
+        else:
+            connections.append((username, result))
+
+    # Every worker starts sending at the same time, once all connections are set up
+    await asyncio.get_running_loop().run_in_executor(None, start_barrier.wait, WORKER_TIMEOUT)
+    start_ns = time.perf_counter_ns()
+    deadline_ns = start_ns + int(config["duration"] * 1e9)
+    tasks = []
+    for username, conn in connections:
+        maker = RequestMaker(config, username, random.Random(f"{username}-{config['seed']}"))
+        if config["rate"]:
+            interval_ns = int(1e9 * sum(config["connections"]) / config["rate"])
+            tasks.append(run_fixed_rate(conn, maker, stats, start_ns, deadline_ns, interval_ns))
+        else:
+            tasks.append(run_closed_loop(conn, maker, stats, deadline_ns))
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    stats.failed_connections += sum(isinstance(result, BaseException) for result in results)
+    elapsed = (time.perf_counter_ns() - start_ns) / 1e9
+    for username, conn in connections:
+        conn.close()
+    return stats, elapsed
+
+def raise_fd_limit():
+    """Raises this process's open file limit as far as it is allowed to go, since every connection needs one."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+def run_worker(worker_id, config, start_barrier, results):
+    raise_fd_limit()
+    results.put((worker_id, *asyncio.run(drive_connections(worker_id, config, start_barrier))))
+
+def run_load(config):
+    """
+    Runs the load in config["processes"] worker processes and returns the merged WorkerStats and the seconds
+    the workers spent sending.
+    """
+    processes = config["processes"]
+    # Spread the connections over the workers as evenly as possible
+    config["connections"] = [config["total_connections"] // processes + (i < config["total_connections"] % processes) for i in range(processes)]
+    config["usernames"] = [f"{config['prefix']}{worker_id}_{i}" for worker_id in range(processes) for i in range(config["connections"][worker_id])]
+    start_barrier = multiprocessing.Barrier(processes)
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=run_worker, args=(i, config, start_barrier, results)) for i in range(processes)]
+    for worker in workers:
+        worker.start()
+    stats = WorkerStats()
+    elapsed = 0.0
+    for _ in workers:
+        worker_id, worker_stats, worker_elapsed = results.get(timeout=config["duration"] + WORKER_TIMEOUT)
+        stats.merge(worker_stats)
+        elapsed = max(elapsed, worker_elapsed)
+    for worker in workers:
+        worker.join()
+    return stats, elapsed
+
+def print_report(config, stats, elapsed):
+    mode = f"fixed rate of {config['rate']:.0f} req/s" if config["rate"] else "closed loop"
+    print(f"\n===== LOAD GENERATOR RESULTS =====")
+    print(f"{config['total_connections']} {config['codec']} connections from {config['processes']} processes, {mode}, {elapsed:.1f} s")
+    if stats.failed_connections:
+        print(f"{stats.failed_connections} connections failed")
+    print(f"{'Type':<6} {'Count':<10} {'Errors':<8} {'Req/s':<10} {'Mean (ms)':<10} {'p50 (ms)':<10} {'p90 (ms)':<10} "
+          f"{'p99 (ms)':<10} {'p99.9 (ms)':<11} {'Max (ms)':<10}")
+    print("-" * 100)
+    total = LatencyHistogram()
+    rows = []
+    for request_type in REQUEST_TYPES:
+        histogram = stats.histograms[request_type]
+        if histogram.count:
+            rows.append((request_type, histogram, stats.errors[request_type]))
+            total.merge(histogram)
+    rows.append(("all", total, sum(stats.errors.values())))
+    for name, histogram, errors in rows:
+        print(f"{name:<6} {histogram.count:<10} {errors:<8} {histogram.count / elapsed:<10.0f} {histogram.mean() / 1e6:<10.3f} "
+              f"{histogram.percentile(50) / 1e6:<10.3f} {histogram.percentile(90) / 1e6:<10.3f} "
+              f"{histogram.percentile(99) / 1e6:<10.3f} {histogram.percentile(99.9) / 1e6:<11.3f} {histogram.max / 1e6:<10.3f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drive the ps1 server with many concurrent connections")
+    parser.add_argument("--host", default=os.environ.get("HOST_SERVER", "127.0.0.1"), help="Server address, or unix: and the path of the server's Unix domain socket")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT_SERVER", 54400)), help="Server port")
+    parser.add_argument("--codec", default="wp", choices=["wp", "json", "v2"], help="Codec every connection speaks")
+    parser.add_argument("--connections", type=int, default=1000, help="Total client connections")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="Worker processes to spread the connections over")
+    parser.add_argument("--mix", default="SE=70,RE=20,LI=5,CR=5", help="Request types and their relative weights")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to send requests for")
+    parser.add_argument("--rate", type=float, default=0, help="Total requests per second in fixed rate mode (0 for closed loop)")
+    parser.add_argument("--message-size", type=int, default=32, help="Characters in every SE message")
+    parser.add_argument("--read-count", type=int, default=10, help="Messages asked for by every RE request")
+    parser.add_argument("--prefix", default=f"lg{os.getpid()}_", help="Prefix of the accounts the load generator creates")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the request mix")
+    args = parser.parse_args()
+
+    config = {
+        "host": args.host,
+        "port": args.port,
+        "codec": args.codec,
+        "total_connections": args.connections,
+        "processes": max(1, min(args.processes, args.connections)),
+        "mix": parse_mix(args.mix),
+        "duration": args.duration,
+        "rate": args.rate,
+        "message_size": args.message_size,
+        "read_count": args.read_count,
+        "prefix": args.prefix,
+        "seed": args.seed,
+    }
+    stats, elapsed = run_load(config)
+    print_report(config, stats, elapsed)
@@ -0,0 +1,220 @@
+# Compact records for stored messages
+#
+# The server keeps every message a user has received until it is deleted, so the fixed cost of each stored
+# message adds up. A Message keeps its fields in __slots__ instead of a dict of its own, and the sender's
+# username is interned, so all the messages from one user share a single string instead of each holding the
+# copy that was parsed out of its request.
+#
+# A user who stays logged out can pile up far more undelivered messages than are worth keeping in memory. A
+# SpillFile holds the newer part of such a backlog on disk, one json line per message, and hands the messages
+# back oldest first when the user reads them. Only the message ids stay in memory, 8 bytes each. The file stays
+# open for appending while it holds messages, so queueing a message to it costs a buffered write, not an open and
+# a close.
+
+import json
+import os
+import sys
+import tracemalloc
+from array import array
+from bisect import bisect_left
+
+class Message:
+    """
+    A stored message.
+
+    Attributes:
+    - message_id (int): Unique across the server, in the order messages were sent.
+    - sender (str): The username of the account that sent the message, interned.
+    - timestamp (str): The time the sender gave for the message.
+    - body (bytes): The message text in utf-8, ready to be sent without encoding it again.
+    - length (int): The number of characters in the message text, which version 1 frames count in.
+    - delivered (bool): Whether the message was pushed to the receiver while it was logged in.
+    """
+    __slots__ = ("message_id", "sender", "timestamp", "body", "length", "delivered")
+
+    def __init__(self, message_id, sender, timestamp, message, delivered):
+        self.message_id = message_id
+        self.sender = sys.intern(sender)
+        self.timestamp = timestamp
+        self.body = message.encode("utf-8")
+        self.length = len(message)
+        self.delivered = delivered
+
+    @property
+    def message(self):
+        """The message text, decoded from body."""
+        return self.body.decode("utf-8")
+
+    def to_dict(self):
+        """Returns the message as json replies carry it, with the keys sender, timestamp, message, messageId and delivered."""
+        return {"sender": self.sender, "timestamp": self.timestamp, "message": self.message, "messageId": self.message_id, "delivered": self.delivered}
+
+    def __repr__(self):
+        return f"Message({self.message_id!r}, {self.sender!r}, {self.timestamp!r}, {self.message!r}, {self.delivered!r})"
+
+class SpillFile:
+    """
+    Undelivered messages of one user, moved out of memory to a file in the order they arrived.
+
+    Attributes:
+    - path (str): The file. It is written on the first append and removed once every message was taken back.
+    - ids (array): The id of every message appended since the file was created, in increasing order.
+    - head (int): Index in ids of the oldest message not yet taken back.
+    - offset (int): Byte offset in the file where that message starts.
+    - deleted (set): Ids of messages deleted while in the file, which are skipped when reading it.
+    - file (file or None): The file open for appending, from the first append until it is removed.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.ids = array("q")
+        self.head = 0
+        self.offset = 0
+        self.deleted = set()
+
+    def __len__(self):
+        return len(self.ids) - self.head - len(self.deleted)
+
+    def __contains__(self, message_id):
+        index = bisect_left(self.ids, message_id, self.head)
+        return index < len(self.ids) and self.ids[index] == message_id and message_id not in self.deleted
+
+    def count_through(self, message_id):
+        """Returns the number of messages in the file up to and including the message with an id, which must be in it."""
+        index = bisect_left(self.ids, message_id, self.head)
+        return index + 1 - self.head - sum(1 for deleted_id in self.deleted if deleted_id < message_id)
+
+    def append(self, message):
+        """Writes an undelivered message to the end of the file. Its id must be larger than any appended before."""
+        if self.file is None:
+            # The first message replaces whatever an earlier server left at the path
+            self.file = open(self.path, "wb")
+        self.file.write(json.dumps([message.message_id, message.sender, message.timestamp, message.message]).encode("utf-8") + b"\n")
+        self.ids.append(message.message_id)
+
+    def freeze(self):
+        """
+        Captures the messages in the file as they are now, for another thread to read with SpillSnapshot.read while
+        messages go on being taken from the file and appended to it.
+
+        Notes
+        -----
+        Lines are only ever appended to the file, and a removed file can still be read through a file object
+        opened before, so the lines the snapshot reads do not change.
+        """
+        self.file.flush()
+        f = open(self.path, "rb")
+        f.seek(self.offset)
+        return SpillSnapshot(f, len(self.ids) - self.head, set(self.deleted))
+
+    def discard(self, message_id):
+        """Deletes a message in the file, which must be in it."""
+        self.deleted.add(message_id)
+
+    def read(self, num=None):
+        """
+        Reads the oldest messages in the file, leaving them in it.
+
+        Parameters
+        ----------
+        num: int or None
+            The most messages to read, or None for all of them
+
+        Returns
+        -------
+        tuple
+            The Messages, and the index in ids and the byte offset just past the last line read
+        """
+        messages = []
+        head = self.head
+        offset = self.offset
+        if head == len(self.ids):
+            return messages, head, offset
+        # Appends are buffered until they are read back
+        self.file.flush()
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            while head < len(self.ids) and (num is None or len(messages) < num):
+                line = f.readline()
+                offset += len(line)
+                head += 1
+                message_id, sender, timestamp, message = json.loads(line)
+                if message_id not in self.deleted:
+                    messages.append(Message(message_id, sender, timestamp, message, False))
+        return messages, head, offset
+
+    def take(self, num):
+        """Removes the oldest num messages from the file, or all of them if it holds fewer, and returns them."""
+        messages, head, offset = self.read(num)
+        for message_id in self.ids[self.head:head]:
+            self.deleted.discard(message_id)
+        self.head = head
+        self.offset = offset
+        if len(self) == 0:
+            self.remove()
+        return messages
+
+    def remove(self):
+        """Drops every message in the file, and closes and removes it."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.ids = array("q")
+        self.head = 0
+        self.offset = 0
+        self.deleted.clear()
+
+class SpillSnapshot:
+    """
+    The messages a SpillFile held when it was frozen, see SpillFile.freeze.
+
+    Attributes:
+    - file (file): The spill file, open at the oldest message.
+    - count (int): The number of lines to read, including the ones of deleted messages.
+    - deleted (set): Ids of the messages that were deleted at the time.
+    """
+    def __init__(self, file, count, deleted):
+        self.file = file
+        self.count = count
+        self.deleted = deleted
+
+    def read(self):
+        """Reads the messages, oldest first, and closes the file."""
+        messages = []
+        with self.file:
+            for _ in range(self.count):
+                message_id, sender, timestamp, message = json.loads(self.file.readline())
+                if message_id not in self.deleted:
+                    messages.append(Message(message_id, sender, timestamp, message, False))
+        return messages
+
+def measure_bytes_per_message(store_message, num_messages=100000):
+    """
+    Measures the memory a server holds per stored message, with tracemalloc.
+
+    Parameters
+    ----------
+    store_message: function
+        Called with a sender, timestamp and message text, it stores one message the way the server does
+    num_messages: int
+        The number of messages to store
+
+    Returns
+    -------
+    float
+        The bytes allocated per message, including its text and the mailbox entries that point at it
+    """
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(num_messages):
+        # Build the strings at run time, the way parsing a request does, so none of them are shared constants
+        sender = "".join(["sen", "der"])
+        store_message(sender, f"2025-02-14-00:{i // 60 % 60:02d}:{i % 60:02d}", f"hello world {i}")
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    if not was_tracing:
+        tracemalloc.stop()
+    return allocated / num_messages
@@ -0,0 +1,132 @@
+# Replies built from byte segments and sent with scatter/gather writes
+#
+# A reply that carries many stored messages, such as the reply to RE, is made of short framing text around the
+# message bodies, which are already stored as utf-8 bytes. ReplyBuilder collects the framing into small
+# segments and keeps a reference to every large body instead of copying it, and OutboundQueue sends a list
+# of segments with one sendmsg call, so the bodies are never copied into a reply or into a send buffer.
+
+import os
+from collections import deque
+from itertools import islice
+
+# Segments shorter than this are copied into the framing around them, since one more entry in a sendmsg call
+# costs more than copying a few bytes
+MIN_SEGMENT = 256
+# Most segments passed to one sendmsg call
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+class ReplyBuilder:
+    """
+    Assembles a frame body from framing and byte segments.
+
+    Attributes:
+    - segments (list): The finished segments of the body, bytes-like.
+    - num_bytes (int): The byte length of the body so far.
+    - num_chars (int): The character length of the body so far, for protocols whose length prefix counts characters.
+    """
+    def __init__(self):
+        self.segments = []
+        self.pending = bytearray()
+        self.num_bytes = 0
+        self.num_chars = 0
+
+    def text(self, text):
+        """Adds framing text."""
+        encoded = text.encode("utf-8")
+        self.pending += encoded
+        self.num_bytes += len(encoded)
+        self.num_chars += len(text)
+
+    def raw(self, data):
+        """Adds binary framing, which counts no characters."""
+        self.pending += data
+        self.num_bytes += len(data)
+
+    def segment(self, data, num_chars=0):
+        """Adds a segment of bytes, such as a stored message body, by reference unless it is short."""
+        if len(data) < MIN_SEGMENT:
+            self.pending += data
+        else:
+            if self.pending:
+                self.segments.append(bytes(self.pending))
+                self.pending.clear()
+            self.segments.append(data)
+        self.num_bytes += len(data)
+        self.num_chars += num_chars
+
+    def finish(self):
+        """Returns the segments of the finished body."""
+        if self.pending:
+            self.segments.append(bytes(self.pending))
+            self.pending.clear()
+        return self.segments
+
+class OutboundQueue:
+    """
+    The bytes waiting to be sent to one connection, as a list of segments.
+
+    Queued segments are referenced, not copied. Sending passes as many of them as the socket takes to a single
+    sendmsg call, and a segment that was only partly sent is kept as a memoryview of its unsent tail.
+    """
+    def __init__(self):
+        self.segments = deque()
+        self.num_bytes = 0
+
+    def __len__(self):
+        return self.num_bytes
+
+    def append(self, payload):
+        """Queues a payload: bytes, or a list of bytes-like segments."""
+        if isinstance(payload, list):
+            for segment in payload:
+                self.append(segment)
+            return
+        if not payload:
+            return
+        if isinstance(payload, bytearray):
+            # The caller may reuse a bytearray, so it is the one thing that is copied
+            payload = bytes(payload)
+        self.segments.append(payload)
+        self.num_bytes += len(payload)
+
+    def send(self, sock):
+        """
+        Sends as much of the queue as the socket takes without blocking.
+
+        Parameters
+        ----------
+        sock: socket
+            A non-blocking socket
+
+        Returns
+        -------
+        int
+            The number of bytes sent
+
+        Raises
+        ------
+        BlockingIOError, InterruptedError, ConnectionError
+            As raised by the socket
+        """
+        if not self.segments:
+            return 0
+        batch = list(islice(self.segments, IOV_MAX))
+        if len(batch) == 1:
+            sent = sock.send(batch[0])
+        elif hasattr(sock, "sendmsg"):
+            sent = sock.sendmsg(batch)
+        else:
+            sent = sock.send(b"".join(batch))
+        self.consume(sent)
+        return sent
+
+    def consume(self, num_bytes):
+        """Drops the first num_bytes bytes of the queue, which were sent."""
+        self.num_bytes -= num_bytes
+        while num_bytes and num_bytes >= len(self.segments[0]):
+            num_bytes -= len(self.segments.popleft())
+        if num_bytes:
+            self.segments[0] = memoryview(self.segments[0])[num_bytes:]
@@ -6,14 +6,150 @@ import types
 import os
 from dotenv import load_dotenv
 import json
+import asyncio
+import time
+import sys
+import hashlib
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice, count
+from collections import OrderedDict, deque, namedtuple
+from bisect import bisect_left, bisect_right, insort
+import wire_v2
+from framing import extract_frames
+import compression
+from journal import Journal
+import eventlog
+from timerwheel import TimerWheel
+from messagestore import Message, SpillFile
+import dispatcher
+from outbound import OutboundQueue, ReplyBuilder
+import shards
+import transport
 
 sel = selectors.DefaultSelector()
 
 load_dotenv()
 
-# Global variables that keep track of user accounts and unique message ids, respectively
+log = eventlog.get_logger("ps1.server")
+
+# "interest" only watches a client for writes while it has bytes queued to send, "legacy" always watches
+# for both reads and writes, which makes the select loop busy-poll since sockets are almost always writable
+SELECTOR_MODE = os.environ.get("SELECTOR_MODE", "interest")
+
+# Serving engine ("selector" or "asyncio") picked at startup
+SERVER_ENGINE = os.environ.get("SERVER_ENGINE", "selector")
+# Threads that carry out requests on the selector engine. With 0 the select loop carries out every request
+# itself. With more, the loop only accepts, reads and writes, and hands each request to a pool of this many
+# threads, which queue the reply on the connection when it is done. A connection has at most one request in
+# the pool at a time, so its replies keep the order of its requests.
+REQUEST_THREADS = int(os.environ.get("REQUEST_THREADS", 0))
+# Held while changing server state, by the select loop while it services events and by a pool thread while it
+# carries out a request. The threads gain the time the others spend outside it: decoding and encoding frames
+# and compressing replies, which zlib does without holding the GIL.
+state_lock = threading.RLock()
+# The pool of REQUEST_THREADS threads, and the socket a pool thread wakes the select loop with
+request_pool = None
+wakeup_writer = None
+# Codecs a connection can speak: "json", "wp" (the custom wire protocol) and "v2" (version 2 of the custom wire
+# protocol, a binary encoding, see wire_v2.py), listed in CODECS. A connection starts out in SERVER_PROTOCOL and
+# switches codec per frame: a length-prefixed frame whose body is a json object is json, any other length-prefixed
+# frame is wp, and a VE2 request switches to v2. This way one server serves clients of every codec.
+SERVER_PROTOCOL = os.environ.get("SERVER_PROTOCOL", "wp")
+# Pending connection backlog of the listening socket
+LISTEN_BACKLOG = int(os.environ.get("LISTEN_BACKLOG", 1024))
+# Path of a Unix domain socket to listen on besides the TCP port, for clients on the same host, which connect to
+# the address "unix:<path>" (see transport.py). Unset only listens on TCP.
+UNIX_SOCKET = os.environ.get("UNIX_SOCKET")
+# The listening socket at UNIX_SOCKET, and the process that made it, which removes it when the server stops
+unix_listener = None
+unix_listener_pid = None
+
+# Most bytes that may sit in one connection's outbound queue. A client that lets its queue fill up is a
+# slow consumer: live pushes to it are dropped and the message is left undelivered ("drop"), or it is
+# disconnected ("disconnect"). A client that stops reading its own replies is simply not read from
+# until its queue drains.
+MAX_OUTBOUND_BYTES = int(os.environ.get("MAX_OUTBOUND_BYTES", 1024 * 1024))
+SLOW_CONSUMER_POLICY = os.environ.get("SLOW_CONSUMER_POLICY", "drop")
+
+# Connection limits. A client that sends nothing for IDLE_TIMEOUT seconds is disconnected (0 never times out),
+# which is checked on a timer wheel that ticks every TIMER_TICK seconds. Connections past MAX_CONNECTIONS are
+# closed as soon as they are accepted, and a client whose unfinished request grows past MAX_INBOUND_BYTES is
+# disconnected.
+IDLE_TIMEOUT = float(os.environ.get("IDLE_TIMEOUT", 0))
+TIMER_TICK = float(os.environ.get("TIMER_TICK", 1.0))
+MAX_CONNECTIONS = int(os.environ.get("MAX_CONNECTIONS", 10000))
+MAX_INBOUND_BYTES = int(os.environ.get("MAX_INBOUND_BYTES", 16 * 1024 * 1024))
+connection_stats = {"idle_disconnects": 0, "rejected_connections": 0, "inbound_overflow_disconnects": 0}
+# Idle checks of the connected clients, one (connection, per-connection state) timer per client
+idle_timers = TimerWheel(TIMER_TICK, now=time.monotonic())
+
+# Counters for the outbound queues, see get_outbound_stats
+outbound_stats = {"peak_queue_bytes": 0, "dropped_pushes": 0, "slow_consumer_disconnects": 0}
+# Request types the server answers. Requests of any other type are counted together as "other".
+REQUEST_TYPES = ("CR", "LI", "LO", "LA", "LS", "SU", "SE", "SB", "SM", "RE", "DM", "DA", "VE", "CM", "ST")
+# Number of buckets in each latency histogram. Bucket i counts requests that took less than 2**i
+# nanoseconds, and the last bucket also counts everything slower.
+LATENCY_BUCKETS = 40
+# Counters and latency histograms of each request type, and bytes read from and queued to clients,
+# see get_server_stats
+request_stats = {}
+traffic_stats = {"bytes_in": 0, "bytes_out": 0}
+# Per-connection state of the clients connected to the asyncio engine, keyed by their StreamWriter
+async_connections = {}
+
+# Connections subscribed to account directory changes, and the version of the directory, which goes up by
+# one with every account created or deleted
+directory_subscribers = set()
+directory_version = 0
+
+# Versions of the custom wire protocol a connection can negotiate with a VE request
+SUPPORTED_WIRE_VERSIONS = ("1", "2")
+
+# Compression a connection can negotiate with a CM request (an empty COMPRESSION turns it off). Frames with
+# bodies of at least COMPRESSION_THRESHOLD bytes are compressed at COMPRESSION_LEVEL, and a compressed frame
+# from a client may expand to at most MAX_DECOMPRESSED_BYTES.
+SUPPORTED_COMPRESSION = tuple(codec for codec in os.environ.get("COMPRESSION", compression.CODEC).split(",") if codec)
+COMPRESSION_THRESHOLD = int(os.environ.get("COMPRESSION_THRESHOLD", 1024))
+COMPRESSION_LEVEL = int(os.environ.get("COMPRESSION_LEVEL", 6))
+MAX_DECOMPRESSED_BYTES = int(os.environ.get("MAX_DECOMPRESSED_BYTES", 16 * 1024 * 1024))
+
+# Directory of the durable journal and snapshots. When unset, the account store only lives in memory.
+JOURNAL_DIR = os.environ.get("JOURNAL_DIR")
+# Seconds between journal fsyncs, which bounds how much can be lost in a crash
+JOURNAL_FSYNC_INTERVAL = float(os.environ.get("JOURNAL_FSYNC_INTERVAL", 0.01))
+# Journal records written between snapshots
+JOURNAL_SNAPSHOT_EVERY = int(os.environ.get("JOURNAL_SNAPSHOT_EVERY", 100000))
+
+# Mailbox retention. Delivered messages past the newest RETAIN_DELIVERED of one user or the newest
+# RETAIN_DELIVERED_TOTAL of all users, or older than RETAIN_SECONDS, are dropped (0 turns each limit off). The age
+# limit is checked every TIMER_TICK seconds. Undelivered messages are never dropped: a user's undelivered messages
+# past the oldest SPILL_AFTER are written to a file in SPILL_DIR instead of kept in memory, and are read back in
+# order as RE asks for them (0 or no SPILL_DIR keeps them all in memory).
+RETAIN_DELIVERED = int(os.environ.get("RETAIN_DELIVERED", 0))
+RETAIN_DELIVERED_TOTAL = int(os.environ.get("RETAIN_DELIVERED_TOTAL", 0))
+RETAIN_SECONDS = float(os.environ.get("RETAIN_SECONDS", 0))
+SPILL_DIR = os.environ.get("SPILL_DIR")
+SPILL_AFTER = int(os.environ.get("SPILL_AFTER", 0))
+# Undelivered messages in each chunk of the backlog a client can ask to be sent when it logs in, see stream_backlog
+BACKLOG_CHUNK = int(os.environ.get("BACKLOG_CHUNK", 100))
+mailbox_stats = {"trimmed_messages": 0, "spilled_messages": 0, "unspilled_messages": 0, "backlog_messages": 0}
+# Delivered messages of every user in the order they arrived, for RETAIN_DELIVERED_TOTAL and RETAIN_SECONDS:
+# maps messageId to (arrival time, username)
+delivered_order = OrderedDict()
+
+# Most account names returned in one page of an LS listing
+MAX_ACCOUNT_PAGE = int(os.environ.get("MAX_ACCOUNT_PAGE", 100))
+
+# Global variables that keep track of user accounts and unique message ids, respectively. With several
+# workers, accounts only holds the accounts this worker owns, and message ids are messageId * WORKERS + INDEX.
 accounts = {}
 messageId = 0
+# Every username in sorted order, for prefix searches, including the accounts owned by other workers
+account_index = []
+# The open Journal when JOURNAL_DIR is set
+journal = None
 
 # HELPERS FOR SERVER ACTIONS
 def create_account(username, password):
@@ -33,9 +169,13 @@ def create_account(username, password):
         list[0] is True or False, and indicates if the account was created successfully
         list[1] is an empty string on success and an error message on failure
     """
-    print("Trying to create account for ", username)
+    log.info("create_account", username=username)
     if username not in accounts:
-        accounts[username] = {"socket": None, "loggedIn": False, "accountInfo": {"username": username, "password": password}, "messageHistory": []}
+        # Interned, so the account and every message it sends share one copy of the name
+        username = sys.intern(username)
+        accounts[username] = new_account(username, password)
+        record_mutation(["CR", username, password])
+        change_directory("ACA", username)
         return [True, ""]
     else:
         # error: account is already in the database
@@ -51,8 +191,9 @@ def login(username, password, sock):
         The inputted username of the account
     password : str
         The inputted password of the account
-    sock : socket
-        The socket the user is sending the request to log in from
+    sock : socket or shards.RemoteConnection
+        The socket the user is sending the request to log in from, which is held by another worker when
+        this one owns the account but the connection was accepted by that worker
 
     Returns
     -------
@@ -65,7 +206,7 @@ def login(username, password, sock):
     Attempting to login to the same account twice does not produce an error.
     The second login attempt will return success, and the user will remain logged in.
     """
-    print("Trying to login ", username)
+    log.info("login", username=username)
     if username not in accounts:
         # error: account with that username does not exist
         return [False, "ER1: account with that username does not exist"]
@@ -100,7 +241,7 @@ def logout(username):
     Attempting to logout of the same account twice does not produce an error.
     The second logout attempt will return success, and the user will remain logged out.
     """
-    print("Trying to logout ", username)
+    log.info("logout", username=username)
     if username not in accounts:
         # error: account with that username does not exist
         return [False, "ER1: account with that username does not exist"]
@@ -125,10 +266,74 @@ def list_accounts():
         list[0] is always True. This function cannot fail.
         list[1] is a list of all account names stored by the server.
     """
-    # Simply return all the accounts, searching for a subset is done on client-side
-    accountNames = list(accounts.keys())
+    # Simply return all the accounts, searching for a subset is done on client-side. The index lists every
+    # account, including the ones other workers own.
+    accountNames = list(account_index)
     return [True, accountNames]
 
+def subscribe_directory(sock):
+    """
+    Subscribes a connection to changes of the account directory.
+
+    Parameters
+    ----------
+    sock: socket or asyncio.StreamWriter
+        The connection to push changes to, in whichever codec it speaks at the time
+
+    Returns
+    -------
+    list
+        list[0] is always True. This function cannot fail.
+        list[1] is a dictionary with the keys accounts, every account name, and version, the directory
+        version those names are current as of.
+
+    Notes
+    -----
+    After subscribing, the connection gets an ACA push whenever an account is created and an ACD push
+    whenever one is deleted, each carrying the new directory version. Subscribing again returns a fresh
+    copy of the directory, which a client does when it sees a gap in the versions it was pushed.
+    """
+    directory_subscribers.add(sock)
+    return [True, {"accounts": list(account_index), "version": directory_version}]
+
+def search_accounts(prefix, cursor, limit):
+    """
+    Lists one page of the usernames that start with a prefix, in sorted order.
+
+    Parameters
+    ----------
+    prefix: str
+        The prefix to search for. The empty prefix matches every account.
+    cursor: str
+        The cursor returned with the previous page, or the empty string for the first page
+    limit:
+        The most usernames to return, capped at MAX_ACCOUNT_PAGE
+
+    Returns
+    -------
+    list
+        list[0] is always True. This function cannot fail.
+        list[1] is a dictionary with the keys accounts, the usernames on this page, and cursor, which is
+        passed back to get the next page and is the empty string when there are no more pages.
+
+    Notes
+    -----
+    The cursor is the last username of the page, so pages stay consistent when accounts are created or
+    deleted between requests.
+    """
+    limit = max(0, min(int(limit), MAX_ACCOUNT_PAGE))
+    start = bisect_left(account_index, prefix)
+    if cursor:
+        start = max(start, bisect_right(account_index, cursor))
+    page = []
+    for username in islice(account_index, start, None):
+        if not username.startswith(prefix):
+            break
+        if len(page) == limit:
+            return [True, {"accounts": page, "cursor": page[-1] if page else ""}]
+        page.append(username)
+    return [True, {"accounts": page, "cursor": ""}]
+
 
 def send_message(from_username, to_username, message, time):
     """
@@ -149,27 +354,44 @@ def send_message(from_username, to_username, message, time):
     Returns
     -------
     list
-        list[0] is always True. This function cannot fail.
-        list[1] is dictionary containing the the information that is now stored in the server about the
-        message that was sent. This dictionary has the following keys: sender, timestamp, message, messageId,
-        and delivered.
+        list[0] is True or False, and indicates if the message was sent
+        list[1] is the Message now stored in the server on success, and an error message on failure
     """
-    print("Sending message from ", from_username, " to ", to_username)
+    log.info("send_message", from_username=from_username, to_username=to_username)
     global messageId
     if to_username not in accounts:
         return [False, "ER1: account with that username does not exist"]
 
-    if accounts[to_username]["loggedIn"] == True:
-        # If user is logged in, the message is marked as delivered instantly
-        message_dict = {"sender": from_username, "timestamp": time, "message": message, "messageId": messageId, "delivered": True}
-        accounts[to_username]["messageHistory"].append(message_dict)
-    else:
-        # If the receiving user is logged out, add the message to their list of messages
-        message_dict = {"sender": from_username, "timestamp": time, "message": message, "messageId": messageId, "delivered": False}
-        accounts[to_username]["messageHistory"].append(message_dict)
+    # If user is logged in, the message is marked as delivered instantly. Every worker numbers its messages
+    # with ids of its own, see shards.py.
+    stored = Message(messageId * shards.WORKERS + shards.INDEX, from_username, time, message, accounts[to_username]["loggedIn"] == True)
+    store_message(to_username, stored)
     # Each time a message is sent the messageId counter goes up
     messageId += 1
-    return [True, message_dict]
+    record_mutation(["SE", to_username, stored.message_id, from_username, time, message, stored.delivered])
+    trim_mailbox(to_username)
+    return [True, stored]
+
+def send_batch(from_username, items, time):
+    """
+    Sends many messages from one user in a single request. Every message is sent on its own, so a bad
+    recipient only fails its own message.
+
+    Parameters
+    ----------
+    from_username: str
+        The username of the account sending the messages
+    items: list
+        A (to_username, message) tuple for every message, in the order they are sent
+    time:
+        A string representing the time the messages were sent
+
+    Returns
+    -------
+    list
+        The return value of send_message for every item, in the same order
+    """
+    return [send_message(from_username, to_username, message, time) for to_username, message in items]
 
 def read_message(username, num):
     """
@@ -190,21 +412,41 @@ def read_message(username, num):
         list[1] is dictionary containing two pieces of data.
         list[1]["num_read"] is the number of messages read, which may be less than num if the user
         had less than num undelivered messages.
-        list[1]["messages"] is a list of dictionaries containint information about the messages that were read.
-        Each message has the following keys: sender, timestamp, message, messageId, and delivered.
-    """
-    print("Reading ", num, " messages for ", username)
-    # Go through message array for a user and append undelivered messages
-    num_read = 0
-    returned_messages = []
-    for message in accounts[username]["messageHistory"]:
-        if message["delivered"] == False:
-            returned_messages.append(message)
-            num_read += 1
-            if num_read == num:
-                break
+        list[1]["messages"] is a list of the Messages that were read.
+    """
+    log.info("read_message", username=username, number=num)
+    account = accounts[username]
+    num = int(num)
+    # Messages spilled to disk are newer than the ones in memory, so they are only needed past those
+    if account["spill"] is not None and len(account["undelivered"]) < num:
+        unspill_messages(username, num - len(account["undelivered"]))
+    # Take the oldest undelivered messages straight from the user's undelivered queue
+    returned_messages = list(islice(account["undelivered"].values(), num))
+    return [True, {"num_read": len(returned_messages), "messages": returned_messages}]
+
+def read_backlog(username, num, delivered_ids):
+    """
+    Marks the last chunk of a logged in user's backlog delivered and reads the next one, see stream_backlog.
+
+    Parameters
+    ----------
+    username: str
+        The username of the account whose backlog is being sent
+    num: int
+        The most messages to read
+    delivered_ids: list
+        The ids of the messages in the chunk that was sent last, empty for the first chunk
 
-    return [True, {"num_read": num_read, "messages": returned_messages}]
+    Returns
+    -------
+    list
+        list[0] is True or False, and indicates if the user is still logged in
+        list[1] is a dictionary as returned by read_message on success and an error message on failure
+    """
+    if username not in accounts or not accounts[username]["loggedIn"]:
+        return [False, "ER1: account is not logged in"]
+    mark_delivered(username, delivered_ids)
+    return read_message(username, num)
 
 def delete_message(username, id):
     """
@@ -223,17 +465,63 @@ def delete_message(username, id):
         list[0] is True or False, and indicates if the user deleted the requested message successfully
         list[1] is an empty string on success and an error message on failure
     """
-    print("Deleting message", id, "from", username)
+    log.info("delete_message", username=username, message_id=id)
     if username not in accounts:
         return [False, "ER3: attempting to delete a message from an account that does not exist"]
 
     message_id = int(id)
-    for i in range(len(accounts[username]["messageHistory"])):
-        if accounts[username]["messageHistory"][i]["messageId"] == message_id:
-            del accounts[username]["messageHistory"][i]
-            return [True, ""]
+    if drop_message(username, message_id):
+        record_mutation(["DM", username, message_id])
+        return [True, ""]
     return [False, "ER4: account did not receive message with that id"]
 
+def mark_delivered(username, message_ids):
+    """
+    Marks undelivered messages of a user as delivered, once they were sent to the user's connection.
+
+    Parameters
+    ----------
+    username: str
+        The username of the account that received the messages
+    message_ids: list
+        The ids of the messages. Messages that are no longer undelivered, such as deleted ones, are skipped.
+
+    Returns
+    -------
+    None.
+    """
+    if not message_ids:
+        return
+    # Journaled first, so the messages it trims are dropped after they were marked when it is replayed
+    record_mutation(["RD", username, message_ids])
+    set_delivered(username, message_ids)
+    mailbox_stats["backlog_messages"] += len(message_ids)
+
+def mark_undelivered(username, message):
+    """
+    Marks a message as undelivered and puts it in the user's undelivered queue, for example when a live
+    push of the message could not be sent.
+
+    Parameters
+    ----------
+    username: str
+        The username of the account that received the message
+    message: Message
+        The stored message, as returned by send_message
+
+    Returns
+    -------
+    None.
+    """
+    if message.message_id not in accounts[username]["messageHistory"]:
+        # The retention limits dropped the message before its push failed, so it is stored again
+        message.delivered = False
+        store_message(username, message)
+        record_mutation(["SE", username, message.message_id, message.sender, message.timestamp, message.message, False])
+        return
+    requeue_message(username, accounts[username]["messageHistory"][message.message_id])
+    record_mutation(["UD", username, message.message_id])
+
 def delete_account(username):
     """
     Deletes a account with the given username.
@@ -249,44 +537,267 @@ def delete_account(username):
         list[0] is True or False, and indicates if the user deleted the requested account successfully
         list[1] is an empty string on success and an error message on failure
     """
-    print("Deleting account ", username)
+    log.info("delete_account", username=username)
     if username not in accounts:
         return [False, "ER1: attempting to delete an account that does not exist"]
     else:
-        del accounts[username]
+        drop_mailbox(accounts.pop(username))
+        record_mutation(["DA", username])
+        change_directory("ACD", username)
         return [True, ""]
 
+def deliver_message(from_username, to_username, message, time):
+    """
+    Sends a message with send_message and pushes it to the receiver if the receiver is logged in.
 
-# HELPERS FOR DEALING WITH SOCKETS
-def accept_wrapper(sock):
+    Parameters
+    ----------
+    from_username: str
+        The username of the account sending the message
+    to_username: str
+        The username of the account receiving the message
+    message: str
+        The message text
+    time:
+        A string representing the time the message was sent
+
+    Returns
+    -------
+    list
+        The return value of send_message
     """
-    Accepts a new connection from a client.
+    call_info = send_message(from_username, to_username, message, time)
+    push_batch([(to_username, message)], [call_info])
+    return call_info
+
+def deliver_batch(from_username, items, time):
+    """
+    Sends many messages from one user with send_batch and pushes them to the receivers that are logged in.
 
     Parameters
     ----------
-    sock: socket
-        The socket of the request comes from.
+    from_username: str
+        The username of the account sending the messages
+    items: list
+        A (to_username, message) pair for every message, in the order they are sent
+    time:
+        A string representing the time the messages were sent
+
+    Returns
+    -------
+    list
+        The return value of send_message for every item, in the same order
+
+    Notes
+    -----
+    With several workers, respond first splits the items up by the worker that owns their receiver, and every
+    worker delivers its share, see split_by_owner.
+    """
+    results = send_batch(from_username, items, time)
+    push_batch(items, results)
+    return results
+
+# HELPERS FOR MULTIPLE WORKERS
+def owner_of(username):
+    """Returns the index of the worker that owns an account, or raises TypeError for a username that is not a str."""
+    if not isinstance(username, str):
+        raise TypeError("username must be a str")
+    return shards.shard_of(username)
+
+def split_by_owner(request):
+    """
+    Splits a request up by the worker that owns the accounts it is about.
+
+    Parameters
+    ----------
+    request: Request
+        The decoded request
+
+    Returns
+    -------
+    list or None
+        None if this worker carries out the whole request itself, as it always does in a single process.
+        Otherwise a (worker, request, positions) tuple for every worker with a part in it. positions is None
+        for a request carried out whole by its owner, and the positions of the items of an SB or SM share in
+        request order.
+
+    Raises
+    ------
+    TypeError
+        If a username is not a str
+    """
+    if shards.WORKERS == 1:
+        return None
+    match request.type:
+        case "CR" | "LI" | "LO" | "RE" | "DM" | "DA":
+            owner = owner_of(request.args["username"])
+        case "SE":
+            owner = owner_of(request.args["to_username"])
+        case "SB" | "SM":
+            items = request.args["items"]
+            shares = {}
+            for position, (to_username, _) in enumerate(items):
+                shares.setdefault(owner_of(to_username), []).append(position)
+            if list(shares) in ([], [shards.INDEX]):
+                return None
+            return [(worker, request._replace(args={**request.args, "items": [items[position] for position in positions]}), positions)
+                    for worker, positions in shares.items()]
+        case _:
+            return None
+    return None if owner == shards.INDEX else [(owner, request, None)]
+
+def carry_out_request(request_type, args, conn):
+    """
+    Carries out a request, or a share of one, about accounts this worker owns for a connection another worker
+    holds, see send_to_owners.
+
+    Parameters
+    ----------
+    request_type: str
+        The type of the request
+    args: dict
+        Its args
+    conn: shards.RemoteConnection
+        The connection the request came from
+
+    Returns
+    -------
+    list
+        The return value of process_request
+    """
+    return process_request(Request(request_type, None, args), conn, None)
+
+def owner_result(result, error, data):
+    """
+    Turns what a call to the owner of an account came back with into the result of the request, or request
+    share, it carried out.
+
+    Parameters
+    ----------
+    result:
+        The return value of the call, or None if it failed
+    error: Exception or None
+        What the call failed with
+    data: SimpleNamespace
+        The per-connection state of the connection the request came from
+
+    Returns
+    -------
+    list
+        The result, or ER0 if the owner found the request malformed or did not answer in time
+    """
+    if error is None:
+        return result
+    if isinstance(error, MALFORMED_REQUEST_ERRORS):
+        log.warning("bad_request", addr=data.addr, error=repr(error))
+        return [False, "ER0: malformed request"]
+    log.error("owner_call_failed", addr=data.addr, error=repr(error))
+    return [False, "ER0: the worker that owns the account did not answer"]
+
+def handle_shard_message(worker, message):
+    """
+    Handles a notification from another worker.
+
+    Parameters
+    ----------
+    worker: int
+        The index of the sending worker
+    message: dict
+        The notification. Its op is one of:
+        - closed: the connection conn_id that username logged in from, held by the sender, was closed
+        - directory: the sender applied a change to the account directory, see change_directory
+        - accounts: the sender owns the accounts in usernames, sent when it starts
+        - push: the sender stored messages for users logged in on connections this worker holds, with a
+          [to_username, conn_id, message] list for every push, see push_batch
+        - undelivered: this worker could not push the messages in a [username, message] list per message, sent
+          in reply to push
 
     Returns
     -------
     None.
     """
-    conn, addr = sock.accept()
-    print(f"Accepted connection from {addr}")
-    conn.setblocking(False)
-    data = types.SimpleNamespace(addr=addr, inb=b"", outb=b"", user=b"")
-    events = selectors.EVENT_READ | selectors.EVENT_WRITE
-    sel.register(conn, events, data=data)
+    match message["op"]:
+        case "closed":
+            # Unless the user logged out or in again since, the user is logged out like a single process would
+            # find the connection gone
+            username = message["username"]
+            if username in accounts and accounts[username]["socket"] == shards.RemoteConnection(worker, message["conn_id"]):
+                logout(username)
+        case "directory":
+            change_directory(message["change"], message["username"])
+        case "accounts":
+            for username in message["usernames"]:
+                insort(account_index, sys.intern(username))
+        case "push":
+            undelivered = []
+            for to_username, conn_id, stored in message["pushes"]:
+                sock = connections_by_id.get(conn_id)
+                if sock is None or not queue_push(sock, encode_push(sock, stored)):
+                    undelivered.append([to_username, stored])
+            if undelivered:
+                shards.mesh.notify(worker, {"op": "undelivered", "messages": undelivered})
+        case "undelivered":
+            # Left for RE, like a push that failed on this worker
+            for username, stored in message["messages"]:
+                if username in accounts:
+                    mark_undelivered(username, stored)
+
+# HELPERS FOR DURABILITY
+def new_account(username, password):
+    """
+    Builds the stored record of a new account.
+
+    Parameters
+    ----------
+    username : str
+        The username of the account
+    password : str
+        The password of the account
+
+    Returns
+    -------
+    dict
+        The account, with no messages and logged out
 
-# WIRE PROTOCOL VERSION
-def service_connection_wp(key, mask):
+    Notes
+    -----
+    messageHistory maps messageId to Message for every message the user holds in memory, and undelivered
+    maps messageId to Message for just the undelivered ones. Both keep the order messages arrived in.
+    delivered holds the ids of the delivered messages for RETAIN_DELIVERED, oldest first, and spill is the
+    SpillFile of the user's newest undelivered messages, or None while they all fit in memory.
     """
-    Services a connection from a client using a custom wire protocol.
+    return {"socket": None, "loggedIn": False, "accountInfo": {"username": username, "password": password}, "messageHistory": {}, "undelivered": {},
+            "delivered": OrderedDict(), "spill": None}
+
+# HELPERS FOR MAILBOX RETENTION
+def set_delivered(username, message_ids):
+    """Moves messages of a user from the undelivered queue to the delivered messages, see mark_delivered."""
+    account = accounts[username]
+    for message_id in message_ids:
+        if account["spill"] is not None and message_id in account["spill"]:
+            # Spilled when the journal is replayed, although it was in memory when it was sent. It and the older
+            # messages in the spill file are read back, as RE would have done.
+            unspill_messages(username, account["spill"].count_through(message_id))
+        stored = account["undelivered"].pop(message_id, None)
+        if stored is None:
+            continue
+        stored.delivered = True
+        if RETAIN_DELIVERED > 0:
+            account["delivered"][message_id] = None
+        if RETAIN_DELIVERED_TOTAL > 0 or RETAIN_SECONDS > 0:
+            delivered_order[message_id] = (time.time(), username)
+    trim_mailbox(username)
+
+def requeue_message(username, stored):
+    """
+    Puts a delivered message of a user back in the user's undelivered messages, see mark_undelivered.
 
     Parameters
     ----------
-    key: namedtuple
-    mask: selectors.EVENT_READ / selectors.EVENT_WRITE
+    username: str
+        The username of the account that received the message
+    stored: Message
+        The message, which the user holds in memory
 
     Returns
     -------
@@ -294,163 +805,140 @@ def service_connection_wp(key, mask):
 
     Notes
     -----
-    This version understand the custom wire protocol.
-    Though this function does not return, the server will always send some kind of response to the client.
-    In the case where a send message request is made, and the receiving user is logged in, the server will
-    send an additional message to the receiving user's socket with the new message information.
+    The message is the newest the user has, so it is stored again the way a new message is: behind the messages
+    in the user's spill file, if there are any, so RE still returns the undelivered messages in the order they
+    arrived.
     """
-    sock = key.fileobj
-    data = key.data
-    if mask & selectors.EVENT_READ:
-        # Reads the first number that is sent over to figure out how many total bytes are in the message
-        str_bytes = ""
-        recv_data = sock.recv(1)
-        while recv_data:
-            if len(recv_data.decode("utf-8")) > 0:
-                if (recv_data.decode("utf-8")).isnumeric():
-                    str_bytes += recv_data.decode("utf-8")
-                else:
-                    break
-            recv_data = sock.recv(1)
-        if not recv_data:
-            print(f"Closing connection to {data.addr}")
-            sel.unregister(sock)
-            sock.close()
-        else:
-            num_bytes = int(str_bytes)
-
-            # Reads the next num_bytes bytes to get the full message
-            data.outb += recv_data
-            cur_bytes = 1
-            while(cur_bytes < num_bytes):
-                recv_data = sock.recv(num_bytes - cur_bytes)
-                if recv_data:
-                    data.outb += recv_data
-                    cur_bytes += len(recv_data.decode("utf-8"))
-                else:
-                    print(f"Closing connection to {data.addr}")
-                    sel.unregister(sock)
-                    sock.close()
+    del accounts[username]["messageHistory"][stored.message_id]
+    forget_delivered(username, stored.message_id)
+    stored.delivered = False
+    store_message(username, stored)
 
-    if mask & selectors.EVENT_WRITE:
-        if not data.outb:
-            return
-        if data.outb:
-            in_data = data.outb.decode("utf-8")
-            # Flush out the input data from the buffer so that things remain synced
-            data.outb = data.outb[len(in_data):]
-            # Get 2 letter request type code
-            request_type = in_data[:2]
-            # The rest of the sent over data is the data needed to complete the request
-            in_data = in_data[2:]
-
-            # Reserve error code ER0 for unknown request type
-            return_data = "ER0"
-            match request_type:
-                case "CR":
-                    # create account
-                    username, password = in_data.split(" ")
-                    call_info = create_account(username, password)
-                    if call_info[0] == True:
-                        return_data = "CRT"
-                    else:
-                        # Pull just the error code out when we are using custom wire protocol
-                        return_data = call_info[1][:3]
-
-                case "LI":
-                    # login
-                    username, password = in_data.split(" ")
-                    call_info = login(username, password, sock)
-                    if call_info[0] == True:
-                        return_data = "LIT"
-                    else:
-                        # Pull just the error code out when we are using custom wire protocol
-                        return_data = call_info[1][:3]
-
-                case "LO":
-                    # logout
-                    username = in_data
-                    call_info = logout(username)
-                    if call_info[0] == True:
-                        return_data = "LOT"
-                    else:
-                        # Pull just the error code out when we are using custom wire protocol
-                        return_data = call_info[1][:3]
+def store_message(username, stored):
+    """
+    Puts a new message in a user's mailbox: in memory, or in the user's spill file if the user already has
+    SPILL_AFTER undelivered messages in memory. Delivered messages are tracked for the retention limits, see
+    trim_mailbox.
 
-                case "LA":
-                    # list accounts
-                    acct_names = list_accounts()[1]
-                    return_data = "LAT" + " ".join(acct_names)
-
-                case "SE":
-                    # send message
-                    in_data_array = in_data.split(" ")
-                    from_username = in_data_array[0]
-                    to_username = in_data_array[1]
-                    time = in_data_array[2]
-                    message = " ".join(in_data_array[3:])
-                    call_info = send_message(from_username, to_username, message, time)
-
-                    if call_info[0] == True:
-                        return_data = "SET"
-                        # If the receiver is logged on, we send a special message to their socket
-                        # This facilitates instantaneous delivery
-                        if accounts[to_username]["loggedIn"] == True:
-                            to_sock = accounts[to_username]["socket"]
-                            message_dict = call_info[1]
-                            sending_data = "SEL" + str(message_dict["messageId"]) + " " + message_dict["sender"] + " " + message_dict["timestamp"] + " " + str(len(message_dict["message"])) + " "  + message_dict["message"]
-                            sending_data = str(len(sending_data)) + sending_data
-                            # Send data to the logged in user's socket
-                            sending_data = sending_data.encode("utf-8")
-                            sent = to_sock.sendall(sending_data)
-
-                    else:
-                        # Pull just the error code out when we are using custom wire protocol
-                        return_data = call_info[1][:3]
+    Parameters
+    ----------
+    username: str
+        The username of the account that received the message
+    stored: Message
+        The message
 
-                case "RE":
-                    username, num = in_data.split(" ")
-                    call_info = read_message(username, num)
-                    if call_info[0] == True:
-                        return_data = "RET" + str(call_info[1]["num_read"])
-                        for message in call_info[1]["messages"]:
-                            return_data += " " + str(message["messageId"]) + " " + message["sender"]  + " " + message["timestamp"] + " " + str(len(message["message"])) + message["message"]
-                    else:
-                        # Pull just the error code out when we are using custom wire protocol
-                        return_data = call_info[1][:3]
-
-                case "DM":
-                    # delete message
-                    username, id = in_data.split(" ")
-                    call_info = delete_message(username, id)
-                    if call_info[0] == True:
-                        return_data = "DMT"
-                    else:
-                        # Pull just the error code out when we are using custom wire protocol
-                        return_data = call_info[1][:3]
-
-                case "DA":
-                    username = in_data
-                    call_info = delete_account(username)
-                    if call_info[0] == True:
-                        return_data = "DAT"
-                    else:
-                        # Pull just the error code out when we are using custom wire protocol
-                        return_data = call_info[1][:3]
-
-            return_data = str(len(return_data)) + return_data
-            return_data = return_data.encode("utf-8")
-            sent = sock.sendall(return_data)
-
-# JSON Version
-def service_connection_json(key, mask):
-    """
-    Services a connection from a client using json.
+    Returns
+    -------
+    None.
+    """
+    account = accounts[username]
+    if stored.delivered:
+        account["messageHistory"][stored.message_id] = stored
+        if RETAIN_DELIVERED > 0:
+            account["delivered"][stored.message_id] = None
+        if RETAIN_DELIVERED_TOTAL > 0 or RETAIN_SECONDS > 0:
+            delivered_order[stored.message_id] = (time.time(), username)
+    elif account["spill"] is not None or (SPILL_DIR and 0 < SPILL_AFTER <= len(account["undelivered"])):
+        if account["spill"] is None:
+            os.makedirs(SPILL_DIR, exist_ok=True)
+            account["spill"] = SpillFile(os.path.join(SPILL_DIR, hashlib.sha1(username.encode("utf-8")).hexdigest() + ".spill"))
+        account["spill"].append(stored)
+        mailbox_stats["spilled_messages"] += 1
+    else:
+        account["messageHistory"][stored.message_id] = stored
+        account["undelivered"][stored.message_id] = stored
+
+def unspill_messages(username, num):
+    """Moves the oldest num messages of a user's spill file, or all of them if it holds fewer, back to memory."""
+    account = accounts[username]
+    for stored in account["spill"].take(num):
+        account["messageHistory"][stored.message_id] = stored
+        account["undelivered"][stored.message_id] = stored
+        mailbox_stats["unspilled_messages"] += 1
+    if len(account["spill"]) == 0:
+        account["spill"] = None
+
+def drop_message(username, message_id):
+    """
+    Deletes a message from a user's mailbox, in memory or in the user's spill file.
+
+    Returns
+    -------
+    bool
+        False if the user does not hold a message with that id
+    """
+    account = accounts[username]
+    if message_id in account["messageHistory"]:
+        del account["messageHistory"][message_id]
+        account["undelivered"].pop(message_id, None)
+        forget_delivered(username, message_id)
+        return True
+    if account["spill"] is not None and message_id in account["spill"]:
+        account["spill"].discard(message_id)
+        if len(account["spill"]) == 0:
+            account["spill"].remove()
+            account["spill"] = None
+        return True
+    return False
+
+def drop_mailbox(account):
+    """Forgets every message of an account that is being deleted."""
+    if delivered_order:
+        for message_id in account["messageHistory"]:
+            delivered_order.pop(message_id, None)
+    if account["spill"] is not None:
+        account["spill"].remove()
+
+def trim_mailbox(username):
+    """Drops the delivered messages past the retention limits after a user received a message."""
+    if RETAIN_DELIVERED > 0:
+        delivered = accounts[username]["delivered"]
+        while len(delivered) > RETAIN_DELIVERED:
+            trim_message(username, next(iter(delivered)))
+    if RETAIN_DELIVERED_TOTAL > 0 or RETAIN_SECONDS > 0:
+        trim_delivered(time.time())
+
+def forget_delivered(username, message_id):
+    """Stops tracking a message for the retention limits, once it is deleted or no longer delivered."""
+    accounts[username]["delivered"].pop(message_id, None)
+    delivered_order.pop(message_id, None)
+
+def trim_delivered(now):
+    """
+    Drops the oldest delivered messages of all users past RETAIN_DELIVERED_TOTAL or older than RETAIN_SECONDS.
 
     Parameters
     ----------
-    key: namedtuple
-    mask: selectors.EVENT_READ / selectors.EVENT_WRITE
+    now: float
+        The current time.time()
+
+    Returns
+    -------
+    None.
+    """
+    while delivered_order:
+        message_id, (arrived, username) = next(iter(delivered_order.items()))
+        over_total = RETAIN_DELIVERED_TOTAL > 0 and len(delivered_order) > RETAIN_DELIVERED_TOTAL
+        too_old = RETAIN_SECONDS > 0 and now - arrived >= RETAIN_SECONDS
+        if not over_total and not too_old:
+            break
+        trim_message(username, message_id)
+
+def trim_message(username, message_id):
+    """Drops a delivered message for the retention limits. It is journaled like a deleted message."""
+    drop_message(username, message_id)
+    mailbox_stats["trimmed_messages"] += 1
+    record_mutation(["DM", username, message_id])
+
+def record_mutation(record):
+    """
+    Appends a mutation of the account store to the journal, if journaling is on.
+
+    Parameters
+    ----------
+    record : list
+        The mutation, starting with its type: CR (create account), SE (store message), UD (mark message
+        undelivered), RD (mark messages delivered), DM (delete message) or DA (delete account)
 
     Returns
     -------
@@ -458,192 +946,2193 @@ def service_connection_json(key, mask):
 
     Notes
     -----
-    This version understands json.
-    Though this function does not return, the server will always send some kind of response to the client.
-    In the case where a send message request is made, and the receiving user is logged in, the server will
-    send an additional message to the receiving user's socket with the new message information.
+    Logins and logouts are not recorded, since no connection survives a restart and every account comes
+    back logged out. Whether each message was delivered is recorded with the message instead.
     """
-    sock = key.fileobj
-    data = key.data
-    if mask & selectors.EVENT_READ:
-        # Reads the first number that is sent over to figure out how many total bytes are in the message
-        str_bytes = ""
-        recv_data = sock.recv(1)
-        while recv_data:
-            if len(recv_data.decode("utf-8")) > 0:
-                if (recv_data.decode("utf-8")).isnumeric():
-                    str_bytes += recv_data.decode("utf-8")
-                else:
-                    break
-            recv_data = sock.recv(1)
-        if not recv_data:
-            print(f"Closing connection to {data.addr}")
-            sel.unregister(sock)
-            sock.close()
-        else:
-            num_bytes = int(str_bytes)
-
-            # Reads the next num_bytes bytes to get the full message
-            data.outb += recv_data
-            cur_bytes = 1
-            while(cur_bytes < num_bytes):
-                recv_data = sock.recv(num_bytes - cur_bytes)
-                if recv_data:
-                    data.outb += recv_data
-                    cur_bytes += len(recv_data.decode("utf-8"))
-                else:
-                    print(f"Closing connection to {data.addr}")
-                    sel.unregister(sock)
-                    sock.close()
+    if journal is None:
+        return
+    journal.append(record)
 
+def snapshot_if_due():
+    """
+    Starts a snapshot of the account store when enough journal records have been written since the last one.
 
-    if mask & selectors.EVENT_WRITE:
-        if not data.outb:
-            return
-        if data.outb:
-            in_data = data.outb.decode("utf-8")
-            # Flush out the input data from the buffer so that things remain synced
-            data.outb = data.outb[len(in_data):]
-            # Convert data to json format
-            in_data_json = json.loads(in_data)
-            # Get 2 letter request type code
-            request_type = in_data_json["type"]
-
-            # Reserve error code ER0 for unknown request type
-            return_data = {"success": False, "errorMsg": "ER0: unknown request type"}
-            match request_type:
-                case "CR":
-                    # create account
-                    username = in_data_json["username"]
-                    password = in_data_json["password"]
-                    call_info = create_account(username, password)
-                    if call_info[0] == True:
-                        return_data = {"type" : "CRT", "success": True, "errorMsg": ""}
-                    else:
-                        # Pull entire error message for json
-                        return_data["errorMsg"] = call_info[1]
-
-                case "LI":
-                    # login
-                    username = in_data_json["username"]
-                    password = in_data_json["password"]
-                    call_info = login(username, password, sock)
-
-                    if call_info[0] == True:
-                        return_data = {"type" : "LIT", "success": True, "errorMsg": ""}
-                    else:
-                        # Pull entire error message for json
-                        return_data["errorMsg"] = call_info[1]
-
-                case "LO":
-                    # logout
-                    username = in_data_json["username"]
-                    call_info = logout(username)
-                    if call_info[0] == True:
-                        return_data = {"type" : "LOT", "success": True, "errorMsg": ""}
-                    else:
-                        # Pull entire error message for json
-                        return_data["errorMsg"] = call_info[1]
+    Parameters
+    ----------
+    None.
 
-                case "LA":
-                    # list accounts
-                    acct_names = list_accounts()[1]
-                    return_data = {"type" : "LAT", "success": True, "accounts": acct_names, "errorMsg": ""}
-
-                case "SE":
-                    # send message
-                    from_username = in_data_json["from_username"]
-                    to_username = in_data_json["to_username"]
-                    time = in_data_json["timestamp"]
-                    message = in_data_json["message"]
-
-                    call_info = send_message(from_username, to_username, message, time)
-
-                    # If the receiver is logged on, we send a special message to their socket
-                    # This facilitates instantaneous delivery
-                    if call_info[0] == True:
-                        return_data = {"type" : "SET", "success": True, "errorMsg": ""}
-                        if accounts[to_username]["loggedIn"] == True:
-                            to_sock = accounts[to_username]["socket"]
-                            message_dict = call_info[1]
-                            message_dict["type"] = "SEL"
-                            message_dict["success"] = True
-                            sending_data = json.dumps(message_dict)
-                            sending_data = str(len(sending_data)) + sending_data
-                            # Send data to the logged in user's socket
-                            sending_data = sending_data.encode("utf-8")
-                            sent = to_sock.sendall(sending_data)
-
-                    else:
-                        # Pull the entire error message for json
-                        return_data["errorMsg"] = call_info[1]
+    Returns
+    -------
+    None.
 
-                case "RE":
-                    username = in_data_json["username"]
-                    num = in_data_json["number"]
-                    call_info = read_message(username, num)
-                    if call_info[0] == True:
-                        return_data = call_info[1]
-                        return_data["type"] = "RET"
-                    else:
-                        # Pull the entire error message for json
-                        return_data["errorMsg"] = call_info[1]
-
-                case "DM":
-                    # delete message
-                    username = in_data_json["username"]
-                    id = in_data_json["id"]
-                    call_info = delete_message(username, id)
-                    if call_info[0] == True:
-                        return_data = {"success": True, "errorMsg": ""}
-                    else:
-                        # Pull the entire error message for json
-                        return_data["errorMsg"] = call_info[1]
-
-                case "DA":
-                    username = in_data_json["username"]
-                    call_info = delete_account(username)
-                    if call_info[0] == True:
-                        return_data = {"success": True, "errorMsg": ""}
-                    else:
-                        # Pull just the error code out when we are using custom wire protocol
-                        return_data["errorMsg"] = call_info[1]
-
-            # Send Json versions back to client
-            return_data = json.dumps(return_data)
-            return_data = str(len(return_data)) + return_data
-            return_data = return_data.encode("utf-8")
-            sent = sock.sendall(return_data)
+    Notes
+    -----
+    Called between requests, so every record a request journals is covered by the snapshot or written after it,
+    never split between the two. Only the copy of the store is taken here, the journal's writer thread builds and
+    writes the snapshot from it.
+    """
+    if journal is not None and journal.needs_snapshot():
+        captured = capture_state()
+        journal.start_snapshot(lambda: build_snapshot(captured))
 
-if __name__ == "__main__":
-    # UNCOMMENT HOST AND PORT BELOW FOR LOCAL UNIT TESTING
-    # HOST = os.environ.get("HOST_SERVER_TESTING")
-    # PORT = int(os.environ.get("PORT_SERVER_TESTING"))
+def capture_state():
+    """
+    Copies what a snapshot needs of the account store, cheaply enough to do between requests.
 
-    # HOST AND PORT FOR MULTIPLE COMPUTERS
-    # server has 0.0.0.0 to listen on all interfaces
-    HOST = os.environ.get("SERVER_IP")
-    PORT = int(os.environ.get("PORT_SERVER"))
-    lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    lsock.bind((HOST, PORT))
-    lsock.listen()
-    print("Listening on", (HOST, PORT))
-    lsock.setblocking(False)
-    sel.register(lsock, selectors.EVENT_READ, data=None)
+    Parameters
+    ----------
+    None.
 
-    try:
-        while True:
-            events = sel.select(timeout=None)
-            for key, mask in events:
-                if key.data is None:
-                    accept_wrapper(key.fileobj)
-                else:
-                    # Version that understands the wire protocol
-                    service_connection_wp(key, mask)
-                    # Version that understands json
-                    # service_connection_json(key, mask)
-    except KeyboardInterrupt:
-        print("Caught keyboard interrupt, exiting")
-    finally:
-        print("Closing server")
-        sel.close()
\ No newline at end of file
+    Returns
+    -------
+    tuple
+        messageId, and for each account its username, its password, the Messages it holds in memory in the order
+        they arrived, the ids of the undelivered ones, and a SpillSnapshot of its spill file or None
+
+    Notes
+    -----
+    Only the containers are copied. Stored Messages are shared, since nothing changes them once they are stored
+    apart from their delivered flag, which the copy of the undelivered ids stands in for.
+    """
+    return messageId, [(username, account["accountInfo"]["password"], list(account["messageHistory"].values()), set(account["undelivered"]),
+                        account["spill"].freeze() if account["spill"] is not None else None)
+                       for username, account in accounts.items()]
+
+def build_snapshot(captured):
+    """
+    Builds a compact copy of the account store for a snapshot, from a copy taken by capture_state.
+
+    Parameters
+    ----------
+    captured: tuple
+        The copy
+
+    Returns
+    -------
+    dict
+        messageId: the counter the next message id is built from
+        accounts: maps each username to [password, messages], where messages lists
+        [messageId, sender, timestamp, message, delivered] in the order they arrived
+    """
+    next_message_id, captured_accounts = captured
+    snapshot_accounts = {}
+    for username, password, messages, undelivered, spill in captured_accounts:
+        stored = [[m.message_id, m.sender, m.timestamp, m.message, m.message_id not in undelivered] for m in messages]
+        if spill is not None:
+            stored += [[m.message_id, m.sender, m.timestamp, m.message, False] for m in spill.read()]
+        snapshot_accounts[username] = [password, stored]
+    return {"messageId": next_message_id, "accounts": snapshot_accounts}
+
+def snapshot_state():
+    """Builds a compact copy of the account store for a snapshot right away, see build_snapshot."""
+    return build_snapshot(capture_state())
+
+def apply_record(record):
+    """
+    Replays one journal record onto the account store.
+
+    Parameters
+    ----------
+    record : list
+        A record written by record_mutation
+
+    Returns
+    -------
+    None.
+    """
+    global messageId
+    match record[0]:
+        case "CR":
+            accounts[sys.intern(record[1])] = new_account(record[1], record[2])
+        case "SE":
+            _, to_username, message_id, sender, time, message, delivered = record
+            store_message(to_username, Message(message_id, sender, time, message, delivered))
+            trim_mailbox(to_username)
+            messageId = max(messageId, message_id // shards.WORKERS + 1)
+        case "UD":
+            requeue_message(record[1], accounts[record[1]]["messageHistory"][record[2]])
+        case "RD":
+            set_delivered(record[1], record[2])
+        case "DM":
+            drop_message(record[1], record[2])
+        case "DA":
+            if record[1] in accounts:
+                drop_mailbox(accounts.pop(record[1]))
+
+def restore_state(snapshot, records):
+    """
+    Rebuilds the account store from a snapshot and the journal records written after it.
+
+    Parameters
+    ----------
+    snapshot : dict or None
+        A snapshot built by snapshot_state, or None to start from an empty store
+    records : iterable
+        The journal records to replay, in order
+
+    Returns
+    -------
+    None.
+    """
+    global messageId
+    for account in accounts.values():
+        drop_mailbox(account)
+    accounts.clear()
+    delivered_order.clear()
+    messageId = 0
+    if snapshot is not None:
+        messageId = snapshot["messageId"]
+        for username, (password, messages) in snapshot["accounts"].items():
+            username = sys.intern(username)
+            accounts[username] = new_account(username, password)
+            for message_id, sender, time, message, delivered in messages:
+                store_message(username, Message(message_id, sender, time, message, delivered))
+        for username in accounts:
+            trim_mailbox(username)
+    for record in records:
+        apply_record(record)
+    account_index[:] = sorted(accounts)
+
+def open_journal(directory):
+    """
+    Restores the account store from a journal directory and starts journaling every mutation to it.
+
+    Parameters
+    ----------
+    directory : str
+        The journal directory, created if it does not exist
+
+    Returns
+    -------
+    Journal
+        The open journal, also stored in the journal global
+    """
+    global journal
+    journal = None
+    stored = Journal(directory, JOURNAL_FSYNC_INTERVAL, JOURNAL_SNAPSHOT_EVERY)
+    snapshot, records = stored.load()
+    restore_state(snapshot, records)
+    log.info("journal_restored", directory=directory, accounts=len(accounts), records=stored.records_since_snapshot)
+    stored.open()
+    journal = stored
+    # Fold a long replayed tail into a fresh snapshot so the next restart is fast
+    if journal.needs_snapshot():
+        journal.write_snapshot(snapshot_state())
+    return journal
+
+
+# HELPERS FOR DEALING WITH SOCKETS
+# Number of bytes pulled off a socket per read event
+RECV_CHUNK_SIZE = 4096
+# Every client socket of the selector engine by its connection id, which other workers refer to it by
+connections_by_id = {}
+connection_ids = count()
+
+def accept_wrapper(sock):
+    """
+    Accepts a new connection from a client.
+
+    Parameters
+    ----------
+    sock: socket
+        The socket of the request comes from.
+
+    Returns
+    -------
+    None.
+    """
+    try:
+        conn, addr = sock.accept()
+    except BlockingIOError:
+        # Every worker watches the shared Unix domain socket, and another one took the connection
+        return
+    if conn.family == socket.AF_UNIX:
+        # Unix domain socket peers have no address of their own
+        addr = transport.UNIX_PREFIX + UNIX_SOCKET
+    if connection_count() >= MAX_CONNECTIONS:
+        # Closing right away gives the client a clean end of stream instead of a hang in the listen backlog
+        connection_stats["rejected_connections"] += 1
+        log.warning("connection_rejected", addr=addr, connections=connection_count())
+        conn.close()
+        return
+    log.info("connection_accepted", addr=addr)
+    conn.setblocking(False)
+    if conn.family != socket.AF_UNIX:
+        # Send replies as soon as they are ready. With Nagle's algorithm, the replies to a burst of pipelined
+        # requests would wait for the client to acknowledge the first one, which it may delay by up to 40ms.
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if SELECTOR_MODE == "legacy":
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE
+    else:
+        events = selectors.EVENT_READ
+    data = types.SimpleNamespace(addr=addr, inb=bytearray(), outb=OutboundQueue(), user=b"", events=events, codec=SERVER_PROTOCOL, compression=False, last_active=time.monotonic(), conn_id=next(connection_ids), pending=deque(), busy=False, backlog=None, remote_users=set())
+    sel.register(conn, events, data=data)
+    connections_by_id[data.conn_id] = conn
+    watch_idle(conn, data)
+
+def connection_count():
+    """Returns the number of connected clients, on either engine."""
+    # The selector also watches the listening socket, and the channels to other workers
+    return len(async_connections) + len(connections_by_id)
+
+def watch_idle(sock, data):
+    """
+    Starts the idle timer of a new connection, if idle connections time out.
+
+    Parameters
+    ----------
+    sock: socket or asyncio.StreamWriter
+        The client connection
+    data: SimpleNamespace
+        The per-connection state
+
+    Returns
+    -------
+    None.
+    """
+    if IDLE_TIMEOUT > 0:
+        idle_timers.schedule((sock, data), data.last_active + IDLE_TIMEOUT)
+
+def reap_idle_connections(now):
+    """
+    Disconnects the clients that have sent nothing for IDLE_TIMEOUT seconds.
+
+    Parameters
+    ----------
+    now: float
+        The current time.monotonic()
+
+    Returns
+    -------
+    None.
+
+    Notes
+    -----
+    Reading from a client only updates its last_active time. When its timer expires, a client that was active
+    since has its timer scheduled again for IDLE_TIMEOUT after that activity, so the work done per tick only
+    depends on the timers that are due, not on the number of connections. Timers of connections that closed
+    in the meantime are skipped.
+    """
+    for sock, data in idle_timers.advance(now):
+        if connection_data(sock) is not data:
+            continue
+        if now - data.last_active < IDLE_TIMEOUT:
+            idle_timers.schedule((sock, data), data.last_active + IDLE_TIMEOUT)
+            continue
+        connection_stats["idle_disconnects"] += 1
+        log.info("idle_disconnected", addr=data.addr, idle_seconds=round(now - data.last_active, 3))
+        if isinstance(sock, asyncio.StreamWriter):
+            # The handler sees the end of stream and cleans up
+            sock.close()
+        else:
+            close_connection(sock, data)
+
+def timers_enabled():
+    """Returns whether anything runs once per timer tick: idle timeouts or the age limit of delivered messages."""
+    return IDLE_TIMEOUT > 0 or RETAIN_SECONDS > 0
+
+def run_timers(now):
+    """
+    Runs what is due once per timer tick: disconnecting idle clients and dropping delivered messages older
+    than RETAIN_SECONDS.
+
+    Parameters
+    ----------
+    now: float
+        The current time.monotonic()
+
+    Returns
+    -------
+    None.
+    """
+    # Advancing the wheel even when it is empty keeps time_to_next_tick counting down to the next tick
+    reap_idle_connections(now)
+    if RETAIN_SECONDS > 0:
+        trim_delivered(time.time())
+
+def close_connection(sock, data):
+    """
+    Unregisters a client socket from the selector and closes it.
+
+    Parameters
+    ----------
+    sock: socket
+        The socket to close
+    data: SimpleNamespace
+        The per-connection state registered with the selector
+
+    Returns
+    -------
+    None.
+    """
+    log.info("connection_closed", addr=data.addr)
+    directory_subscribers.discard(sock)
+    connections_by_id.pop(data.conn_id, None)
+    for username in data.remote_users:
+        # The owner of the account may still have the user logged in on this connection
+        shards.mesh.notify(shards.shard_of(username), {"op": "closed", "username": username, "conn_id": data.conn_id})
+    sel.unregister(sock)
+    sock.close()
+
+def update_interest(sock, data):
+    """
+    Updates which events the selector watches a client socket for.
+
+    Parameters
+    ----------
+    sock: socket
+        The client socket
+    data: SimpleNamespace
+        The per-connection state registered with the selector
+
+    Returns
+    -------
+    None.
+
+    Notes
+    -----
+    Write interest is only on while bytes are queued or a backlog is being sent (always on in legacy mode),
+    and read interest is turned off while the outbound queue is full so a client that does not read its
+    replies cannot make the queue grow without bound, and while requests wait for the request pool.
+    """
+    events = 0
+    if len(data.outb) < MAX_OUTBOUND_BYTES and not data.pending:
+        events |= selectors.EVENT_READ
+    if data.outb or (data.backlog is not None and not data.busy) or SELECTOR_MODE == "legacy":
+        events |= selectors.EVENT_WRITE
+    if events != data.events:
+        data.events = events
+        sel.modify(sock, events, data=data)
+
+def flush_outbound(sock, data):
+    """
+    Sends as much of a connection's queued outbound bytes as the socket will take without blocking.
+
+    Parameters
+    ----------
+    sock: socket
+        The client socket
+    data: SimpleNamespace
+        The per-connection state registered with the selector
+
+    Returns
+    -------
+    None.
+
+    Notes
+    -----
+    Write interest stays on only while bytes are left in the queue, so an idle connection never wakes up
+    the select loop. Once the queue is empty, the next chunk of a backlog being sent is queued, see
+    stream_backlog, unless a request of the connection is in the request pool or parked, since its reply goes
+    first.
+    """
+    if sock.fileno() == -1:
+        # The connection was already closed while servicing it
+        return
+    if data.backlog is not None and not data.outb and not data.busy:
+        stream_backlog(sock, data)
+    if data.outb:
+        try:
+            data.outb.send(sock)
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            close_connection(sock, data)
+            return
+    update_interest(sock, data)
+
+def connection_data(sock):
+    """
+    Looks up the per-connection state of a client.
+
+    Parameters
+    ----------
+    sock: socket or asyncio.StreamWriter
+        The client connection
+
+    Returns
+    -------
+    SimpleNamespace or None
+        The per-connection state, or None if the client is no longer connected
+    """
+    if isinstance(sock, asyncio.StreamWriter):
+        return async_connections.get(sock)
+    try:
+        return sel.get_key(sock).data
+    except (KeyError, ValueError):
+        return None
+
+def queue_send(sock, payload, flush=True, compress=True):
+    """
+    Queues bytes to be sent to a client and starts sending them.
+
+    Parameters
+    ----------
+    sock: socket
+        The client socket to send to, which may be a different client than the one being serviced
+    payload: bytes or list
+        The framed bytes to send, or a frame as a list of bytes-like segments, which are sent without being
+        joined unless the frame is compressed
+    flush: bool
+        False to leave the bytes queued for the caller to flush, so replies to pipelined requests go out
+        together instead of one small send each
+    compress: bool
+        False if the caller already compressed the frame
+
+    Returns
+    -------
+    bool
+        True if the bytes were queued, and False if the socket is no longer connected, or was closed because
+        sending to it failed
+
+    Notes
+    -----
+    Clients of the asyncio engine are identified by their StreamWriter, whose transport keeps its own
+    outbound buffer. Frames to connections that negotiated compression are compressed here.
+    """
+    if isinstance(sock, asyncio.StreamWriter):
+        if sock.is_closing():
+            return False
+        data = async_connections.get(sock)
+    else:
+        try:
+            data = sel.get_key(sock).data
+        except (KeyError, ValueError):
+            return False
+    compress = compress and data is not None and data.compression
+    if isinstance(payload, list):
+        if compress:
+            payload = b"".join(payload)
+        else:
+            traffic_stats["bytes_out"] += sum(len(segment) for segment in payload)
+    if isinstance(payload, bytes):
+        if compress:
+            payload = compress_outbound(payload, data)
+        traffic_stats["bytes_out"] += len(payload)
+    if isinstance(sock, asyncio.StreamWriter):
+        if isinstance(payload, list):
+            sock.writelines(payload)
+        else:
+            sock.write(payload)
+        depth = sock.transport.get_write_buffer_size()
+    else:
+        data.outb.append(payload)
+        depth = len(data.outb)
+        if flush:
+            flush_outbound(sock, data)
+    if depth > outbound_stats["peak_queue_bytes"]:
+        outbound_stats["peak_queue_bytes"] = depth
+    # Sending can find the connection reset, in which case it was closed with the bytes unsent
+    return isinstance(sock, asyncio.StreamWriter) or sock.fileno() != -1
+
+def compress_outbound(payload, data):
+    """
+    Compresses a frame to a connection that negotiated compression, if it is large enough to be worth it.
+
+    Parameters
+    ----------
+    payload: bytes
+        The framed bytes to send
+    data: SimpleNamespace
+        The per-connection state of the receiving connection
+
+    Returns
+    -------
+    bytes
+        The frame to send, compressed or not
+    """
+    if len(payload) < COMPRESSION_THRESHOLD:
+        return payload
+    return CODECS[data.codec].compress_frame(payload)
+
+def queue_push(sock, payload):
+    """
+    Queues a live message push to a logged in client, applying the slow consumer policy.
+
+    Parameters
+    ----------
+    sock: socket
+        The socket of the receiving client
+    payload: bytes
+        The framed bytes to send
+
+    Returns
+    -------
+    bool
+        True if the push was queued. False if the receiving client is no longer connected or its outbound
+        queue is full, in which case the message should be left undelivered.
+    """
+    if isinstance(sock, asyncio.StreamWriter):
+        if sock.is_closing():
+            return False
+        addr = sock.get_extra_info("peername")
+        depth = sock.transport.get_write_buffer_size()
+    else:
+        try:
+            data = sel.get_key(sock).data
+        except (KeyError, ValueError):
+            return False
+        addr = data.addr
+        depth = len(data.outb)
+    if depth + len(payload) > MAX_OUTBOUND_BYTES:
+        if SLOW_CONSUMER_POLICY == "disconnect":
+            outbound_stats["slow_consumer_disconnects"] += 1
+            log.warning("slow_consumer_disconnected", addr=addr, queued_bytes=depth)
+            if isinstance(sock, asyncio.StreamWriter):
+                sock.close()
+            else:
+                close_connection(sock, data)
+        else:
+            outbound_stats["dropped_pushes"] += 1
+            log.warning("push_dropped", addr=addr, queued_bytes=depth)
+        return False
+    return queue_send(sock, payload)
+
+def push_batch(items, results):
+    """
+    Pushes the messages of a batch send to the recipients that are logged in.
+
+    Parameters
+    ----------
+    items: list
+        The (to_username, message) tuples of the batch
+    results: list
+        The return values of send_batch for the batch
+
+    Returns
+    -------
+    None.
+
+    Notes
+    -----
+    One push_encoder is built per distinct message text, so the payload a multicast shares between its
+    recipients is only encoded once per codec. Recipients whose connections are held by another worker are
+    pushed to by that worker, with one push notification per worker, without waiting for it. That worker
+    answers the messages it could not push with an undelivered notification, and they are left for RE then,
+    see handle_shard_message.
+    """
+    encoders = {}
+    remote_pushes = {}
+    for (to_username, message), call_info in zip(items, results):
+        if call_info[0] == True and accounts[to_username]["loggedIn"] == True:
+            stored = call_info[1]
+            to_sock = accounts[to_username]["socket"]
+            if isinstance(to_sock, shards.RemoteConnection):
+                remote_pushes.setdefault(to_sock.worker, []).append([to_username, to_sock.conn_id, stored])
+                continue
+            if message not in encoders:
+                encoders[message] = push_encoder(stored)
+            # Send data to the logged in user's socket, or leave the message for RE if it can't take it
+            if not queue_push(to_sock, encoders[message](to_sock, stored.message_id)):
+                mark_undelivered(to_username, stored)
+    for worker, pushes in remote_pushes.items():
+        shards.mesh.notify(worker, {"op": "push", "pushes": pushes})
+
+def encode_directory_push(codec, opcode, username):
+    """
+    Encodes an account directory push.
+
+    Parameters
+    ----------
+    codec: str
+        The codec of the receiving connection, one of CODECS
+    opcode: str
+        ACA when the account was created and ACD when it was deleted
+    username: str
+        The account that changed
+
+    Returns
+    -------
+    bytes
+        The framed push, ready to be sent
+    """
+    if codec == "json":
+        sending_data = json.dumps({"type": opcode, "version": directory_version, "username": username})
+    elif codec == "v2":
+        return wire_v2.encode_frame(opcode, 0, [directory_version, username])
+    else:
+        sending_data = opcode + str(directory_version) + " " + username
+    sending_data = str(len(sending_data)) + sending_data
+    return sending_data.encode("utf-8")
+
+def change_directory(opcode, username):
+    """
+    Adds an account to the account directory or removes it, and pushes the change to the subscribers.
+
+    Parameters
+    ----------
+    opcode: str
+        ACA when the account was created and ACD when it was deleted
+    username: str
+        The account that changed
+
+    Returns
+    -------
+    None.
+
+    Notes
+    -----
+    The worker that owns the account passes the change on to every other worker, which applies it to its own
+    copy of the directory.
+    """
+    if opcode == "ACA":
+        insort(account_index, username)
+    else:
+        del account_index[bisect_left(account_index, username)]
+    push_directory_change(opcode, username)
+    if shards.mesh is not None and shards.owns(username):
+        shards.mesh.broadcast({"op": "directory", "change": opcode, "username": username})
+
+def push_directory_change(opcode, username):
+    """
+    Pushes an account directory change to every subscribed connection.
+
+    Parameters
+    ----------
+    opcode: str
+        ACA when the account was created and ACD when it was deleted
+    username: str
+        The account that changed
+
+    Returns
+    -------
+    None.
+
+    Notes
+    -----
+    The push is encoded once per codec in use. A push dropped under the slow consumer policy is not
+    retried, the subscriber notices the skipped version on its next push and subscribes again.
+    """
+    global directory_version
+    directory_version += 1
+    payloads = {}
+    for sock in list(directory_subscribers):
+        data = connection_data(sock)
+        if data is None:
+            # The connection closed
+            directory_subscribers.discard(sock)
+            continue
+        if data.codec not in payloads:
+            payloads[data.codec] = encode_directory_push(data.codec, opcode, username)
+        queue_push(sock, payloads[data.codec])
+
+def get_outbound_stats():
+    """
+    Reports how full the outbound queues are.
+
+    Parameters
+    ----------
+    None.
+
+    Returns
+    -------
+    dict
+        connections: the number of connected clients
+        queued_bytes: the bytes currently queued across all clients
+        max_queue_bytes: the deepest queue right now
+        peak_queue_bytes: the deepest queue seen since the server started
+        dropped_pushes: live pushes dropped because the receiver's queue was full
+        slow_consumer_disconnects: clients disconnected because their queue was full
+    """
+    depths = [len(connection_data(sock).outb) for sock in connections_by_id.values()]
+    depths += [writer.transport.get_write_buffer_size() for writer in async_connections]
+    return {
+        "connections": len(depths),
+        "queued_bytes": sum(depths),
+        "max_queue_bytes": max(depths, default=0),
+        **outbound_stats,
+    }
+
+def record_request(request_type, start_ns, success):
+    """
+    Counts a finished request and adds its latency to the histogram of its type.
+
+    Parameters
+    ----------
+    request_type: str
+        The 2 letter request type code
+    start_ns: int
+        time.perf_counter_ns() from when the request started being processed
+    success: bool
+        False if the request was answered with an error
+
+    Returns
+    -------
+    None.
+    """
+    elapsed = time.perf_counter_ns() - start_ns
+    if request_type not in REQUEST_TYPES:
+        request_type = "other"
+    stats = request_stats.get(request_type)
+    if stats is None:
+        stats = request_stats[request_type] = {"count": 0, "errors": 0, "total_ns": 0, "max_ns": 0, "histogram": [0] * LATENCY_BUCKETS}
+    stats["count"] += 1
+    if not success:
+        stats["errors"] += 1
+    stats["total_ns"] += elapsed
+    if elapsed > stats["max_ns"]:
+        stats["max_ns"] = elapsed
+    stats["histogram"][min(elapsed.bit_length(), LATENCY_BUCKETS - 1)] += 1
+
+def histogram_percentile(histogram, count, fraction):
+    """Returns the upper bound in nanoseconds of the histogram bucket holding the given fraction of requests."""
+    target = fraction * count
+    seen = 0
+    for bucket, bucket_count in enumerate(histogram):
+        seen += bucket_count
+        if bucket_count and seen >= target:
+            return 2 ** bucket
+    return 0
+
+def get_server_stats():
+    """
+    Reports request latencies, traffic and connection counts.
+
+    Parameters
+    ----------
+    None.
+
+    Returns
+    -------
+    dict
+        bytes_in, bytes_out: bytes read from clients and queued to be sent to them since the server started
+        everything get_outbound_stats reports, including the number of connected clients
+        idle_disconnects, rejected_connections, inbound_overflow_disconnects: clients disconnected by the
+        connection limits
+        trimmed_messages, spilled_messages, unspilled_messages: delivered messages dropped by the retention
+        limits, and undelivered messages moved to spill files and read back from them
+        the compression.stats counters, and compress_bytes_saved: the bytes compression kept off the wire,
+        to weigh against compress_cpu_ns
+        worker and workers: the index of this worker and the number of workers, and with several workers the
+        Mesh stats: calls_sent, calls_served and notifications_sent. Every other count is for this worker only.
+        with JOURNAL_DIR set, the Journal.get_stats counters: journal_pending, journal_write_failures and
+        journal_snapshot_failures
+        requests: for every request type that has been seen, its count, errors, mean_us and max_us, the
+        p50_us, p90_us and p99_us latency percentiles, and histogram, a list of [upper bound in
+        nanoseconds, count] pairs for the non-empty buckets
+
+    Notes
+    -----
+    The percentiles come from the histogram, so they are the upper bound of the bucket they fall in and can
+    be up to twice the true value.
+    """
+    requests = {}
+    for request_type, stats in request_stats.items():
+        count = stats["count"]
+        requests[request_type] = {
+            "count": count,
+            "errors": stats["errors"],
+            "mean_us": round(stats["total_ns"] / count / 1000, 3),
+            "max_us": round(stats["max_ns"] / 1000, 3),
+            **{f"p{round(fraction * 100)}_us": histogram_percentile(stats["histogram"], count, fraction) / 1000 for fraction in (0.5, 0.9, 0.99)},
+            "histogram": [[2 ** bucket, bucket_count] for bucket, bucket_count in enumerate(stats["histogram"]) if bucket_count],
+        }
+    compression_saved = compression.stats["compress_bytes_in"] - compression.stats["compress_bytes_out"]
+    worker_stats = {"worker": shards.INDEX, "workers": shards.WORKERS, **(shards.mesh.stats if shards.mesh is not None else {})}
+    journal_stats = journal.get_stats() if journal is not None else {}
+    return {**traffic_stats, **get_outbound_stats(), **connection_stats, **mailbox_stats, **compression.stats, "compress_bytes_saved": compression_saved, **worker_stats, **journal_stats, "requests": requests}
+
+def flatten_server_stats(stats):
+    """
+    Flattens get_server_stats into [name, value] pairs for the wire protocol, such as ["SE.p99_us", 65.536]
+    and, for each histogram bucket, ["SE.hist.65536", 12].
+    """
+    pairs = []
+    for name, value in stats.items():
+        if name != "requests":
+            pairs.append([name, value])
+    for request_type, request in stats["requests"].items():
+        for name, value in request.items():
+            if name == "histogram":
+                pairs += [[f"{request_type}.hist.{bound}", bucket_count] for bound, bucket_count in value]
+            else:
+                pairs.append([f"{request_type}.{name}", value])
+    return pairs
+
+def extract_requests(data):
+    """
+    Pulls every complete request out of a connection's receive buffer, in the framing the connection speaks.
+
+    Parameters
+    ----------
+    data: SimpleNamespace
+        The per-connection state
+
+    Returns
+    -------
+    list
+        The request frames. Length-prefixed frames are str, and v2 frames are (opcode, request id, fields).
+
+    Raises
+    ------
+    ValueError
+        If the buffer holds a malformed frame, or an unfinished one larger than MAX_INBOUND_BYTES
+    """
+    max_decompressed = MAX_DECOMPRESSED_BYTES if data.compression else None
+    frames = CODECS[data.codec].extract_frames(data.inb, max_decompressed)
+    # What is left is the start of a request that has not fully arrived
+    if len(data.inb) > MAX_INBOUND_BYTES:
+        connection_stats["inbound_overflow_disconnects"] += 1
+        raise ValueError(f"unfinished request is larger than {MAX_INBOUND_BYTES} bytes")
+    return frames
+
+def receive_frames(sock, data):
+    """
+    Reads whatever a client has sent and returns the requests that are now complete.
+
+    Parameters
+    ----------
+    sock: socket
+        The client socket that is ready for reading
+    data: SimpleNamespace
+        The per-connection state registered with the selector
+
+    Returns
+    -------
+    list or None
+        The complete request frames in the order they were sent, which can be several pipelined requests
+        or none at all. None is returned if the connection was closed.
+    """
+    try:
+        recv_data = sock.recv(RECV_CHUNK_SIZE)
+    except (BlockingIOError, InterruptedError):
+        return []
+    except OSError:
+        # Reset by the client, or any other error of the socket, is the end of the connection
+        recv_data = b""
+    if not recv_data:
+        close_connection(sock, data)
+        return None
+
+    traffic_stats["bytes_in"] += len(recv_data)
+    data.last_active = time.monotonic()
+    data.inb += recv_data
+    try:
+        return extract_requests(data)
+    except ValueError as e:
+        log.warning("bad_frame", addr=data.addr, error=str(e))
+        close_connection(sock, data)
+        return None
+
+def encode_messages_wp(builder, messages):
+    """
+    Adds stored messages to a version 1 wire protocol reply: their number, then the id, sender, timestamp,
+    character length and text of each one, separated by spaces. The texts are added from their stored bodies.
+
+    Parameters
+    ----------
+    builder: ReplyBuilder
+        The reply, with its type already added
+    messages: list
+        The Messages
+
+    Returns
+    -------
+    None
+    """
+    builder.text(str(len(messages)))
+    for message in messages:
+        builder.text(" " + str(message.message_id) + " " + message.sender  + " " + message.timestamp + " " + str(message.length))
+        builder.segment(message.body, message.length)
+
+def encode_messages_v2(builder, messages):
+    """
+    Adds stored messages to the body of a version 2 reply: their number, then the id, sender, timestamp and text
+    fields of each one. The texts are added from their stored bodies.
+
+    Parameters
+    ----------
+    builder: ReplyBuilder
+        The reply body
+    messages: list
+        The Messages
+
+    Returns
+    -------
+    None
+    """
+    builder.raw(wire_v2.encode_fields([len(messages)]))
+    for message in messages:
+        builder.raw(wire_v2.encode_fields([message.message_id, message.sender, message.timestamp]))
+        builder.raw(wire_v2.FIELD_LENGTH.pack(len(message.body)))
+        builder.segment(message.body)
+
+def encode_push(to_sock, message):
+    """
+    Encodes the SEL push that delivers a message to a logged in user, in the codec that user's connection
+    speaks.
+
+    Parameters
+    ----------
+    to_sock: socket or asyncio.StreamWriter
+        The connection of the receiving user
+    message: Message
+        The stored message, as returned by send_message. It is not modified.
+
+    Returns
+    -------
+    bytes
+        The framed push, ready to be sent
+    """
+    encode = push_encoder(message)
+    return encode(to_sock, message.message_id)
+
+def push_encoder(message):
+    """
+    Builds an encoder for the SEL pushes of one message. The parts of the push that do not depend on the
+    receiver are encoded once per codec, the first time a receiver speaking that codec needs them, and only
+    the message id is added per receiver. The wire protocol pushes carry the stored body as it is.
+
+    Parameters
+    ----------
+    message: Message
+        The stored message. Its id is ignored, since messages sent to many receivers share their text.
+
+    Returns
+    -------
+    function
+        Takes the receiving connection and the message id, and returns the framed push in the codec that
+        connection speaks
+    """
+    tails = {}
+
+    def encode(to_sock, message_id):
+        data = connection_data(to_sock)
+        codec = data.codec if data is not None else SERVER_PROTOCOL
+        if codec not in tails:
+            if codec == "json":
+                # Same text json.dumps gives for the stored message with the push's type and success keys added
+                tails[codec] = json.dumps({"sender": message.sender, "timestamp": message.timestamp, "message": message.message})[:-1]
+            elif codec == "v2":
+                tails[codec] = wire_v2.encode_fields([message.sender, message.timestamp, message.body])
+            else:
+                # The encoded tail and the number of characters in it
+                head = " " + message.sender + " " + message.timestamp + " " + str(message.length) + " "
+                tails[codec] = (head.encode("utf-8") + message.body, len(head) + message.length)
+        if codec == "v2":
+            return wire_v2.frame("SEL", 0, wire_v2.encode_fields([message_id]) + tails[codec])
+        if codec == "json":
+            sending_data = tails[codec] + ', "messageId": ' + str(message_id) + ', "delivered": true, "type": "SEL", "success": true}'
+            sending_data = str(len(sending_data)) + sending_data
+            return sending_data.encode("utf-8")
+        tail, num_chars = tails[codec]
+        sending_data = "SEL" + str(message_id)
+        return (str(len(sending_data) + num_chars) + sending_data).encode("utf-8") + tail
+
+    return encode
+
+def encode_backlog(to_sock, messages):
+    """
+    Encodes a REB push, which carries one chunk of a user's backlog the same way RET carries the messages
+    read by RE, in the codec the user's connection speaks.
+
+    Parameters
+    ----------
+    to_sock: socket or asyncio.StreamWriter
+        The connection of the user
+    messages: list
+        The Messages of the chunk, none for the push that ends the backlog
+
+    Returns
+    -------
+    list
+        The framed push, as a list of segments
+    """
+    data = connection_data(to_sock)
+    codec = data.codec if data is not None else SERVER_PROTOCOL
+    builder = ReplyBuilder()
+    if codec == "v2":
+        encode_messages_v2(builder, messages)
+        segments = builder.finish()
+        return [wire_v2.HEADER.pack(builder.num_bytes, b"REB", 0)] + segments
+    if codec == "json":
+        builder.text('{"type": "REB", "success": true, "num_read": ' + str(len(messages)) + ', "messages": [')
+        encode_messages_json(builder, messages)
+        builder.text("]}")
+    else:
+        builder.text("REB")
+        encode_messages_wp(builder, messages)
+    segments = builder.finish()
+    return [str(builder.num_chars).encode("utf-8")] + segments
+
+def start_backlog(sock, username):
+    """
+    Starts sending a user's undelivered messages to the connection the user just logged in from.
+
+    Parameters
+    ----------
+    sock: socket or asyncio.StreamWriter
+        The connection
+    username: str
+        The username of the account that logged in
+
+    Returns
+    -------
+    None.
+
+    Notes
+    -----
+    The selector engine sends the chunks from flush_outbound, and the asyncio engine from a task of its own.
+    Either way the first chunk goes out after the reply to the login.
+    """
+    data = connection_data(sock)
+    if data is None or (data.backlog is not None and data.backlog[0] == username):
+        # Logging in again while the backlog is being sent leaves it going
+        return
+    streaming = data.backlog is not None
+    data.backlog = (username, [])
+    if not streaming and isinstance(sock, asyncio.StreamWriter):
+        data.backlog_task = asyncio.get_running_loop().create_task(stream_backlog_async(sock, data))
+
+def stream_backlog(sock, data):
+    """
+    Queues the next chunk of a connection's backlog. Called once everything queued before, including the chunk
+    before it, has left the outbound queue, so a client that reads slowly is sent the backlog as slowly.
+
+    Parameters
+    ----------
+    sock: socket or asyncio.StreamWriter
+        The connection
+    data: SimpleNamespace
+        The per-connection state, whose backlog holds the username and the ids of the chunk sent last
+
+    Returns
+    -------
+    None.
+
+    Notes
+    -----
+    The messages of a chunk are marked delivered when the next chunk is read. The backlog ends with a push
+    carrying no messages, or without one if the user logs out or is deleted first. When another worker owns the
+    account, the chunk is read there, and the requests of the connection wait for it like for a parked request,
+    see send_to_owners.
+    """
+    username, delivered_ids = data.backlog
+    if not shards.owns(username):
+        data.busy = True
+        shards.mesh.call(shards.shard_of(username), "read_backlog", [username, BACKLOG_CHUNK, delivered_ids],
+                         lambda result, error: finish_backlog_chunk(sock, data, owner_result(result, error, data)))
+        return
+    queue_backlog_chunk(sock, data, read_backlog(username, BACKLOG_CHUNK, delivered_ids))
+
+def queue_backlog_chunk(sock, data, call_info):
+    """Queues a chunk of a connection's backlog, given the return value of read_backlog, see stream_backlog."""
+    username = data.backlog[0]
+    if call_info[0] != True:
+        data.backlog = None
+        return
+    messages = call_info[1]["messages"]
+    data.backlog = (username, [message.message_id for message in messages]) if messages else None
+    queue_send(sock, encode_backlog(sock, messages), flush=False)
+
+def finish_backlog_chunk(sock, data, call_info):
+    """Queues a chunk of a connection's backlog the owner of the account read, and carries on with the connection."""
+    if connection_data(sock) is not data:
+        # The connection closed while the owner read the chunk
+        return
+    queue_backlog_chunk(sock, data, call_info)
+    resume_connection(sock, data)
+
+async def stream_backlog_async(writer, data):
+    """Sends a connection's backlog on the asyncio engine, one chunk each time the writer drained completely."""
+    # With no high-water mark, drain waits until the transport wrote out everything, like the selector engine
+    writer.transport.set_write_buffer_limits(high=0)
+    try:
+        while data.backlog is not None and not writer.is_closing():
+            await writer.drain()
+            if data.backlog is not None:
+                stream_backlog(writer, data)
+    except ConnectionError:
+        pass
+    finally:
+        data.backlog_task = None
+        if not writer.is_closing():
+            writer.transport.set_write_buffer_limits(high=MAX_OUTBOUND_BYTES)
+
+def negotiate_version(version, data):
+    """
+    Switches a connection to the requested version of the custom wire protocol.
+
+    Parameters
+    ----------
+    version: str
+        The requested version
+    data: SimpleNamespace
+        The per-connection state
+
+    Returns
+    -------
+    list
+        list[0] is True or False, and indicates if the connection switched
+        list[1] is the version on success and an error message if the version is not supported
+
+    Notes
+    -----
+    The reply is always sent in the codec the request came in, and every frame after it uses the new version,
+    so the client has to wait for the reply before sending anything else. Json connections may switch too.
+    """
+    if version not in SUPPORTED_WIRE_VERSIONS:
+        return [False, "ER5: unsupported version"]
+    data.codec = "v2" if version == "2" else "wp"
+    return [True, version]
+
+def negotiate_compression(codec, sock):
+    """
+    Turns on compression for a connection.
+
+    Parameters
+    ----------
+    codec: str
+        The requested compression codec
+    sock: socket or asyncio.StreamWriter
+        The connection that asked for it
+
+    Returns
+    -------
+    list
+        list[0] is True or False, and indicates if compression was turned on
+        list[1] is an empty string on success and an error message if the codec is not supported
+
+    Notes
+    -----
+    Clients ask for compression right after connecting. Either side may compress any frame sent after the
+    reply, see compression.py.
+    """
+    data = connection_data(sock)
+    if codec not in SUPPORTED_COMPRESSION or data is None:
+        return [False, "ER5: unsupported compression"]
+    data.compression = True
+    return [True, ""]
+
+# What carrying out a request raises when its fields are missing or of the wrong type, or name an account that does
+# not exist. The request is answered with ER0 instead of taking down the connection, or the server.
+MALFORMED_REQUEST_ERRORS = (IndexError, KeyError, TypeError, ValueError)
+
+# Message bodies made only of printable ascii other than quotes and backslashes are already valid json strings
+JSON_SAFE_BODY = re.compile(rb'[\x20\x21\x23-\x5b\x5d-\x7e]*')
+
+def encode_messages_json(builder, messages):
+    """
+    Adds stored messages to a json reply as a comma separated list of objects, the same ones Message.to_dict
+    returns.
+
+    Parameters
+    ----------
+    builder: ReplyBuilder
+        The reply
+    messages: list
+        The Messages
+
+    Returns
+    -------
+    None
+
+    Notes
+    -----
+    A body that json.dumps would return unchanged between quotes is added as a segment of its own, and only the
+    others are decoded and escaped.
+    """
+    for i, message in enumerate(messages):
+        builder.text(("{" if i == 0 else ", {") + '"sender": ' + json.dumps(message.sender) + ', "timestamp": ' + json.dumps(message.timestamp) + ', "message": ')
+        if JSON_SAFE_BODY.fullmatch(message.body):
+            builder.text('"')
+            builder.segment(message.body, message.length)
+            builder.text('"')
+        else:
+            builder.text(json.dumps(message.message))
+        builder.text(', "messageId": ' + str(message.message_id) + ', "delivered": ' + json.dumps(message.delivered) + "}")
+
+# REQUESTS
+# Every codec decodes a request frame into a Request, which process_request carries out the same way whichever
+# codec it came in, and the same codec encodes the reply from the result:
+#   type       - the 2 letter request type code
+#   request_id - the id the client tagged the request with, echoed back in the reply, or None
+#   args       - the fields of the request by the names in REQUEST_ARGS, which are also the keys of the json
+#                requests. LI also has backlog, True to be sent the undelivered messages right after the reply,
+#                and SB and SM have from_username, timestamp and items, a (to_username, message) pair for every
+#                message in request order.
+Request = namedtuple("Request", ["type", "request_id", "args"])
+
+# Field names of each request type, in the order the custom wire protocol sends them
+REQUEST_ARGS = {**wire_v2.REQUEST_FIELDS, "VE": ["version"]}
+
+class MalformedRequest(ValueError):
+    """
+    Raised by a codec for a request whose fields cannot be read. The error it was read with is its __cause__.
+
+    Attributes:
+    - request (Request): The request type and request id, as far as they could be read, so the ER0 reply still
+      answers the request. Its args are None.
+    """
+    def __init__(self, request):
+        super().__init__("malformed request")
+        self.request = request
+
+def process_request(request, sock, data):
+    """
+    Carries out a request, whichever codec it came in.
+
+    Parameters
+    ----------
+    request: Request
+        The decoded request
+    sock: socket or asyncio.StreamWriter
+        The connection the request came from
+    data: SimpleNamespace
+        The per-connection state
+
+    Returns
+    -------
+    list
+        list[0] is True or False, and indicates if the request succeeded
+        list[1] is an error message on failure. On success it is what the helper that carried out the request
+        returned, such as the messages read by RE, and the codec encodes the reply from it.
+
+    Raises
+    ------
+    Any of MALFORMED_REQUEST_ERRORS
+        If a field is of the wrong type, or names an account that does not exist
+
+    Notes
+    -----
+    In the case where a send message request is made, and the receiving user is logged in, the server will
+    send an additional message to the receiving user's socket with the new message information.
+    """
+    args = request.args
+    match request.type:
+        case "CR":
+            # create account
+            return create_account(args["username"], args["password"])
+
+        case "LI":
+            # login, see after_request for the undelivered messages the client may ask for
+            return login(args["username"], args["password"], sock)
+
+        case "LO":
+            # logout
+            return logout(args["username"])
+
+        case "LA":
+            # list accounts
+            return list_accounts()
+
+        case "VE":
+            # switch to a version of the custom wire protocol
+            return negotiate_version(args["version"], data)
+
+        case "CM":
+            # turn on compression
+            return negotiate_compression(args["codec"], sock)
+
+        case "ST":
+            # server stats
+            return [True, get_server_stats()]
+
+        case "SU":
+            # subscribe to account directory changes
+            return subscribe_directory(sock)
+
+        case "LS":
+            # search accounts
+            return search_accounts(args["prefix"], args["cursor"], args["limit"])
+
+        case "SE":
+            # send message
+            # If the receiver is logged on, we send a special message to their socket
+            # This facilitates instantaneous delivery
+            return deliver_message(args["from_username"], args["to_username"], args["message"], args["timestamp"])
+
+        case "SB" | "SM":
+            # send a batch of messages, or one message to many users, with one result per message in request order
+            return [True, deliver_batch(args["from_username"], args["items"], args["timestamp"])]
+
+        case "RE":
+            return read_message(args["username"], args["number"])
+
+        case "DM":
+            # delete message
+            return delete_message(args["username"], args["id"])
+
+        case "DA":
+            return delete_account(args["username"])
+
+    # Reserve error code ER0 for unknown request type
+    return [False, "ER0: unknown request type"]
+
+def batch_statuses(results):
+    """Returns the status of every message of an SB or SM reply, in request order: "T" or the error code."""
+    return ["T" if call_info[0] == True else call_info[1][:3] for call_info in results]
+
+# CODECS
+# A codec turns the frames of one encoding into Requests and the results of process_request into reply frames.
+# Every codec has the same methods:
+#   detect(frame)                         - whether a request frame, as its framing extracts it, is in the codec
+#   extract_frames(buf, max_decompressed) - pulls the complete request frames out of a receive buffer
+#   decode(frame)                         - the Request, or MalformedRequest
+#   encode_reply(request, call_info)      - the framed reply, as bytes or a list of segments
+#   compress_frame(payload)               - the framed bytes, compressed if that is worth it
+# and is listed in CODECS below.
+
+class WireCodec:
+    """
+    Version 1 of the custom wire protocol: length-prefixed text frames made of the 2 letter request type and
+    the fields separated by spaces. A request may start with a request id, see dispatcher.py, which the reply
+    then starts with too. Replies carry only the error code of an error.
+    """
+    def detect(self, frame):
+        # Json bodies are objects, and wire protocol bodies start with their request type, so the two never mix up
+        return isinstance(frame, str) and frame[:1] != "{"
+
+    def extract_frames(self, buf, max_decompressed):
+        return extract_frames(buf, max_decompressed)
+
+    def compress_frame(self, payload):
+        return compression.compress_frame(payload, COMPRESSION_THRESHOLD, COMPRESSION_LEVEL)
+
+    def decode(self, frame):
+        try:
+            request_id, body = dispatcher.split_request_id(frame)
+        except ValueError:
+            # Answered like a request of an unknown type
+            return Request("", None, {})
+        request_type = body[:2]
+        try:
+            args = self.decode_args(request_type, body[2:])
+        except MALFORMED_REQUEST_ERRORS as e:
+            raise MalformedRequest(Request(request_type, request_id, None)) from e
+        return Request(request_type, request_id, args)
+
+    def decode_args(self, request_type, fields):
+        match request_type:
+            case "LI":
+                # with a trailing " B" to be sent the undelivered messages right after the reply
+                username, password, *flags = fields.split(" ")
+                return {"username": username, "password": password, "backlog": flags == ["B"]}
+
+            case "LO" | "DA" | "CM" | "VE":
+                # The one field is the rest of the frame
+                return {REQUEST_ARGS[request_type][0]: fields}
+
+            case "SE":
+                # Only the message, which comes last, may contain spaces
+                from_username, to_username, timestamp, *words = fields.split(" ")
+                return {"from_username": from_username, "to_username": to_username, "timestamp": timestamp, "message": " ".join(words)}
+
+            case "SB":
+                # "from_username timestamp count" followed by " to_username length message" for every message,
+                # where length is the message's character count
+                from_username, timestamp, count, rest = fields.split(" ", 3)
+                items = []
+                for _ in range(int(count)):
+                    to_username, length, rest = rest.split(" ", 2)
+                    length = int(length)
+                    if length > len(rest):
+                        raise ValueError("message runs past the end of the frame")
+                    items.append((to_username, rest[:length]))
+                    rest = rest[length + 1:]
+                return {"from_username": from_username, "timestamp": timestamp, "items": items}
+
+            case "SM":
+                # "from_username timestamp count", the count usernames, and then the message
+                from_username, timestamp, count, rest = fields.split(" ", 3)
+                count = int(count)
+                *to_usernames, message = rest.split(" ", count)
+                if len(to_usernames) != count:
+                    raise ValueError("missing recipients")
+                return {"from_username": from_username, "timestamp": timestamp, "items": [(to_username, message) for to_username in to_usernames]}
+
+            case "CR" | "LS" | "RE" | "DM":
+                # Every field is one word, "prefix cursor limit" of LS may leave the prefix and cursor empty
+                values = fields.split(" ")
+                if len(values) != len(REQUEST_ARGS[request_type]):
+                    raise ValueError(f"expected {len(REQUEST_ARGS[request_type])} fields")
+                return dict(zip(REQUEST_ARGS[request_type], values))
+
+        return {}
+
+    def encode_reply(self, request, call_info):
+        # Echo the request id, so a client with many requests in flight can tell which one this answers
+        tag = dispatcher.tag_request("", request.request_id) if request.request_id is not None else ""
+        if call_info[0] != True:
+            # Pull just the error code out when we are using custom wire protocol
+            reply = call_info[1][:3]
+        else:
+            result = call_info[1]
+            reply = request.type + "T"
+            match request.type:
+                case "LA":
+                    reply += " ".join(result)
+                case "VE":
+                    reply += result
+                case "CM":
+                    reply += request.args["codec"]
+                case "ST":
+                    # server stats, as space separated name value pairs
+                    reply += " ".join(f"{name} {value}" for name, value in flatten_server_stats(result))
+                case "SU":
+                    # The directory version comes first, then the usernames
+                    reply += " ".join([str(result["version"])] + result["accounts"])
+                case "LS":
+                    # The next page's cursor comes first, then the usernames
+                    reply += " ".join([result["cursor"]] + result["accounts"])
+                case "SB" | "SM":
+                    reply += " ".join(batch_statuses(result))
+                case "RE":
+                    # Built around the stored message bodies instead of copying them into a string
+                    builder = ReplyBuilder()
+                    builder.text(tag + "RET")
+                    encode_messages_wp(builder, result["messages"])
+                    segments = builder.finish()
+                    return [str(builder.num_chars).encode("utf-8")] + segments
+        reply = tag + reply
+        return (str(len(reply)) + reply).encode("utf-8")
+
+class JsonCodec:
+    """
+    Length-prefixed json objects, with the request type under "type" and the fields under their names. Replies
+    carry the whole error message of an error.
+    """
+    def detect(self, frame):
+        return isinstance(frame, str) and frame[:1] == "{"
+
+    def extract_frames(self, buf, max_decompressed):
+        return extract_frames(buf, max_decompressed)
+
+    def compress_frame(self, payload):
+        return compression.compress_frame(payload, COMPRESSION_THRESHOLD, COMPRESSION_LEVEL)
+
+    def decode(self, frame):
+        body = {}
+        try:
+            body = json.loads(frame)
+            args = self.decode_args(body)
+        except MALFORMED_REQUEST_ERRORS as e:
+            raise MalformedRequest(Request(body.get("type"), body.get(dispatcher.JSON_KEY), None)) from e
+        return Request(body["type"], body.get(dispatcher.JSON_KEY), args)
+
+    def decode_args(self, body):
+        match body["type"]:
+            case "LI":
+                return {"username": body["username"], "password": body["password"], "backlog": bool(body.get("backlog"))}
+            case "SB":
+                items = [(item["to_username"], item["message"]) for item in body["messages"]]
+                return {"from_username": body["from_username"], "timestamp": body["timestamp"], "items": items}
+            case "SM":
+                items = [(to_username, body["message"]) for to_username in body["to_usernames"]]
+                return {"from_username": body["from_username"], "timestamp": body["timestamp"], "items": items}
+        return {name: body[name] for name in REQUEST_ARGS.get(body["type"], [])}
+
+    def encode_reply(self, request, call_info):
+        messages = None
+        if call_info[0] != True:
+            # Pull the entire error message for json
+            reply = {"success": False, "errorMsg": call_info[1]}
+        else:
+            result = call_info[1]
+            match request.type:
+                case "DM" | "DA":
+                    reply = {"success": True, "errorMsg": ""}
+                case "LA":
+                    reply = {"type": "LAT", "success": True, "accounts": result, "errorMsg": ""}
+                case "VE":
+                    reply = {"type": "VET", "success": True, "version": result, "errorMsg": ""}
+                case "CM":
+                    reply = {"type": "CMT", "success": True, "codec": request.args["codec"], "errorMsg": ""}
+                case "ST":
+                    reply = {"type": "STT", "success": True, "stats": result, "errorMsg": ""}
+                case "SU":
+                    reply = {"type": "SUT", "success": True, "accounts": result["accounts"], "version": result["version"], "errorMsg": ""}
+                case "LS":
+                    reply = {"type": "LST", "success": True, "accounts": result["accounts"], "cursor": result["cursor"], "errorMsg": ""}
+                case "SB" | "SM":
+                    reply = {"type": request.type + "T", "success": True, "errorMsg": "", "results": []}
+                    for item in result:
+                        if item[0] == True:
+                            reply["results"].append({"success": True, "errorMsg": "", "messageId": item[1].message_id})
+                        else:
+                            reply["results"].append({"success": False, "errorMsg": item[1]})
+                case "RE":
+                    # The messages are encoded straight from their stored bodies below
+                    reply = {"type": "RET", "num_read": result["num_read"]}
+                    messages = result["messages"]
+                case _:
+                    reply = {"type": request.type + "T", "success": True, "errorMsg": ""}
+        if request.request_id is not None:
+            reply[dispatcher.JSON_KEY] = request.request_id
+        if messages is not None:
+            # The other keys come first, then the messages, straight from their stored bodies
+            builder = ReplyBuilder()
+            builder.text(json.dumps(reply)[:-1] + ', "messages": [')
+            encode_messages_json(builder, messages)
+            builder.text("]}")
+            segments = builder.finish()
+            # Json replies are ascii, so the character count is the byte count
+            return [str(builder.num_chars).encode("utf-8")] + segments
+        reply = json.dumps(reply)
+        return (str(len(reply)) + reply).encode("utf-8")
+
+class V2Codec:
+    """
+    Version 2 of the custom wire protocol, a binary encoding, see wire_v2.py. Error replies carry the error code
+    as their opcode and the whole error message as their only field.
+    """
+    def detect(self, frame):
+        return isinstance(frame, tuple)
+
+    def extract_frames(self, buf, max_decompressed):
+        return wire_v2.extract_frames(buf, max_decompressed)
+
+    def compress_frame(self, payload):
+        return wire_v2.compress_frame(payload, COMPRESSION_THRESHOLD, COMPRESSION_LEVEL)
+
+    def decode(self, frame):
+        opcode, request_id, fields = frame
+        try:
+            args = self.decode_args(opcode, fields)
+        except MALFORMED_REQUEST_ERRORS as e:
+            raise MalformedRequest(Request(opcode, request_id, None)) from e
+        return Request(opcode, request_id, args)
+
+    def decode_args(self, opcode, fields):
+        match opcode:
+            case "LI":
+                # with a third field "B" to be sent the undelivered messages right after the reply
+                return {"username": fields[0], "password": fields[1], "backlog": fields[2:] == ["B"]}
+            case "SB":
+                if len(fields) % 2 != 0:
+                    raise ValueError("unpaired recipient")
+                return {"from_username": fields[0], "timestamp": fields[1], "items": list(zip(fields[2::2], fields[3::2]))}
+            case "SM":
+                return {"from_username": fields[0], "timestamp": fields[1], "items": [(to_username, fields[2]) for to_username in fields[3:]]}
+        names = REQUEST_ARGS.get(opcode, [])
+        if len(fields) < len(names):
+            raise IndexError(f"expected {len(names)} fields")
+        return dict(zip(names, fields))
+
+    def encode_reply(self, request, call_info):
+        if call_info[0] != True:
+            return wire_v2.encode_frame(call_info[1][:3], request.request_id, [call_info[1]])
+        result = call_info[1]
+        fields = []
+        match request.type:
+            case "LA":
+                fields = result
+            case "VE":
+                fields = [result]
+            case "CM":
+                fields = [request.args["codec"]]
+            case "ST":
+                # server stats, as alternating name and value fields
+                fields = [field for pair in flatten_server_stats(result) for field in pair]
+            case "SU":
+                fields = [result["version"]] + result["accounts"]
+            case "LS":
+                fields = [result["cursor"]] + result["accounts"]
+            case "SB" | "SM":
+                fields = batch_statuses(result)
+            case "RE":
+                builder = ReplyBuilder()
+                encode_messages_v2(builder, result["messages"])
+                segments = builder.finish()
+                return [wire_v2.HEADER.pack(builder.num_bytes, b"RET", request.request_id)] + segments
+        return wire_v2.encode_frame(request.type + "T", request.request_id, fields)
+
+# The codecs by name, in the order detect_codec tries them. A connection starts out in SERVER_PROTOCOL.
+CODECS = {"json": JsonCodec(), "wp": WireCodec(), "v2": V2Codec()}
+
+def detect_codec(frame):
+    """Returns the name of the codec a request frame is in."""
+    for name, codec in CODECS.items():
+        if codec.detect(frame):
+            return name
+    raise ValueError("frame of no known codec")
+
+def respond(in_data, sock, data):
+    """
+    Carries out a request in the codec it was sent in and frames its reply in the same codec.
+
+    Parameters
+    ----------
+    in_data: str or tuple
+        A request frame as returned by extract_requests
+    sock: socket or asyncio.StreamWriter
+        The connection the request came from
+    data: SimpleNamespace
+        The per-connection state
+
+    Returns
+    -------
+    bytes or list or None
+        The framed reply, ready to be sent. The reply to RE is a list of segments, built around the stored
+        message bodies. None if the request was parked until other workers carry it out, see send_to_owners.
+
+    Notes
+    -----
+    Every frame sets the codec of the connection, so pushes to it are encoded the way it last spoke. The reply
+    goes out in the codec the request came in, even when the request switched the connection to another one.
+    """
+    start_ns = time.perf_counter_ns()
+    data.codec = detect_codec(in_data)
+    codec = CODECS[data.codec]
+    error = None
+    try:
+        request = codec.decode(in_data)
+    except MalformedRequest as e:
+        request, error = e.request, e.__cause__
+    with state_lock:
+        if error is None:
+            try:
+                parts = split_by_owner(request)
+                if parts is not None:
+                    send_to_owners(parts, codec, request, sock, data, start_ns)
+                    return None
+                call_info = process_request(request, sock, data)
+            except MALFORMED_REQUEST_ERRORS as e:
+                error = e
+            else:
+                after_request(request, call_info, sock, data)
+        if error is not None:
+            # A malformed request only fails itself, like a request of an unknown type
+            log.warning("bad_request", addr=data.addr, error=repr(error))
+            call_info = [False, "ER0: malformed request"]
+        record_request(request.type, start_ns, call_info[0] == True)
+    return codec.encode_reply(request, call_info)
+
+def after_request(request, call_info, sock, data):
+    """
+    Does what is left to do on the connection a request came from once the request was carried out, on the
+    worker that holds the connection.
+
+    Parameters
+    ----------
+    request: Request
+        The request
+    call_info: list
+        Its result, as returned by process_request
+    sock: socket or asyncio.StreamWriter
+        The connection the request came from
+    data: SimpleNamespace
+        The per-connection state
+
+    Returns
+    -------
+    None.
+    """
+    if request.type == "LI" and call_info[0] == True:
+        username = request.args["username"]
+        if not shards.owns(username):
+            # The owner is told when this connection closes, see close_connection
+            data.remote_users.add(username)
+        # Send the undelivered messages right after the reply if the client asked for them
+        if request.args["backlog"]:
+            start_backlog(sock, username)
+
+def send_to_owners(parts, codec, request, sock, data, start_ns):
+    """
+    Parks a request while the workers that own the accounts it is about carry out their parts of it, and
+    answers it once every part is done.
+
+    Parameters
+    ----------
+    parts: list
+        The parts of the request, as returned by split_by_owner
+    codec: object
+        The codec the request came in, which encodes the reply
+    request: Request
+        The request
+    sock: socket
+        The connection the request came from
+    data: SimpleNamespace
+        The per-connection state registered with the selector
+    start_ns: int
+        When the request started, for its latency
+
+    Returns
+    -------
+    None.
+
+    Notes
+    -----
+    The connection is busy until the reply is queued, so its later requests wait in its pending queue, and its
+    replies keep the order of its requests. The share of an SB or SM this worker owns is carried out right away,
+    and a share that failed as a whole fails every message in it.
+    """
+    data.busy = True
+    conn = shards.RemoteConnection(shards.INDEX, data.conn_id)
+    batch = request.type in ("SB", "SM")
+    results = [None] * len(request.args["items"]) if batch else None
+    waiting = len(parts)
+
+    def part_done(positions, call_info):
+        nonlocal waiting
+        if batch:
+            share_results = call_info[1] if call_info[0] == True else [call_info] * len(positions)
+            for position, item_info in zip(positions, share_results):
+                results[position] = item_info
+            call_info = [True, results]
+        waiting -= 1
+        if waiting == 0:
+            finish_parked(codec, request, call_info, sock, data, start_ns)
+
+    local_parts = []
+    for worker, part, positions in parts:
+        if worker == shards.INDEX:
+            local_parts.append((part, positions))
+        else:
+            shards.mesh.call(worker, "carry_out_request", [part.type, part.args, conn],
+                             lambda result, error, positions=positions: part_done(positions, owner_result(result, error, data)))
+    # Carried out once the calls are sent, so the parts run side by side, and the reply waits for the calls even
+    # if this share raises
+    for part, positions in local_parts:
+        try:
+            call_info = process_request(part, sock, data)
+        except MALFORMED_REQUEST_ERRORS as e:
+            call_info = owner_result(None, e, data)
+        part_done(positions, call_info)
+
+def finish_parked(codec, request, call_info, sock, data, start_ns):
+    """
+    Answers a request parked by send_to_owners once every part of it is done, and carries on with the connection.
+
+    Parameters
+    ----------
+    codec: object
+        The codec the request came in
+    request: Request
+        The request
+    call_info: list
+        Its result, as process_request would have returned it
+    sock: socket
+        The connection the request came from
+    data: SimpleNamespace
+        The per-connection state registered with the selector
+    start_ns: int
+        When the request started, for its latency
+
+    Returns
+    -------
+    None.
+    """
+    record_request(request.type, start_ns, call_info[0] == True)
+    if connection_data(sock) is not data:
+        # The connection closed while the owner carried out the request, so a login the owner made on it is
+        # undone as close_connection would have
+        if request.type == "LI" and call_info[0] == True:
+            username = request.args["username"]
+            shards.mesh.notify(shards.shard_of(username), {"op": "closed", "username": username, "conn_id": data.conn_id})
+        return
+    after_request(request, call_info, sock, data)
+    queue_send(sock, codec.encode_reply(request, call_info), flush=False)
+    resume_connection(sock, data)
+
+def resume_connection(sock, data):
+    """Carries on with the pending requests of a connection that waited for another worker, and sends what it can."""
+    data.busy = False
+    serve_pending(sock, data)
+    flush_outbound(sock, data)
+
+def serve_pending(sock, data):
+    """
+    Carries out the requests that arrived on a connection in order, and queues their replies, until one of them
+    is parked, or hands them to the request pool one at a time.
+
+    Parameters
+    ----------
+    sock: socket
+        The client socket
+    data: SimpleNamespace
+        The per-connection state registered with the selector
+
+    Returns
+    -------
+    None.
+    """
+    if request_pool is not None:
+        start_request(sock, data)
+        return
+    while data.pending and not data.busy:
+        payload = respond(data.pending.popleft(), sock, data)
+        if payload is not None:
+            queue_send(sock, payload, flush=False)
+
+def service_connection(key, mask):
+    """
+    Services a connection from a client.
+
+    Parameters
+    ----------
+    key: namedtuple
+    mask: selectors.EVENT_READ / selectors.EVENT_WRITE
+
+    Returns
+    -------
+    None.
+
+    Notes
+    -----
+    Every complete request that has arrived is answered in its own codec, so several pipelined requests can be
+    handled in one read, while a partial request stays buffered until the rest of it arrives.
+    Though this function does not return, the server will always send some kind of response to the client.
+    """
+    sock = key.fileobj
+    data = key.data
+    if mask & selectors.EVENT_READ:
+        frames = receive_frames(sock, data)
+        if frames is None:
+            return
+        data.pending.extend(frames)
+        serve_pending(sock, data)
+        flush_outbound(sock, data)
+
+    if mask & selectors.EVENT_WRITE:
+        flush_outbound(sock, data)
+
+def start_request(sock, data):
+    """
+    Hands the next request of a connection to the request pool, unless one of its requests is already there.
+
+    Parameters
+    ----------
+    sock: socket
+        The client socket
+    data: SimpleNamespace
+        The per-connection state registered with the selector
+
+    Returns
+    -------
+    None.
+    """
+    if data.busy or not data.pending:
+        return
+    data.busy = True
+    request_pool.submit(run_request, sock, data, data.pending.popleft())
+
+def run_request(sock, data, in_data):
+    """
+    Carries out a request on a thread of the request pool, and queues its reply.
+
+    Parameters
+    ----------
+    sock: socket
+        The client socket
+    data: SimpleNamespace
+        The per-connection state registered with the selector
+    in_data: str or tuple
+        A request frame as returned by extract_requests
+
+    Returns
+    -------
+    None.
+
+    Notes
+    -----
+    Only respond and queue_send take state_lock, so the reply is compressed without it. The connection may have
+    been closed while the request ran, in which case the reply is dropped. A parked request keeps the connection
+    busy until finish_parked answers it on the select loop.
+    """
+    try:
+        payload = respond(in_data, sock, data)
+        if payload is not None and data.compression:
+            payload = compress_outbound(b"".join(payload) if isinstance(payload, list) else payload, data)
+    except Exception as e:
+        # The loop would have stopped the server, a pool thread only drops the connection
+        log.error("request_failed", addr=data.addr, error=repr(e))
+        with state_lock:
+            if connection_data(sock) is data:
+                close_connection(sock, data)
+        return
+    with state_lock:
+        if payload is not None and connection_data(sock) is data:
+            queue_send(sock, payload, compress=False)
+            data.busy = False
+            start_request(sock, data)
+            if connection_data(sock) is data:
+                update_interest(sock, data)
+    # The select loop may be waiting on interest that changed since it went to sleep, or on a call to another
+    # worker it has yet to send
+    try:
+        wakeup_writer.send(b"\0")
+    except BlockingIOError:
+        # Enough wakeups are already waiting
+        pass
+
+# ASYNCIO ENGINE
+async def handle_async_client(reader, writer):
+    """
+    Services a connection from a client on the asyncio engine.
+
+    Parameters
+    ----------
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+
+    Returns
+    -------
+    None.
+
+    Notes
+    -----
+    Requests are handled by the same helpers as the selector engine, with the StreamWriter standing in
+    for the socket. After each read the handler waits for the writer to drain, so a client that does
+    not read its replies is not read from until its buffer drops below MAX_OUTBOUND_BYTES.
+    """
+    addr = writer.get_extra_info("peername") or transport.UNIX_PREFIX + UNIX_SOCKET
+    if connection_count() >= MAX_CONNECTIONS:
+        connection_stats["rejected_connections"] += 1
+        log.warning("connection_rejected", addr=addr, connections=connection_count())
+        writer.close()
+        return
+    log.info("connection_accepted", addr=addr)
+    writer.transport.set_write_buffer_limits(high=MAX_OUTBOUND_BYTES)
+    data = types.SimpleNamespace(addr=addr, inb=bytearray(), user=b"", codec=SERVER_PROTOCOL, compression=False, last_active=time.monotonic(), backlog=None, backlog_task=None)
+    async_connections[writer] = data
+    watch_idle(writer, data)
+    try:
+        while True:
+            recv_data = await reader.read(RECV_CHUNK_SIZE)
+            if not recv_data:
+                break
+            traffic_stats["bytes_in"] += len(recv_data)
+            data.last_active = time.monotonic()
+            data.inb += recv_data
+            for in_data in extract_requests(data):
+                queue_send(writer, respond(in_data, writer, data))
+            snapshot_if_due()
+            await writer.drain()
+    except ValueError as e:
+        log.warning("bad_frame", addr=addr, error=str(e))
+    except ConnectionError:
+        pass
+    finally:
+        log.info("connection_closed", addr=addr)
+        async_connections.pop(writer, None)
+        directory_subscribers.discard(writer)
+        writer.close()
+
+async def serve_asyncio(host, port):
+    """
+    Runs the server on an asyncio event loop until it is cancelled.
+
+    Parameters
+    ----------
+    host: str
+        The interface to listen on
+    port: int
+        The port to listen on
+
+    Returns
+    -------
+    None.
+    """
+    # Listening on the Unix domain socket first, so once the TCP port takes connections both do
+    unix_server = await asyncio.start_unix_server(handle_async_client, sock=listen_unix()) if UNIX_SOCKET else None
+    server = await asyncio.start_server(handle_async_client, host, port, backlog=LISTEN_BACKLOG)
+    log.info("listening", host=host, port=port)
+    if timers_enabled():
+        # Held on to so the task is not garbage collected
+        ticker = asyncio.create_task(run_timers_async())
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if unix_server is not None:
+            unix_server.close()
+
+def listen_unix():
+    """
+    Returns the listening socket at UNIX_SOCKET, which is made the first time.
+
+    Notes
+    -----
+    A Unix domain socket path can only be bound once, so SO_REUSEPORT cannot spread its connections like the
+    TCP port's. With several workers the supervisor makes it before forking, and every worker accepts from it.
+    """
+    global unix_listener, unix_listener_pid
+    if unix_listener is None:
+        unix_listener = transport.listen_unix(UNIX_SOCKET, LISTEN_BACKLOG)
+        unix_listener_pid = os.getpid()
+        log.info("listening", path=UNIX_SOCKET)
+    return unix_listener
+
+def close_unix_listener():
+    """Closes the listening socket at UNIX_SOCKET, and removes its path if this process made it."""
+    global unix_listener
+    if unix_listener is None:
+        return
+    unix_listener.close()
+    unix_listener = None
+    if unix_listener_pid == os.getpid() and os.path.exists(UNIX_SOCKET):
+        os.remove(UNIX_SOCKET)
+
+async def run_timers_async():
+    """Runs the timers once per tick for the asyncio engine, see run_timers."""
+    while True:
+        await asyncio.sleep(idle_timers.time_to_next_tick(time.monotonic()))
+        run_timers(time.monotonic())
+        snapshot_if_due()
+
+def serve_selector(host, port):
+    """
+    Runs the server on the selector loop until it is interrupted.
+
+    Parameters
+    ----------
+    host: str
+        The interface to listen on
+    port: int
+        The port to listen on
+
+    Returns
+    -------
+    None.
+    """
+    global request_pool, wakeup_writer
+    if UNIX_SOCKET:
+        # Listening on the Unix domain socket first, so once the TCP port takes connections both do
+        sel.register(listen_unix(), selectors.EVENT_READ, data=None)
+    lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if shards.WORKERS > 1:
+        # Every worker listens on the port, and the kernel spreads the connections across them
+        lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    lsock.bind((host, port))
+    lsock.listen(LISTEN_BACKLOG)
+    log.info("listening", host=host, port=port)
+    lsock.setblocking(False)
+    sel.register(lsock, selectors.EVENT_READ, data=None)
+    if REQUEST_THREADS > 0:
+        request_pool = ThreadPoolExecutor(REQUEST_THREADS, thread_name_prefix="request")
+        wakeup_reader, wakeup_writer = socket.socketpair()
+        wakeup_reader.setblocking(False)
+        wakeup_writer.setblocking(False)
+        sel.register(wakeup_reader, selectors.EVENT_READ, data="wakeup")
+        log.info("request_pool_started", threads=REQUEST_THREADS)
+
+    while True:
+        # Wake up for the next timer tick or for the next call to another worker to time out, or only for socket
+        # events if there is neither
+        now = time.monotonic()
+        timeout = idle_timers.time_to_next_tick(now) if timers_enabled() else None
+        if shards.mesh is not None and shards.mesh.calls:
+            deadline = shards.mesh.time_to_next_deadline(now)
+            timeout = deadline if timeout is None else min(timeout, deadline)
+        events = sel.select(timeout=timeout)
+        with state_lock:
+            service_events(events)
+            if shards.mesh is not None:
+                shards.mesh.expire_calls(time.monotonic())
+            if timers_enabled():
+                run_timers(time.monotonic())
+            snapshot_if_due()
+
+def service_events(events):
+    """
+    Services the events returned by one select() on the selector engine, with state_lock held.
+
+    Parameters
+    ----------
+    events: list
+        The (key, mask) pairs select() returned
+
+    Returns
+    -------
+    None.
+
+    Notes
+    -----
+    Servicing one event can close another connection of the same batch, such as a client that a push to failed,
+    so the events of connections that are no longer registered are skipped.
+    """
+    for key, mask in events:
+        if key.data is None:
+            accept_wrapper(key.fileobj)
+        elif key.data == "wakeup":
+            try:
+                key.fileobj.recv(RECV_CHUNK_SIZE)
+            except BlockingIOError:
+                pass
+        elif isinstance(key.data, shards.Channel):
+            shards.mesh.service(key.data, mask)
+        elif connection_data(key.fileobj) is key.data:
+            service_connection(key, mask)
+
+# The functions other workers call on the worker that owns an account, see send_to_owners and stream_backlog
+SHARD_FUNCTIONS = {function.__name__: function for function in (carry_out_request, read_backlog)}
+
+def run_server(host, port):
+    """
+    Restores the journal and runs the server on the configured engine until it is interrupted.
+
+    Parameters
+    ----------
+    host: str
+        The interface to listen on
+    port: int
+        The port to listen on
+
+    Returns
+    -------
+    None.
+    """
+    if JOURNAL_DIR:
+        # Every worker journals the accounts it owns in a directory of its own
+        open_journal(JOURNAL_DIR if shards.WORKERS == 1 else os.path.join(JOURNAL_DIR, f"shard-{shards.INDEX}"))
+    if shards.mesh is not None:
+        # Every worker lists every account in its directory, whichever worker owns it
+        shards.mesh.broadcast({"op": "accounts", "usernames": list(accounts)})
+
+    try:
+        if SERVER_ENGINE == "asyncio":
+            asyncio.run(serve_asyncio(host, port))
+        else:
+            serve_selector(host, port)
+    except KeyboardInterrupt:
+        log.info("interrupted")
+    finally:
+        log.info("server_closing", stats=get_server_stats())
+        sel.close()
+        close_unix_listener()
+        if journal is not None:
+            journal.close()
+
+def run_worker(host, port):
+    """
+    Runs one worker of a multi-process server, in the process shards.spawn forked for it.
+
+    Parameters
+    ----------
+    host: str
+        The interface to listen on
+    port: int
+        The port to listen on
+
+    Returns
+    -------
+    None.
+    """
+    global sel
+    # The selector made at import is shared with the supervisor and every other worker after the fork
+    sel = selectors.DefaultSelector()
+    shards.mesh.serve(sel, SHARD_FUNCTIONS, handle_shard_message)
+    log.info("worker_started", worker=shards.INDEX, workers=shards.WORKERS, pid=os.getpid())
+    run_server(host, port)
+
+if __name__ == "__main__":
+    # UNCOMMENT HOST AND PORT BELOW FOR LOCAL UNIT TESTING
+    # HOST = os.environ.get("HOST_SERVER_TESTING")
+    # PORT = int(os.environ.get("PORT_SERVER_TESTING"))
+
+    # HOST AND PORT FOR MULTIPLE COMPUTERS
+    # server has 0.0.0.0 to listen on all interfaces
+    HOST = os.environ.get("SERVER_IP")
+    PORT = int(os.environ.get("PORT_SERVER"))
+
+    if shards.WORKERS > 1:
+        if SERVER_ENGINE == "asyncio":
+            sys.exit("WORKERS > 1 needs the selector engine")
+        if UNIX_SOCKET:
+            # Made before forking, so every worker accepts from the same socket
+            listen_unix()
+        shards.spawn(lambda: run_worker(HOST, PORT))
+        close_unix_listener()
+    else:
+        run_server(HOST, PORT)
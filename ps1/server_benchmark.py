@@ -0,0 +1,365 @@
+"""
+Benchmarks the ps1 server under different configurations: the selector engine in its "legacy" and
+"interest" selector modes, and the asyncio engine.
+
+For every configuration a fresh server process is started and two things are measured:
+- the CPU the server uses while clients are connected but not sending anything
+- the per-request latency of SE requests while several clients send at the same time
+
+It then compares the codecs a connection can speak (json, the wp text wire protocol and its binary version
+2) on the same mix of requests, measuring latency, throughput and the bytes each request and its reply take
+on the wire.
+
+It also compares loopback TCP with the server's Unix domain socket, on the same mix of requests, and reports the
+latency and throughput gained by clients on the same host.
+
+Last it measures the memory the server holds for each stored message, in this process.
+"""
+import argparse
+import json
+import os
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from framing import extract_frames
+import messagestore
+import eventlog
+import wire_v2
+import transport
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+TIMESTAMP = "2025-02-14-00:00:00"
+
+# Environment overrides that select each server configuration
+CONFIGS = {
+    "legacy": {"SERVER_ENGINE": "selector", "SELECTOR_MODE": "legacy"},
+    "interest": {"SERVER_ENGINE": "selector", "SELECTOR_MODE": "interest"},
+    "asyncio": {"SERVER_ENGINE": "asyncio"},
+}
+
+CODECS = ["json", "wp", "v2"]
+TRANSPORTS = ["tcp", "unix"]
+# Requests each client of the codec benchmark sends, in order, over and over. They are written in the wp text
+# form and translated for the other codecs. Clients send to an account that is never logged in, so no pushes
+# are mixed in with the replies.
+OPCODE_MIX = [
+    "SE{user} bench_sink {timestamp} load message {n}",
+    "SE{user} bench_sink {timestamp} another load message {n}",
+    "REbench_sink 5",
+    "LSbench_ {cursor} 10",
+]
+
+class BenchClient:
+    """
+    Minimal blocking client used to drive the server. Requests are given in the wp text form, and sent in
+    the client's codec: "wp", "json" or "v2". Replies are returned as the codec decodes them. The host may be a
+    "unix:" address, see transport.py.
+    """
+    def __init__(self, host, port, codec="wp"):
+        self.sock = transport.connect(host, port)
+        self.codec = "wp"
+        self.inb = bytearray()
+        self.frames = []
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        if codec == "v2":
+            if self.request("VE2") != "VET2":
+                raise RuntimeError("server does not speak wire protocol version 2")
+        self.codec = codec
+
+    def request(self, body):
+        """Sends one request and waits for its reply."""
+        if self.codec == "v2":
+            opcode, fields = wire_v2.v1_request_fields(body)
+            payload = wire_v2.encode_frame(opcode, 1, fields)
+        else:
+            if self.codec == "json":
+                opcode, fields = wire_v2.v1_request_fields(body)
+                body = json.dumps(dict(zip(wire_v2.REQUEST_FIELDS[opcode], fields), type=opcode))
+            payload = (str(len(body)) + body).encode("utf-8")
+        self.sock.sendall(payload)
+        self.bytes_sent += len(payload)
+        return self.read_frame()
+
+    def read_frame(self):
+        """Returns the next complete frame sent by the server."""
+        while not self.frames:
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise ConnectionError("server closed the connection")
+            self.bytes_received += len(chunk)
+            self.inb += chunk
+            if self.codec == "v2":
+                self.frames.extend(wire_v2.extract_frames(self.inb))
+            elif self.codec == "json":
+                self.frames.extend(json.loads(frame) for frame in extract_frames(self.inb))
+            else:
+                self.frames.extend(extract_frames(self.inb))
+        return self.frames.pop(0)
+
+    def close(self):
+        self.sock.close()
+
+def free_port(host):
+    """Asks the OS for a port nobody is listening on."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+
+def start_server(host, port, env_overrides):
+    """Starts server.py in a child process and waits until it accepts connections."""
+    env = dict(os.environ, SERVER_IP=host, PORT_SERVER=str(port), **env_overrides)
+    proc = subprocess.Popen([sys.executable, "server.py"], cwd=SERVER_DIR, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=0.5).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("server did not start")
+
+def stop_server(proc):
+    """Stops a server started by start_server and returns the CPU seconds it used."""
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    proc.terminate()
+    proc.wait()
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+
+def measure_idle_cpu(host, env_overrides, idle_clients, idle_seconds):
+    """
+    Returns the percentage of one core the server uses with idle_clients connected clients and no traffic.
+    The CPU used to start the server is measured separately and subtracted.
+    """
+    port = free_port(host)
+    startup_cpu = stop_server(start_server(host, port, env_overrides))
+
+    port = free_port(host)
+    proc = start_server(host, port, env_overrides)
+    clients = [BenchClient(host, port) for _ in range(idle_clients)]
+    time.sleep(idle_seconds)
+    for client in clients:
+        client.close()
+    cpu = stop_server(proc)
+    return max(cpu - startup_cpu, 0.0) / idle_seconds * 100
+
+def measure_load_latency(host, env_overrides, num_clients, num_requests):
+    """
+    Has num_clients clients each send num_requests messages to an offline user, one request at a time.
+
+    Returns the list of per-request latencies in milliseconds and the overall requests per second.
+    """
+    port = free_port(host)
+    proc = start_server(host, port, env_overrides)
+    try:
+        setup = BenchClient(host, port)
+        setup.request("CRbench_sink sinkpass")
+        setup.close()
+
+        latencies = []
+        lock = threading.Lock()
+
+        def run_client(i):
+            client = BenchClient(host, port)
+            client.request(f"CRbench_{i} pass{i}")
+            client.request(f"LIbench_{i} pass{i}")
+            own = []
+            for n in range(num_requests):
+                start = time.perf_counter()
+                client.request(f"SEbench_{i} bench_sink {TIMESTAMP} load message {n}")
+                own.append((time.perf_counter() - start) * 1000)
+            client.close()
+            with lock:
+                latencies.extend(own)
+
+        threads = [threading.Thread(target=run_client, args=(i,)) for i in range(num_clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        stop_server(proc)
+    return latencies, len(latencies) / elapsed
+
+def measure_codec_mix(host, env_overrides, codec, num_clients, num_requests, client_host=None):
+    """
+    Has num_clients clients speaking codec each send num_requests requests of OPCODE_MIX, one at a time. The
+    clients connect to client_host, such as the "unix:" address of the server, or else to the server's host.
+
+    Returns the list of per-request latencies in milliseconds, the overall requests per second, and the mean
+    bytes a request and its reply take on the wire.
+    """
+    port = free_port(host)
+    proc = start_server(host, port, env_overrides)
+    client_host = client_host or host
+    try:
+        setup = BenchClient(client_host, port, codec)
+        setup.request("CRbench_sink sinkpass")
+        setup.close()
+
+        latencies = []
+        wire_bytes = []
+        lock = threading.Lock()
+
+        def run_client(i):
+            client = BenchClient(client_host, port, codec)
+            client.request(f"CRbench_{i} pass{i}")
+            client.request(f"LIbench_{i} pass{i}")
+            sent, received = client.bytes_sent, client.bytes_received
+            own = []
+            for n in range(num_requests):
+                body = OPCODE_MIX[n % len(OPCODE_MIX)].format(user=f"bench_{i}", timestamp=TIMESTAMP, n=n, cursor="")
+                start = time.perf_counter()
+                client.request(body)
+                own.append((time.perf_counter() - start) * 1000)
+            own_bytes = client.bytes_sent - sent + client.bytes_received - received
+            client.close()
+            with lock:
+                latencies.extend(own)
+                wire_bytes.append(own_bytes)
+
+        threads = [threading.Thread(target=run_client, args=(i,)) for i in range(num_clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        stop_server(proc)
+    return latencies, len(latencies) / elapsed, sum(wire_bytes) / len(latencies)
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def run_benchmark(host, configs, idle_clients, idle_seconds, num_clients, num_requests):
+    results = []
+    for config in configs:
+        print(f"\n--- Benchmarking {config} ---")
+        env_overrides = dict(CONFIGS[config], SERVER_PROTOCOL="wp")
+        idle_cpu = measure_idle_cpu(host, env_overrides, idle_clients, idle_seconds)
+        latencies, throughput = measure_load_latency(host, env_overrides, num_clients, num_requests)
+        results.append({
+            "config": config,
+            "idle_cpu_percent": idle_cpu,
+            "mean_latency_ms": statistics.mean(latencies),
+            "p50_latency_ms": percentile(latencies, 50),
+            "p99_latency_ms": percentile(latencies, 99),
+            "requests_per_second": throughput,
+        })
+
+    print("\n===== SERVER BENCHMARK RESULTS =====")
+    print(f"{'Config':<12} {'Idle CPU %':<12} {'Mean (ms)':<12} {'p50 (ms)':<12} {'p99 (ms)':<12} {'Req/s':<10}")
+    print("-" * 72)
+    for r in results:
+        print(f"{r['config']:<12} {r['idle_cpu_percent']:<12.1f} {r['mean_latency_ms']:<12.3f} "
+              f"{r['p50_latency_ms']:<12.3f} {r['p99_latency_ms']:<12.3f} {r['requests_per_second']:<10.0f}")
+    return results
+
+def run_codec_benchmark(host, codecs, num_clients, num_requests):
+    results = []
+    for codec in codecs:
+        print(f"\n--- Benchmarking the {codec} codec ---")
+        latencies, throughput, bytes_per_request = measure_codec_mix(host, CONFIGS["interest"], codec, num_clients, num_requests)
+        results.append({
+            "codec": codec,
+            "mean_latency_ms": statistics.mean(latencies),
+            "p50_latency_ms": percentile(latencies, 50),
+            "p99_latency_ms": percentile(latencies, 99),
+            "requests_per_second": throughput,
+            "bytes_per_request": bytes_per_request,
+        })
+
+    print("\n===== CODEC BENCHMARK RESULTS =====")
+    print(f"{'Codec':<12} {'Mean (ms)':<12} {'p50 (ms)':<12} {'p99 (ms)':<12} {'Req/s':<10} {'Bytes/req':<10}")
+    print("-" * 70)
+    for r in results:
+        print(f"{r['codec']:<12} {r['mean_latency_ms']:<12.3f} {r['p50_latency_ms']:<12.3f} "
+              f"{r['p99_latency_ms']:<12.3f} {r['requests_per_second']:<10.0f} {r['bytes_per_request']:<10.1f}")
+    return results
+
+def run_transport_benchmark(host, transports, codec, num_clients, num_requests):
+    """Runs the request mix over loopback TCP and over the server's Unix domain socket, and reports the difference."""
+    results = []
+    with tempfile.TemporaryDirectory(prefix="ps1-bench-") as directory:
+        for name in transports:
+            print(f"\n--- Benchmarking the {name} transport ---")
+            env_overrides = dict(CONFIGS["interest"])
+            client_host = None
+            if name == "unix":
+                env_overrides["UNIX_SOCKET"] = os.path.join(directory, "server.sock")
+                client_host = transport.UNIX_PREFIX + env_overrides["UNIX_SOCKET"]
+            latencies, throughput, _ = measure_codec_mix(host, env_overrides, codec, num_clients, num_requests, client_host)
+            results.append({
+                "transport": name,
+                "mean_latency_ms": statistics.mean(latencies),
+                "p50_latency_ms": percentile(latencies, 50),
+                "p99_latency_ms": percentile(latencies, 99),
+                "requests_per_second": throughput,
+            })
+
+    print("\n===== TRANSPORT BENCHMARK RESULTS =====")
+    print(f"{'Transport':<12} {'Mean (ms)':<12} {'p50 (ms)':<12} {'p99 (ms)':<12} {'Req/s':<10}")
+    print("-" * 60)
+    for r in results:
+        print(f"{r['transport']:<12} {r['mean_latency_ms']:<12.3f} {r['p50_latency_ms']:<12.3f} "
+              f"{r['p99_latency_ms']:<12.3f} {r['requests_per_second']:<10.0f}")
+    by_name = {r["transport"]: r for r in results}
+    if "tcp" in by_name and "unix" in by_name:
+        tcp, unix = by_name["tcp"], by_name["unix"]
+        print(f"Unix socket vs TCP: mean latency {(unix['mean_latency_ms'] / tcp['mean_latency_ms'] - 1) * 100:+.1f}%, "
+              f"p99 latency {(unix['p99_latency_ms'] / tcp['p99_latency_ms'] - 1) * 100:+.1f}%, "
+              f"throughput {(unix['requests_per_second'] / tcp['requests_per_second'] - 1) * 100:+.1f}%")
+    return results
+
+def run_memory_benchmark(num_messages):
+    """Sends num_messages to an account that is logged out, so they stay in its mailbox, and reports the bytes each one takes."""
+    if num_messages <= 0:
+        return None
+    # Imported only here, since importing the server sets it up in this process, which the other benchmarks
+    # start as a child process instead
+    import server
+    # Log records waiting in the log queue would be counted as message memory
+    server.log.event_log.level = eventlog.LEVELS["error"]
+    server.create_account("sender", "password")
+    server.create_account("receiver", "password")
+    bytes_per_message = messagestore.measure_bytes_per_message(
+        lambda sender, time, message: server.send_message(sender, "receiver", message, time), num_messages)
+
+    print("\n===== MEMORY BENCHMARK RESULTS =====")
+    print(f"Stored messages: {num_messages}")
+    print(f"Bytes/message:   {bytes_per_message:.1f}")
+    return bytes_per_message
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare idle CPU and request latency across server configurations")
+    parser.add_argument("--host", default="127.0.0.1", help="Interface to run the benchmark servers on")
+    parser.add_argument("--configs", nargs="+", default=list(CONFIGS), choices=list(CONFIGS),
+                        help="Server configurations to compare")
+    parser.add_argument("--idle-clients", type=int, default=10, help="Connected clients during the idle phase")
+    parser.add_argument("--idle-seconds", type=float, default=3.0, help="Length of the idle phase")
+    parser.add_argument("--clients", type=int, default=8, help="Concurrent clients during the load phase")
+    parser.add_argument("--requests", type=int, default=500, help="Requests sent by each client during the load phase")
+    parser.add_argument("--codecs", nargs="*", default=CODECS, choices=CODECS,
+                        help="Codecs to compare on the same request mix (none to skip)")
+    parser.add_argument("--transports", nargs="*", default=TRANSPORTS, choices=TRANSPORTS,
+                        help="Transports to compare on the same request mix, in the wp codec (none to skip)")
+    parser.add_argument("--memory-messages", type=int, default=100000,
+                        help="Messages to store when measuring memory per message (0 to skip)")
+    args = parser.parse_args()
+    run_benchmark(args.host, args.configs, args.idle_clients, args.idle_seconds, args.clients, args.requests)
+    run_codec_benchmark(args.host, args.codecs, args.clients, args.requests)
+    run_transport_benchmark(args.host, args.transports, "wp", args.clients, args.requests)
+    run_memory_benchmark(args.memory_messages)
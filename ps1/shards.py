@@ -0,0 +1,349 @@
+# Multi-process serving with one owner per account
+#
+# With WORKERS > 1 the server runs as that many worker processes, forked from one supervisor. Every worker
+# listens on the same port with SO_REUSEPORT, so the kernel spreads incoming connections across them, and
+# every account, with its mailbox, is owned by one worker, picked by a hash of the username that every worker
+# computes the same way. A request about an account that reaches another worker is carried out by the owner:
+# the worker that read the request parks it, calls the owner over a local socket, and answers the request once
+# the result arrives, serving its other connections meanwhile. So each mailbox is only ever changed by one
+# process, and send_message and read_message keep the semantics they have with a single process.
+#
+# Every pair of workers shares a socketpair, which carries length-prefixed json messages:
+#   {"op": "call", "id": ..., "function": ..., "args": [...]}  - run a function on the owner, which answers with
+#   {"op": "result", "id": ..., "result": ...}
+#   anything else is a notification, handed to the server without an answer, such as a change of the account
+#   directory, or a message the owner pushes to a user whose connection another worker holds
+# No worker ever waits for another, so two workers calling each other cannot deadlock. A call that gets no result
+# within CALL_TIMEOUT seconds fails with TimeoutError, and a result that arrives after that is dropped.
+
+import builtins
+import json
+import os
+import selectors
+import signal
+import socket
+import struct
+import sys
+import time
+import zlib
+from collections import namedtuple
+
+from messagestore import Message
+from outbound import OutboundQueue
+
+# Number of worker processes. 1 runs the server in a single process, without any of this.
+WORKERS = int(os.environ.get("WORKERS", 1))
+# Index of this worker, from 0 to WORKERS - 1
+INDEX = 0
+# The Mesh of this worker, once it was forked
+mesh = None
+# Seconds a worker waits for the result of a call before the call fails
+CALL_TIMEOUT = float(os.environ.get("WORKER_CALL_TIMEOUT", 5))
+
+FRAME_LENGTH = struct.Struct("!I")
+RECV_CHUNK_SIZE = 65536
+
+# A connection to a logged in user held by another worker, which the owner of the account pushes to over IPC
+RemoteConnection = namedtuple("RemoteConnection", ["worker", "conn_id"])
+
+def shard_of(username):
+    """Returns the index of the worker that owns an account. Python's hash() differs between processes, crc32 does not."""
+    return zlib.crc32(username.encode("utf-8")) % WORKERS
+
+def owns(username):
+    """Returns whether this worker owns an account, which it always does in a single process."""
+    return WORKERS == 1 or shard_of(username) == INDEX
+
+def encode_value(value):
+    """
+    Encodes the values json does not know for an IPC message: Messages, anywhere in the message. json sends a
+    RemoteConnection as a list without asking, so encode turns the ones passed as call arguments into
+    {"$connection": ...} itself, and a RemoteConnection anywhere else arrives as a list.
+    """
+    if isinstance(value, Message):
+        return {"$message": [value.message_id, value.sender, value.timestamp, value.message, value.delivered]}
+    raise TypeError(f"cannot send {type(value).__name__} to another worker")
+
+def decode_value(value):
+    """Decodes what encode_value encoded."""
+    if "$message" in value:
+        return Message(*value["$message"])
+    if "$connection" in value:
+        return RemoteConnection(*value["$connection"])
+    return value
+
+def encode(message):
+    """Frames an IPC message."""
+    # RemoteConnection is a tuple, which json would send as a list without asking encode_value, so the top-level
+    # call arguments are encoded here
+    if "args" in message:
+        message = {**message, "args": [{"$connection": list(arg)} if isinstance(arg, RemoteConnection) else arg for arg in message["args"]]}
+    body = json.dumps(message, default=encode_value).encode("utf-8")
+    return FRAME_LENGTH.pack(len(body)) + body
+
+class Channel:
+    """
+    One end of the socketpair between this worker and another.
+
+    Attributes:
+    - worker (int): The index of the worker at the other end.
+    - sock (socket): The non-blocking socket.
+    - inb (bytearray): Bytes received that do not make up a whole message yet.
+    - outb (OutboundQueue): Messages waiting to be sent.
+    """
+    def __init__(self, worker, sock):
+        self.worker = worker
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.inb = bytearray()
+        self.outb = OutboundQueue()
+
+    def flush(self):
+        """Sends as much of the queued messages as the socket takes without blocking."""
+        try:
+            while self.outb:
+                self.outb.send(self.sock)
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def receive(self):
+        """
+        Reads what arrived and returns the whole messages in it, decoded.
+
+        Raises
+        ------
+        ConnectionError
+            If the other worker went away
+        """
+        try:
+            data = self.sock.recv(RECV_CHUNK_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return []
+        if not data:
+            raise ConnectionError(f"worker {self.worker} went away")
+        self.inb += data
+        messages = []
+        pos = 0
+        while len(self.inb) - pos >= FRAME_LENGTH.size:
+            (length,) = FRAME_LENGTH.unpack_from(self.inb, pos)
+            end = pos + FRAME_LENGTH.size + length
+            if end > len(self.inb):
+                break
+            messages.append(json.loads(self.inb[pos + FRAME_LENGTH.size:end], object_hook=decode_value))
+            pos = end
+        del self.inb[:pos]
+        return messages
+
+class Mesh:
+    """
+    The channels from this worker to every other worker.
+
+    Attributes:
+    - index (int): The index of this worker.
+    - channels (dict): Maps the index of every other worker to the Channel to it.
+    - functions (dict): Maps the name of every function other workers may call to the function.
+    - handle (function): Called with the index of the sending worker and the message for every notification.
+    - stats (dict): calls_sent and calls_served, the calls made to and answered for other workers,
+      call_timeouts, the calls made that got no result in time, and notifications_sent.
+    - calls (dict): Maps the id of every call of this worker that waits for its result to the function to call
+      with it and the monotonic time it times out at. Every call waits as long, so they time out in id order.
+    """
+    def __init__(self, index, channels):
+        self.index = index
+        self.channels = channels
+        self.functions = {}
+        self.handle = None
+        self.selector = None
+        self.next_call_id = 0
+        self.stats = {"calls_sent": 0, "calls_served": 0, "call_timeouts": 0, "notifications_sent": 0}
+        self.calls = {}
+
+    def serve(self, selector, functions, handle):
+        """Registers the channels with the server's selector, and starts answering calls and notifications."""
+        self.selector = selector
+        self.functions = functions
+        self.handle = handle
+        for channel in self.channels.values():
+            selector.register(channel.sock, selectors.EVENT_READ, data=channel)
+
+    def send(self, worker, message):
+        """Sends a message to another worker without waiting for it to be read."""
+        channel = self.channels[worker]
+        channel.outb.append(encode(message))
+        channel.flush()
+        self.update_interest(channel)
+
+    def notify(self, worker, message):
+        """Sends a notification to another worker."""
+        self.stats["notifications_sent"] += 1
+        self.send(worker, message)
+
+    def broadcast(self, message):
+        """Sends a notification to every other worker."""
+        for worker in self.channels:
+            self.notify(worker, message)
+
+    def update_interest(self, channel):
+        """Watches a channel for writes in the server's selector while it has messages waiting."""
+        if self.selector is not None:
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if channel.outb else 0)
+            self.selector.modify(channel.sock, events, data=channel)
+
+    def service(self, channel, mask):
+        """Services a channel the server's selector found ready."""
+        if mask & selectors.EVENT_READ:
+            # Messages are handled in the order they arrive, so whatever the called worker sent before a result,
+            # such as a directory change, is applied before the call is done
+            for message in channel.receive():
+                self.dispatch(channel.worker, message)
+        if mask & selectors.EVENT_WRITE:
+            channel.flush()
+        self.update_interest(channel)
+
+    def dispatch(self, worker, message):
+        """Answers a call, finishes the call a result is for, or hands a notification to the server."""
+        match message["op"]:
+            case "call":
+                self.stats["calls_served"] += 1
+                try:
+                    result = self.functions[message["function"]](*message["args"])
+                except Exception as e:
+                    # Raised again by the caller, as if the function had run there
+                    self.send(worker, {"op": "result", "id": message["id"], "error": [type(e).__name__, str(e)]})
+                else:
+                    self.send(worker, {"op": "result", "id": message["id"], "result": result})
+            case "result":
+                call = self.calls.pop(message["id"], None)
+                if call is None:
+                    # The call timed out before its result arrived
+                    return
+                done = call[0]
+                if "error" in message:
+                    name, text = message["error"]
+                    error = getattr(builtins, name, None)
+                    if not (isinstance(error, type) and issubclass(error, Exception)):
+                        error = RuntimeError
+                    done(None, error(text))
+                else:
+                    done(message["result"], None)
+            case _:
+                self.handle(worker, message)
+
+    def call(self, worker, function, args, done):
+        """
+        Calls a function on another worker, without waiting for its result.
+
+        Parameters
+        ----------
+        worker: int
+            The index of the worker to run the function
+        function: str
+            The name of the function, one of the functions that worker serves
+        args: list
+            The arguments. Each one is sent as json, and may be a RemoteConnection or contain Messages, see
+            encode_value.
+        done: function
+            Called with (result, error) from service once the result arrives: the return value of the function,
+            with its Messages rebuilt, and None, or None and what the function raised, as the built-in exception
+            of the same name or RuntimeError. Called with None and a TimeoutError from expire_calls instead if
+            the result does not arrive within CALL_TIMEOUT seconds.
+
+        Returns
+        -------
+        None.
+        """
+        self.stats["calls_sent"] += 1
+        call_id = self.next_call_id
+        self.next_call_id += 1
+        self.calls[call_id] = (done, time.monotonic() + CALL_TIMEOUT)
+        self.send(worker, {"op": "call", "id": call_id, "function": function, "args": list(args)})
+
+    def time_to_next_deadline(self, now):
+        """Returns the seconds until the oldest waiting call times out, or None if no call waits."""
+        for done, deadline in self.calls.values():
+            return max(0.0, deadline - now)
+        return None
+
+    def expire_calls(self, now):
+        """Fails the calls whose results did not arrive in time with TimeoutError."""
+        while self.calls:
+            call_id = next(iter(self.calls))
+            done, deadline = self.calls[call_id]
+            if deadline > now:
+                break
+            del self.calls[call_id]
+            self.stats["call_timeouts"] += 1
+            done(None, TimeoutError(f"no result from another worker within {CALL_TIMEOUT} seconds"))
+
+def spawn(run):
+    """
+    Forks WORKERS worker processes that each call run, and supervises them until they exit.
+
+    Parameters
+    ----------
+    run: function
+        Serves until the worker is stopped. It finds the index and Mesh of its worker in INDEX and mesh.
+
+    Returns
+    -------
+    None. Only the supervisor returns, once every worker exited. A worker exits the process when run returns.
+
+    Notes
+    -----
+    The supervisor passes SIGTERM on to the workers as SIGINT, which they handle like Ctrl-C. Every account is
+    only reachable through its owner, so when one worker exits the others are stopped as well.
+    """
+    global INDEX, mesh
+    pairs = {(i, j): socket.socketpair() for i in range(WORKERS) for j in range(i + 1, WORKERS)}
+    pids = []
+    for index in range(WORKERS):
+        pid = os.fork()
+        if pid == 0:
+            INDEX = index
+            # A supervisor started in the background ignores SIGINT, and the workers must not
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            channels = {}
+            for (i, j), (first, second) in pairs.items():
+                if i == index:
+                    channels[j] = Channel(j, first)
+                    second.close()
+                elif j == index:
+                    channels[i] = Channel(i, second)
+                    first.close()
+                else:
+                    first.close()
+                    second.close()
+            mesh = Mesh(index, channels)
+            run()
+            # Leave by exiting, so the worker never runs the supervisor's code after spawn
+            sys.exit(0)
+        pids.append(pid)
+    for first, second in pairs.values():
+        first.close()
+        second.close()
+
+    stopping = False
+
+    def stop(signum=None, frame=None):
+        nonlocal stopping
+        if stopping:
+            return
+        stopping = True
+        # Ctrl-C reaches the workers by itself, since they share the terminal's process group
+        if signum != signal.SIGINT:
+            for pid in pids:
+                try:
+                    os.kill(pid, signal.SIGINT)
+                except ProcessLookupError:
+                    pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    running = set(pids)
+    while running:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        running.discard(pid)
+        stop()
@@ -0,0 +1,78 @@
+# A hashed timer wheel for connection timeouts
+#
+# Timers live in a ring of slots, one slot per tick. Scheduling a timer appends its key to the slot its
+# deadline falls in, and advancing the wheel by one tick empties one slot, so both cost O(1) however many
+# timers are pending. A deadline more than one turn of the wheel away stays in its slot until the turn it
+# is due in. Timers cannot be cancelled: whoever gets an expired key checks whether it still matters, for
+# example whether the connection was active since it was scheduled, and schedules it again if needed.
+
+import math
+
+class TimerWheel:
+    """
+    Expires keys once their deadline has passed, to a resolution of one tick.
+
+    Attributes:
+    - tick (float): Seconds per slot. Keys never expire early, and at most one tick late.
+    - current_tick (int): The last tick the wheel was advanced to, counted from time 0.
+    """
+    def __init__(self, tick, num_slots=512, now=0.0):
+        self.tick = tick
+        self.slots = [[] for _ in range(num_slots)]
+        self.current_tick = math.floor(now / tick)
+        self.pending = 0
+
+    def __len__(self):
+        return self.pending
+
+    def schedule(self, key, deadline):
+        """
+        Schedules a key to expire at a deadline.
+
+        Parameters
+        ----------
+        key: hashable
+            Returned by advance once the deadline has passed
+        deadline: float
+            The time to expire at, on the same clock as the times passed to advance
+        """
+        due_tick = max(math.ceil(deadline / self.tick), self.current_tick + 1)
+        self.slots[due_tick % len(self.slots)].append((due_tick, key))
+        self.pending += 1
+
+    def advance(self, now):
+        """
+        Moves the wheel forward to the current time.
+
+        Parameters
+        ----------
+        now: float
+            The current time
+
+        Returns
+        -------
+        list
+            The keys whose deadlines passed since the last advance, in the order of their slots
+        """
+        now_tick = math.floor(now / self.tick)
+        expired = []
+        # After a stall of more than a full turn, every slot is due once
+        for due in range(self.current_tick + 1, min(now_tick, self.current_tick + len(self.slots)) + 1):
+            index = due % len(self.slots)
+            slot = self.slots[index]
+            if not slot:
+                continue
+            later = []
+            for entry in slot:
+                if entry[0] <= now_tick:
+                    expired.append(entry[1])
+                else:
+                    later.append(entry)
+            self.slots[index] = later
+        self.current_tick = max(self.current_tick, now_tick)
+        self.pending -= len(expired)
+        return expired
+
+    def time_to_next_tick(self, now):
+        """Returns the seconds until the wheel is next due to be advanced."""
+        return max((self.current_tick + 1) * self.tick - now, 0.0)
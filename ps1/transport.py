@@ -0,0 +1,101 @@
+# Server addresses: TCP, or a Unix domain socket for clients on the same host
+#
+# An address is a host and port, or "unix:" followed by the path of the socket, as in "unix:/tmp/ps1.sock", in
+# which case the port is ignored. A Unix domain socket skips the TCP/IP stack on both ends, so a client on the
+# same host as the server gets its replies sooner than over loopback TCP. Both carry the same frames.
+
+import asyncio
+import errno
+import os
+import socket
+import stat
+
+UNIX_PREFIX = "unix:"
+
+def unix_path(host):
+    """Returns the socket path of a "unix:" address, or None for a TCP host."""
+    if isinstance(host, str) and host.startswith(UNIX_PREFIX):
+        return host[len(UNIX_PREFIX):]
+    return None
+
+def format_address(host, port):
+    """Formats an address for messages, as host:port or as the unix: address."""
+    return host if unix_path(host) is not None else f"{host}:{port}"
+
+def connect(host, port, timeout=None):
+    """
+    Connects to a server.
+
+    Parameters
+    ----------
+    host: str
+        The host name, or "unix:" and the path of the server's Unix domain socket
+    port: int
+        The port, ignored for a Unix domain socket
+    timeout: float or None
+        Seconds to wait for the connection, or None to wait as long as the OS does
+
+    Returns
+    -------
+    socket
+        The connected, blocking socket. A TCP socket has Nagle's algorithm turned off, so each request is sent
+        right away.
+    """
+    path = unix_path(host)
+    if path is None:
+        sock = socket.create_connection((host, port), timeout=timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+async def open_connection(host, port):
+    """Connects to a server for asyncio, like connect, and returns the StreamReader and StreamWriter."""
+    path = unix_path(host)
+    if path is None:
+        return await asyncio.open_connection(host, port)
+    return await asyncio.open_unix_connection(path)
+
+def listen_unix(path, backlog):
+    """
+    Listens on a Unix domain socket.
+
+    Parameters
+    ----------
+    path: str
+        The path of the socket. A socket file left there by a server that did not shut down cleanly is replaced.
+    backlog: int
+        The pending connection backlog
+
+    Returns
+    -------
+    socket
+        The non-blocking listening socket
+
+    Raises
+    ------
+    OSError
+        EADDRINUSE if a running server is listening on the path, or if anything other than a socket is there
+    """
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        # Only a socket nobody listens on is stale, connecting to it is refused
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            os.remove(path)
+        else:
+            raise OSError(errno.EADDRINUSE, f"a server is already listening on {path}")
+        finally:
+            probe.close()
+    lsock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    lsock.bind(path)
+    lsock.listen(backlog)
+    lsock.setblocking(False)
+    return lsock
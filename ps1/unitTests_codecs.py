@@ -0,0 +1,59 @@
+import unittest
+import json
+import types
+import server
+import wire_v2
+
+class TestCodecs(unittest.TestCase):
+    def setUp(self):
+        self.data = types.SimpleNamespace(addr="test", codec="wp", compression=False)
+
+    def tearDown(self):
+        server.accounts.clear()
+        server.account_index.clear()
+
+    def test_one_request_form(self):
+        # The same request decodes the same way whichever codec it came in
+        args = {"from_username": "user1", "to_username": "user2", "timestamp": "2023-10-10-10:00:00", "message": "hello there"}
+        frames = [
+            "SEuser1 user2 2023-10-10-10:00:00 hello there",
+            json.dumps({"type": "SE", **args}),
+            ("SE", 0, wire_v2.request_fields({"type": "SE", **args})),
+        ]
+        for frame in frames:
+            codec = server.CODECS[server.detect_codec(frame)]
+            self.assertEqual(codec.decode(frame).args, args)
+        self.assertEqual([server.detect_codec(frame) for frame in frames], ["wp", "json", "v2"])
+
+        batch = [("user2", "hi"), ("user3", "hello there")]
+        self.assertEqual(server.CODECS["wp"].decode("SBuser1 t 2 user2 2 hi user3 11 hello there").args["items"], batch)
+        self.assertEqual(server.CODECS["v2"].decode(("SB", 0, ["user1", "t", "user2", "hi", "user3", "hello there"])).args["items"], batch)
+
+    def test_malformed(self):
+        # The type and request id are kept, so the ER0 reply still answers the request
+        with self.assertRaises(server.MalformedRequest) as raised:
+            server.CODECS["wp"].decode("#4 CRuser1")
+        self.assertEqual(raised.exception.request, server.Request("CR", "4", None))
+        with self.assertRaises(server.MalformedRequest) as raised:
+            server.CODECS["json"].decode('{"type": "CR", "requestId": 5}')
+        self.assertEqual(raised.exception.request, server.Request("CR", 5, None))
+        with self.assertRaises(server.MalformedRequest):
+            server.CODECS["v2"].decode(("SB", 6, ["user1", "t", "user2"]))
+
+    def test_respond(self):
+        self.assertEqual(server.respond("#1 CRuser1 password1", None, self.data), b"6#1 CRT")
+        reply = json.loads(server.respond('{"type": "CR", "username": "user1", "password": "password1"}', None, self.data)[2:])
+        self.assertEqual(reply, {"success": False, "errorMsg": "ER1: account is already in database"})
+        self.assertEqual(self.data.codec, "json")
+        self.assertEqual(server.respond(("LA", 7, []), None, self.data), wire_v2.encode_frame("LAT", 7, ["user1"]))
+        self.assertEqual(server.respond(("XX", 8, []), None, self.data), wire_v2.encode_frame("ER0", 8, ["ER0: unknown request type"]))
+
+    def test_switch_version(self):
+        # The reply goes out in the codec the request came in
+        self.assertEqual(server.respond("VE2", None, self.data), b"4VET2")
+        self.assertEqual(self.data.codec, "v2")
+        self.assertEqual(server.respond(("VE", 1, ["1"]), None, self.data), wire_v2.encode_frame("VET", 1, ["1"]))
+        self.assertEqual(self.data.codec, "wp")
+
+if __name__ == '__main__':
+    unittest.main()
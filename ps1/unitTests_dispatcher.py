@@ -0,0 +1,37 @@
+import unittest
+import dispatcher
+
+class TestDispatcher(unittest.TestCase):
+    def test_split_request_id(self):
+        self.assertEqual(dispatcher.split_request_id("#12 SET"), ("12", "SET"))
+        self.assertEqual(dispatcher.split_request_id(dispatcher.tag_request("SEa b c hi there", 3)), ("3", "SEa b c hi there"))
+        self.assertEqual(dispatcher.split_request_id("SEL1 a"), (None, "SEL1 a"))
+        with self.assertRaises(ValueError):
+            dispatcher.split_request_id("#12")
+
+    def test_replies_in_any_order(self):
+        requests = dispatcher.Dispatcher()
+        replies = []
+        first = requests.register(lambda reply: replies.append(("first", reply)))
+        second = requests.register(lambda reply: replies.append(("second", reply)))
+        self.assertEqual(len(requests), 2)
+        self.assertTrue(requests.complete(str(second), "LIT"))
+        # Pushes and replies to requests no longer in flight are not matched
+        self.assertFalse(requests.complete(None, "SEL"))
+        self.assertFalse(requests.complete(second, "LIT"))
+        self.assertTrue(requests.complete(first, "CRT"))
+        self.assertEqual(replies, [("second", "LIT"), ("first", "CRT")])
+
+    def test_fail_all(self):
+        requests = dispatcher.Dispatcher()
+        replies = []
+        for _ in range(3):
+            requests.register(replies.append)
+        cancelled = requests.register(replies.append)
+        requests.cancel(cancelled)
+        requests.fail_all(None)
+        self.assertEqual(replies, [None, None, None])
+        self.assertEqual(len(requests), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+import io
+import json
+import os
+import eventlog
+
+class TestEventLog(unittest.TestCase):
+    def records(self, stream):
+        return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+    def test_structured_records(self):
+        stream = io.StringIO()
+        event_log = eventlog.EventLog(stream=stream)
+        log = eventlog.Logger("test", event_log)
+        log.info("send_message", from_username="user1", to_username="user2")
+        log.warning("bad_frame", addr=("127.0.0.1", 5000))
+        event_log.close()
+
+        records = self.records(stream)
+        self.assertEqual([record["event"] for record in records], ["send_message", "bad_frame"])
+        self.assertEqual(records[0]["level"], "info")
+        self.assertEqual(records[0]["logger"], "test")
+        self.assertEqual(records[0]["to_username"], "user2")
+        self.assertEqual(records[1]["addr"], ["127.0.0.1", 5000])
+
+    def test_levels_and_sampling(self):
+        stream = io.StringIO()
+        event_log = eventlog.EventLog(stream=stream, level="info", sample_rates={"read_message": 0, "login": 1})
+        log = eventlog.Logger("test", event_log)
+        log.debug("create_account", username="user1")
+        for _ in range(10):
+            log.info("read_message", username="user1")
+        log.info("login", username="user1")
+        event_log.close()
+        self.assertEqual([record["event"] for record in self.records(stream)], ["login"])
+
+    def test_full_queue_drops(self):
+        stream = io.StringIO()
+        event_log = eventlog.EventLog(stream=stream, queue_size=1)
+        log = eventlog.Logger("test", event_log)
+        # Logging never blocks, whatever the writer thread is doing
+        for i in range(1000):
+            log.info("send_message", number=i)
+        event_log.close()
+        self.assertEqual(len(self.records(stream)) + event_log.dropped, 1000)
+
+    def test_parse_sample_rates(self):
+        self.assertEqual(eventlog.parse_sample_rates("send_message=0.01, read_message=0.5"), {"send_message": 0.01, "read_message": 0.5})
+        self.assertEqual(eventlog.parse_sample_rates(""), {})
+
+    def test_copies_identical(self):
+        # Every server imports the copy next to it, and they all must be this file
+        with open(eventlog.__file__, "rb") as f:
+            source = f.read()
+        for server_dir in ("ps2", "ps4"):
+            path = os.path.join(os.path.dirname(os.path.abspath(eventlog.__file__)), os.pardir, server_dir, "eventlog.py")
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), source, f"{server_dir}/eventlog.py differs from ps1/eventlog.py")
+
+if __name__ == '__main__':
+    unittest.main()
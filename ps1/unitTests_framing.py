@@ -0,0 +1,25 @@
+import unittest
+import subprocess
+import sys
+import framing
+
+class TestFraming(unittest.TestCase):
+    def test_extract_frames(self):
+        # Lengths count characters, and a frame that has not fully arrived stays in the buffer
+        buf = bytearray("3CRT6héllo✓12SEuser1 u".encode("utf-8"))
+        self.assertEqual(framing.extract_frames(buf), ["CRT", "héllo✓"])
+        self.assertEqual(buf, bytearray(b"12SEuser1 u"))
+
+    def test_missing_prefix(self):
+        with self.assertRaises(ValueError):
+            framing.extract_frames(bytearray(b"CRT"))
+
+    def test_clients_do_not_import_server(self):
+        # Importing the server sets it up, which a client tool must not do
+        for module in ("experiment", "loadgen", "server_benchmark"):
+            code = f"import sys, {module}; print('server' in sys.modules)"
+            result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+            self.assertEqual(result.stdout.strip(), "False", module)
+
+if __name__ == '__main__':
+    unittest.main()
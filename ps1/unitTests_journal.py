@@ -0,0 +1,180 @@
+import unittest
+import json
+import os
+import tempfile
+import threading
+import journal
+import server
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        if server.journal is not None:
+            server.journal.close()
+            server.journal = None
+        server.accounts.clear()
+        server.account_index.clear()
+        server.messageId = 0
+        self.dir.cleanup()
+
+    def restart(self):
+        # Simulate a restart by dropping the in-memory store and reopening the journal
+        server.journal.close()
+        server.journal = None
+        server.accounts.clear()
+        server.messageId = 0
+        server.open_journal(self.dir.name)
+
+    def populate(self, between=lambda: None):
+        # between runs after every request, like the server's loop does
+        server.create_account("user1", "password1")
+        server.create_account("user2", "password2")
+        server.create_account("user3", "password3")
+        between()
+        for i in range(5):
+            server.send_message("user1", "user2", f"message {i}", "2023-10-10-10:00:00")
+            between()
+        server.delete_message("user2", 1)
+        between()
+        server.delete_account("user3")
+        between()
+
+    def check_populated(self):
+        self.assertEqual(sorted(server.accounts), ["user1", "user2"])
+        self.assertEqual(server.account_index, ["user1", "user2"])
+        self.assertEqual(server.accounts["user2"]["accountInfo"]["password"], "password2")
+        read = server.read_message("user2", 10)[1]
+        self.assertEqual([m.message for m in read["messages"]], ["message 0", "message 2", "message 3", "message 4"])
+        # New messages keep getting fresh ids
+        self.assertEqual(server.send_message("user2", "user1", "hi", "2023-10-10-10:00:00")[1].message_id, 5)
+
+    def test_replay_journal(self):
+        server.open_journal(self.dir.name)
+        self.populate()
+        self.restart()
+        self.check_populated()
+
+    def test_snapshot_and_tail(self):
+        server.JOURNAL_SNAPSHOT_EVERY = 4
+        try:
+            server.open_journal(self.dir.name)
+            self.populate(server.snapshot_if_due)
+            self.assertLess(server.journal.records_since_snapshot, 4)
+            self.restart()
+            self.check_populated()
+        finally:
+            server.JOURNAL_SNAPSHOT_EVERY = 100000
+
+    def test_snapshot_in_background(self):
+        server.open_journal(self.dir.name)
+        server.journal.snapshot_every = 3
+        for username in ("user1", "user2", "user3"):
+            server.create_account(username, "password")
+        # Hold the writer thread in the middle of building the snapshot
+        building = threading.Event()
+        release = threading.Event()
+        build_snapshot = server.build_snapshot
+
+        def slow_build_snapshot(captured):
+            building.set()
+            release.wait(10)
+            return build_snapshot(captured)
+
+        server.build_snapshot = slow_build_snapshot
+        try:
+            server.snapshot_if_due()
+            self.assertTrue(building.wait(10))
+            # Requests keep being served, and are journaled after the snapshot
+            server.send_message("user1", "user2", "during", "2023-10-10-10:00:00")
+            server.delete_account("user3")
+            self.assertEqual(server.read_message("user2", 10)[1]["num_read"], 1)
+        finally:
+            release.set()
+            server.build_snapshot = build_snapshot
+        server.journal.close()
+        with open(os.path.join(self.dir.name, "snapshot.json")) as f:
+            self.assertEqual(sorted(json.load(f)["accounts"]), ["user1", "user2", "user3"])
+        self.restart()
+        self.assertEqual(sorted(server.accounts), ["user1", "user2"])
+        self.assertEqual([m.message for m in server.read_message("user2", 10)[1]["messages"]], ["during"])
+
+    def test_undelivered_push(self):
+        server.open_journal(self.dir.name)
+        server.create_account("user1", "password1")
+        server.accounts["user1"]["loggedIn"] = True
+        message = server.send_message("user2", "user1", "hello", "2023-10-10-10:00:00")[1]
+        server.send_message("user2", "user1", "delivered", "2023-10-10-10:00:00")
+        # The live push of the first message failed
+        server.mark_undelivered("user1", message)
+        self.restart()
+        self.assertFalse(server.accounts["user1"]["loggedIn"])
+        read = server.read_message("user1", 10)[1]
+        self.assertEqual([m.message for m in read["messages"]], ["hello"])
+
+    def test_backlog_delivered(self):
+        server.open_journal(self.dir.name)
+        server.create_account("user1", "password1")
+        for i in range(3):
+            server.send_message("user2", "user1", f"message {i}", "2023-10-10-10:00:00")
+        server.accounts["user1"]["loggedIn"] = True
+        # The first chunk of the backlog was sent, and reading the next one marks it delivered
+        first = server.read_backlog("user1", 2, [])[1]["messages"]
+        rest = server.read_backlog("user1", 2, [m.message_id for m in first])[1]["messages"]
+        self.assertEqual([m.message for m in rest], ["message 2"])
+        self.restart()
+        self.assertEqual([m.delivered for m in server.accounts["user1"]["messageHistory"].values()], [True, True, False])
+        read = server.read_message("user1", 10)[1]
+        self.assertEqual([m.message for m in read["messages"]], ["message 2"])
+
+    def test_write_failure(self):
+        server.open_journal(self.dir.name)
+        server.journal.stopped.set()
+        server.journal.writer.join()
+        server.create_account("user1", "password1")
+        fsync = journal.os.fsync
+
+        def failing_fsync(fd):
+            journal.os.fsync = fsync
+            raise OSError(5, "Input/output error")
+
+        # The record reaches the segment, but the fsync fails, so it is written again on the next pass
+        journal.os.fsync = failing_fsync
+        try:
+            server.journal.commit()
+        finally:
+            journal.os.fsync = fsync
+        self.assertIsInstance(server.journal.write_error, OSError)
+        self.assertEqual(server.journal.get_stats()["journal_pending"], 1)
+        server.create_account("user2", "password2")
+        server.journal.commit()
+        self.assertIsNone(server.journal.write_error)
+        self.assertEqual(server.journal.get_stats(), {"journal_pending": 0, "journal_write_failures": 1, "journal_snapshot_failures": 0})
+        self.restart()
+        self.assertEqual(server.account_index, ["user1", "user2"])
+        self.assertEqual(server.journal.records_since_snapshot, 2)
+
+    def test_snapshot_failure(self):
+        server.open_journal(self.dir.name)
+        server.create_account("user1", "password1")
+        replace = journal.os.replace
+
+        def failing_replace(src, dst):
+            raise OSError(28, "No space left on device")
+
+        journal.os.replace = failing_replace
+        try:
+            server.journal.write_snapshot(server.snapshot_state())
+        finally:
+            journal.os.replace = replace
+        self.assertIsInstance(server.journal.snapshot_error, OSError)
+        # The records keep going to the new segment, and the old one stays until a snapshot covers it
+        server.create_account("user2", "password2")
+        server.journal.commit()
+        self.assertEqual(server.journal.get_stats()["journal_snapshot_failures"], 1)
+        self.restart()
+        self.assertEqual(server.account_index, ["user1", "user2"])
+
+if __name__ == '__main__':
+    unittest.main()
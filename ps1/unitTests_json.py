@@ -1,6 +1,9 @@
 import unittest
-import socket
+import time
 import json
+import compression
+import transport
+import wire_v2
 import os
 from dotenv import load_dotenv
 
@@ -11,8 +14,8 @@ PORT = int(os.environ.get("PORT_SERVER_TESTING"))
 
 class TestServerMethods(unittest.TestCase):
     def setUp(self):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect((HOST, PORT))
+        # HOST_SERVER_TESTING may be "unix:<path>" to test over the server's Unix domain socket
+        self.sock = transport.connect(HOST, PORT)
 
     def tearDown(self):
         self.sock.close()
@@ -233,5 +236,285 @@ class TestServerMethods(unittest.TestCase):
         response = self.send_request(request)
         self.assertTrue(response["success"])
 
+    def test_read_message_after_delete(self):
+        # Create two accounts and login to just the sender account
+        self.send_request({"type": "CR", "username": "user1", "password": "password1"})
+        self.send_request({"type": "CR", "username": "user2", "password": "password2"})
+        self.send_request({"type": "LI", "username": "user1", "password": "password1"})
+
+        # Send three messages while the recipient is logged out
+        for text in ["first", "second", "third"]:
+            response = self.send_request({"type": "SE", "from_username": "user1", "to_username": "user2", "timestamp": "2023-10-10-10:00:00", "message": text})
+            self.assertTrue(response["success"])
+
+        # Delete the second message, and reading should return the others in the order they were sent
+        response = self.send_request({"type": "RE", "username": "user2", "number": 3})
+        second_id = response["messages"][1]["messageId"]
+        response = self.send_request({"type": "DM", "username": "user2", "id": second_id})
+        self.assertTrue(response["success"])
+        response = self.send_request({"type": "RE", "username": "user2", "number": 3})
+        self.assertEqual(response["num_read"], 2)
+        self.assertEqual([m["message"] for m in response["messages"]], ["first", "third"])
+
+        # Reading fewer messages than are waiting only returns the oldest ones
+        response = self.send_request({"type": "RE", "username": "user2", "number": 1})
+        self.assertEqual([m["message"] for m in response["messages"]], ["first"])
+
+        # Delete account to clean up
+        self.assertTrue(self.send_request({"type": "DA", "username": "user1"})["success"])
+        self.assertTrue(self.send_request({"type": "DA", "username": "user2"})["success"])
+
+    def test_send_batch(self):
+        self.send_request({"type": "CR", "username": "user1", "password": "password1"})
+        self.send_request({"type": "CR", "username": "user2", "password": "password2"})
+
+        # Send several messages in one request, and each one gets its own status
+        request = {"type": "SB", "from_username": "user1", "timestamp": "2023-10-10-10:00:00",
+                   "messages": [{"to_username": "user2", "message": "first"},
+                                {"to_username": "user3", "message": "lost"}]}
+        response = self.send_request(request)
+        self.assertEqual(response["type"], "SBT")
+        self.assertEqual([result["success"] for result in response["results"]], [True, False])
+        self.assertEqual(response["results"][1]["errorMsg"], "ER1: account with that username does not exist")
+
+        # Send one message to many users, including a logged in user who gets it pushed right away
+        self.send_request({"type": "LI", "username": "user1", "password": "password1"})
+        request = {"type": "SM", "from_username": "user1", "timestamp": "2023-10-10-10:00:00",
+                   "to_usernames": ["user2", "user1"], "message": "hello everyone"}
+        responses = self.send_request_se(request)
+        self.assertEqual(responses[0]["type"], "SEL")
+        self.assertEqual(responses[0]["message"], "hello everyone")
+        self.assertEqual(responses[1]["type"], "SMT")
+        self.assertEqual([result["success"] for result in responses[1]["results"]], [True, True])
+
+        response = self.send_request({"type": "RE", "username": "user2", "number": 5})
+        self.assertEqual([m["message"] for m in response["messages"]], ["first", "hello everyone"])
+
+        # Delete account to clean up
+        self.assertTrue(self.send_request({"type": "DA", "username": "user1"})["success"])
+        self.assertTrue(self.send_request({"type": "DA", "username": "user2"})["success"])
+
+    def test_search_accounts(self):
+        for username in ["searchb", "searcha", "searchc", "other"]:
+            self.send_request({"type": "CR", "username": username, "password": "password"})
+
+        # Pages come back in sorted order, and the cursor gets the next page
+        response = self.send_request({"type": "LS", "prefix": "search", "cursor": "", "limit": 2})
+        self.assertEqual(response["type"], "LST")
+        self.assertEqual(response["accounts"], ["searcha", "searchb"])
+        response = self.send_request({"type": "LS", "prefix": "search", "cursor": response["cursor"], "limit": 2})
+        self.assertEqual(response["accounts"], ["searchc"])
+        self.assertEqual(response["cursor"], "")
+
+        # Delete account to clean up
+        for username in ["searchb", "searcha", "searchc", "other"]:
+            self.assertTrue(self.send_request({"type": "DA", "username": username})["success"])
+
+    def test_directory_subscription(self):
+        # Subscribe, and the reply is a copy of the directory with its version
+        self.send_request({"type": "CR", "username": "user1", "password": "password1"})
+        response = self.send_request({"type": "SU"})
+        self.assertEqual(response["type"], "SUT")
+        self.assertIn("user1", response["accounts"])
+        version = response["version"]
+
+        # Account changes made by another client are pushed with the next directory versions
+        other = transport.connect(HOST, PORT)
+        try:
+            for request in [{"type": "CR", "username": "user2", "password": "password2"}, {"type": "DA", "username": "user2"}]:
+                request = json.dumps(request)
+                other.sendall((str(len(request)) + request).encode('utf-8'))
+            self.assertEqual(self.read_message(), {"type": "ACA", "version": version + 1, "username": "user2"})
+            self.assertEqual(self.read_message(), {"type": "ACD", "version": version + 2, "username": "user2"})
+        finally:
+            other.close()
+
+        # Delete account to clean up, which is pushed to this client too, ahead of the reply
+        responses = self.send_request_se({"type": "DA", "username": "user1"})
+        self.assertEqual(responses[0], {"type": "ACD", "version": version + 3, "username": "user1"})
+        self.assertTrue(responses[1]["success"])
+
+    def test_server_stats(self):
+        self.send_request({"type": "CR", "username": "user1", "password": "password1"})
+        self.send_request({"type": "CR", "username": "user1", "password": "password1"})
+
+        response = self.send_request({"type": "ST"})
+        self.assertEqual(response["type"], "STT")
+        stats = response["stats"]
+        self.assertGreaterEqual(stats["requests"]["CR"]["count"], 2)
+        self.assertGreaterEqual(stats["requests"]["CR"]["errors"], 1)
+        self.assertGreaterEqual(sum(count for bound, count in stats["requests"]["CR"]["histogram"]), 2)
+        self.assertGreater(stats["bytes_out"], 0)
+        self.assertGreaterEqual(stats["connections"], 1)
+
+        # Delete account to clean up
+        self.assertTrue(self.send_request({"type": "DA", "username": "user1"})["success"])
+
+    def test_compression(self):
+        self.assertFalse(self.send_request({"type": "CM", "codec": "gzip"})["success"])
+        self.assertEqual(self.send_request({"type": "CM", "codec": "zlib"})["type"], "CMT")
+        self.send_request({"type": "CR", "username": "user1", "password": "password1"})
+        self.send_request({"type": "CR", "username": "user2", "password": "password2"})
+
+        # A large message is sent compressed, and comes back compressed in the RE reply
+        text = "all work and no play makes jack a dull boy " * 100
+        request = json.dumps({"type": "SE", "from_username": "user1", "to_username": "user2", "timestamp": "2023-10-10-10:00:00", "message": text})
+        request = compression.compress_frame((str(len(request)) + request).encode('utf-8'), 1024)
+        self.assertEqual(request[0:1], b"Z")
+        self.sock.sendall(request)
+        self.assertTrue(self.read_message()["success"])
+
+        request = json.dumps({"type": "RE", "username": "user2", "number": 1})
+        self.sock.sendall((str(len(request)) + request).encode('utf-8'))
+        self.assertEqual(self.sock.recv(1), b"Z")
+        str_bytes = ""
+        recv_data = self.sock.recv(1)
+        while recv_data != b" ":
+            str_bytes += recv_data.decode("utf-8")
+            recv_data = self.sock.recv(1)
+        body = b""
+        while len(body) < int(str_bytes):
+            body += self.sock.recv(int(str_bytes) - len(body))
+        response = json.loads(compression.decompress(body, 1024 * 1024))
+        self.assertEqual(response["messages"][0]["message"], text)
+
+        # Delete account to clean up
+        self.assertTrue(self.send_request({"type": "DA", "username": "user1"})["success"])
+        self.assertTrue(self.send_request({"type": "DA", "username": "user2"})["success"])
+
+    def test_mixed_codecs(self):
+        self.send_request({"type": "CR", "username": "user1", "password": "password1"})
+        self.send_request({"type": "CR", "username": "user2", "password": "password2"})
+        self.send_request({"type": "LI", "username": "user1", "password": "password1"})
+
+        # A client speaking the custom wire protocol to the same server gets pushes in its own codec
+        other = transport.connect(HOST, PORT)
+        try:
+            other.sendall(b"17LIuser2 password2")
+            self.assertEqual(other.recv(64), b"3LIT")
+            self.send_request({"type": "SE", "from_username": "user1", "to_username": "user2", "timestamp": "2023-10-10-10:00:00", "message": "Hello World"})
+            self.assertRegex(other.recv(64).decode("utf-8"), r"^\d+SEL\d+ user1 2023-10-10-10:00:00 11 Hello World$")
+        finally:
+            other.close()
+
+        # A push that cannot be delivered leaves the stored message for RE, unchanged by the push
+        time.sleep(0.1)
+        self.send_request({"type": "SE", "from_username": "user1", "to_username": "user2", "timestamp": "2023-10-10-10:00:00", "message": "Hello again"})
+        response = self.send_request({"type": "RE", "username": "user2", "number": 1})
+        self.assertEqual(response["messages"][0]["message"], "Hello again")
+        self.assertNotIn("type", response["messages"][0])
+
+        # A json connection can switch to the binary wire protocol version 2
+        response = self.send_request({"type": "VE", "version": "2"})
+        self.assertEqual(response["type"], "VET")
+        self.sock.sendall(wire_v2.encode_frame("LS", 7, ["user", "", 10]))
+        buf = bytearray()
+        frames = []
+        while not frames:
+            buf += self.sock.recv(4096)
+            frames = wire_v2.extract_frames(buf)
+        self.assertEqual(frames[0], ("LST", 7, ["", "user1", "user2"]))
+
+        # Delete account to clean up
+        for username in ["user1", "user2"]:
+            self.sock.sendall(wire_v2.encode_frame("DA", 8, [username]))
+            frames = []
+            while not frames:
+                buf += self.sock.recv(4096)
+                frames = wire_v2.extract_frames(buf)
+            self.assertEqual(frames[0][0], "DAT")
+
+    def test_pipelined_requests(self):
+        # Send two requests in a single write, and the server should answer both in order
+        requests = [{"type": "CR", "username": "user1", "password": "password1"},
+                    {"type": "LI", "username": "user1", "password": "password1"}]
+        payload = ""
+        for request in requests:
+            request = json.dumps(request)
+            payload += str(len(request)) + request
+        self.sock.sendall(payload.encode('utf-8'))
+        self.assertEqual(self.read_message()["type"], "CRT")
+        self.assertEqual(self.read_message()["type"], "LIT")
+
+        # Send a request split across two writes, and the server should wait for the rest of it
+        request = json.dumps({"type": "DA", "username": "user1"})
+        request = str(len(request)) + request
+        self.sock.sendall(request[:10].encode('utf-8'))
+        time.sleep(0.1)
+        self.sock.sendall(request[10:].encode('utf-8'))
+        self.assertTrue(self.read_message()["success"])
+
+    def test_request_ids(self):
+        # The reply carries the request id back, and replies to untagged requests carry none
+        response = self.send_request({"type": "CR", "username": "user1", "password": "password1", "requestId": 7})
+        self.assertEqual((response["type"], response["requestId"]), ("CRT", 7))
+        response = self.send_request({"type": "CR", "username": "user2", "password": "password2"})
+        self.assertNotIn("requestId", response)
+        response = self.send_request({"type": "LI", "username": "user1", "password": "password1", "requestId": 8})
+        self.assertEqual(response["requestId"], 8)
+
+        # A burst of sends in one write, with every reply matched to its request by id
+        payload = ""
+        for i in range(5):
+            request = json.dumps({"type": "SE", "from_username": "user2", "to_username": "user1", "timestamp": "2023-10-10-10:00:00",
+                                  "message": f"message {i}", "requestId": 100 + i})
+            payload += str(len(request)) + request
+        self.sock.sendall(payload.encode('utf-8'))
+        replies = [self.read_message() for _ in range(10)]
+        self.assertEqual(sorted(reply["requestId"] for reply in replies if "requestId" in reply), [100 + i for i in range(5)])
+        self.assertEqual(len([reply for reply in replies if reply.get("type") == "SEL"]), 5)
+
+        response = self.send_request({"type": "DA", "username": "user1", "requestId": "last"})
+        self.assertEqual(response["requestId"], "last")
+        self.send_request({"type": "DA", "username": "user2"})
+
+    def test_read_long_messages(self):
+        # Messages long enough to be sent from their stored bytes, and ones that need escaping
+        self.send_request({"type": "CR", "username": "user1", "password": "password1"})
+        self.send_request({"type": "CR", "username": "user2", "password": "password2"})
+        self.send_request({"type": "LI", "username": "user1", "password": "password1"})
+        texts = ["a" * 1000, "héllo wörld ✓ " * 50, 'say "hi" \\ ' * 50, "short"]
+        for text in texts:
+            self.send_request({"type": "SE", "from_username": "user1", "to_username": "user2", "timestamp": "2023-10-10-10:00:00", "message": text})
+
+        response = self.send_request({"type": "RE", "username": "user2", "number": 4, "requestId": 5})
+        self.assertEqual(response["requestId"], 5)
+        self.assertEqual(response["num_read"], 4)
+        self.assertEqual([message["message"] for message in response["messages"]], texts)
+        self.assertEqual(list(response["messages"][0].keys()), ["sender", "timestamp", "message", "messageId", "delivered"])
+        self.assertEqual(response["messages"][0]["delivered"], False)
+
+        self.send_request({"type": "DA", "username": "user1"})
+        self.send_request({"type": "DA", "username": "user2"})
+
+    def test_login_backlog(self):
+        # The undelivered messages follow LIT in REB pushes, and an empty REB ends them
+        self.send_request({"type": "CR", "username": "user1", "password": "password1"})
+        self.send_request({"type": "CR", "username": "user2", "password": "password2"})
+        texts = ["message " + str(i) for i in range(3)]
+        for text in texts:
+            self.send_request({"type": "SE", "from_username": "user1", "to_username": "user2", "timestamp": "2023-10-10-10:00:00", "message": text})
+        response = self.send_request({"type": "LI", "username": "user2", "password": "password2", "backlog": True})
+        self.assertEqual(response["type"], "LIT")
+        response = self.read_message()
+        self.assertEqual((response["type"], response["num_read"]), ("REB", 3))
+        self.assertEqual([message["message"] for message in response["messages"]], texts)
+        self.assertEqual(self.read_message()["num_read"], 0)
+
+        # The messages sent are marked delivered, so RE finds none left
+        self.assertEqual(self.send_request({"type": "RE", "username": "user2", "number": 3})["num_read"], 0)
+        self.send_request({"type": "DA", "username": "user1"})
+        self.send_request({"type": "DA", "username": "user2"})
+
+    def test_malformed_requests(self):
+        # A body that is not json, or a request with missing fields, only fails itself
+        self.sock.sendall(b"4{bad")
+        self.assertEqual(self.read_message()["errorMsg"], "ER0: malformed request")
+        self.assertEqual(self.send_request({"type": "CR", "username": "user1"})["errorMsg"], "ER0: malformed request")
+        response = self.send_request({"type": "RE", "username": "nobody", "number": 3, "requestId": 4})
+        self.assertEqual((response["errorMsg"], response["requestId"]), ("ER0: malformed request", 4))
+        self.assertTrue(self.send_request({"type": "CR", "username": "user1", "password": "password1"})["success"])
+        self.assertTrue(self.send_request({"type": "DA", "username": "user1"})["success"])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,47 @@
+import unittest
+import random
+import loadgen
+
+class TestLatencyHistogram(unittest.TestCase):
+    def test_small_values_are_exact(self):
+        histogram = loadgen.LatencyHistogram()
+        for value in range(1, 101):
+            histogram.record(value)
+        self.assertEqual(histogram.percentile(50), 50)
+        self.assertEqual(histogram.percentile(99), 99)
+        self.assertEqual(histogram.percentile(100), 100)
+        self.assertEqual(histogram.min, 1)
+        self.assertAlmostEqual(histogram.mean(), 50.5)
+
+    def test_relative_precision(self):
+        histogram = loadgen.LatencyHistogram(precision_bits=8)
+        rng = random.Random(1)
+        values = sorted(int(rng.lognormvariate(13, 2)) for _ in range(10000))
+        for value in values:
+            histogram.record(value)
+        for pct in (50, 90, 99, 99.9):
+            exact = values[round(len(values) * pct / 100) - 1]
+            # Within one sub-bucket above the exact value, which is under 1%
+            self.assertGreaterEqual(histogram.percentile(pct), exact)
+            self.assertLessEqual(histogram.percentile(pct), exact * (1 + 1 / 128))
+        self.assertEqual(histogram.percentile(100), values[-1])
+
+    def test_merge(self):
+        first = loadgen.LatencyHistogram()
+        second = loadgen.LatencyHistogram()
+        for value in range(1000):
+            first.record(value * 1000)
+        for value in range(1000, 2000):
+            second.record(value * 1000)
+        first.merge(second)
+        self.assertEqual(first.count, 2000)
+        self.assertEqual(first.max, 1999000)
+        self.assertAlmostEqual(first.percentile(50), 999000, delta=999000 / 128)
+
+    def test_parse_mix(self):
+        self.assertEqual(loadgen.parse_mix("SE=70, re=30"), [("SE", 70.0), ("RE", 30.0)])
+        with self.assertRaises(ValueError):
+            loadgen.parse_mix("XX=1")
+
+if __name__ == '__main__':
+    unittest.main()
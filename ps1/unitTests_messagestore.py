@@ -0,0 +1,191 @@
+import os
+import time
+import unittest
+import tempfile
+import server
+from messagestore import Message, SpillFile, measure_bytes_per_message
+
+class TestMessageStore(unittest.TestCase):
+    def tearDown(self):
+        server.accounts.clear()
+        server.account_index.clear()
+        server.messageId = 0
+
+    def test_to_dict(self):
+        message = Message(7, "alice", "2025-02-14-00:00:00", "hello", False)
+        self.assertEqual(message.to_dict(), {"sender": "alice", "timestamp": "2025-02-14-00:00:00", "message": "hello",
+                                             "messageId": 7, "delivered": False})
+        # Slotted records have no per-instance dict
+        self.assertFalse(hasattr(message, "__dict__"))
+
+    def test_senders_are_interned(self):
+        server.create_account("".join(["ali", "ce"]), "password")
+        server.create_account("bob", "password")
+        first = server.send_message("".join(["ali", "ce"]), "bob", "one", "2025-02-14-00:00:00")[1]
+        second = server.send_message("".join(["ali", "ce"]), "bob", "two", "2025-02-14-00:00:01")[1]
+        # Every message from alice shares the account's copy of the username
+        username = next(name for name in server.accounts if name == "alice")
+        self.assertIs(first.sender, second.sender)
+        self.assertIs(first.sender, username)
+
+    def test_bytes_per_message(self):
+        stored = []
+        bytes_per_message = measure_bytes_per_message(
+            lambda sender, time, message: stored.append(Message(len(stored), sender, time, message, False)), 1000)
+        self.assertEqual(len(stored), 1000)
+        # A message and its strings take a few hundred bytes, far below the dict it replaced
+        self.assertGreater(bytes_per_message, 100)
+        self.assertLess(bytes_per_message, 500)
+
+class TestSpillFile(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.spill = SpillFile(os.path.join(self.dir.name, "user.spill"))
+        for i in range(5):
+            self.spill.append(Message(i * 2, "alice", "2025-02-14-00:00:00", f"message {i}", False))
+
+    def tearDown(self):
+        self.spill.remove()
+        self.dir.cleanup()
+
+    def test_take_in_order(self):
+        self.spill.discard(2)
+        self.assertEqual(len(self.spill), 4)
+        self.assertIn(4, self.spill)
+        self.assertNotIn(2, self.spill)
+        self.assertNotIn(3, self.spill)
+        self.assertEqual([m.message for m in self.spill.take(2)], ["message 0", "message 2"])
+        self.assertNotIn(0, self.spill)
+        # Reading leaves the messages in the file
+        self.assertEqual([m.message_id for m in self.spill.read()[0]], [6, 8])
+        # Every append went through the same open file, which is closed once the file is drained
+        appended = self.spill.file
+        self.spill.append(Message(10, "alice", "2025-02-14-00:00:00", "message 5", False))
+        self.assertIs(self.spill.file, appended)
+        self.assertEqual([m.message_id for m in self.spill.take(10)], [6, 8, 10])
+        self.assertEqual(len(self.spill), 0)
+        self.assertTrue(appended.closed)
+        self.assertIsNone(self.spill.file)
+        self.assertFalse(os.path.exists(self.spill.path))
+
+class TestRetention(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        server.create_account("alice", "password")
+        server.create_account("bob", "password")
+        server.create_account("carol", "password")
+
+    def tearDown(self):
+        if server.journal is not None:
+            server.journal.close()
+            server.journal = None
+        server.restore_state(None, [])
+        server.messageId = 0
+        server.RETAIN_DELIVERED = 0
+        server.RETAIN_DELIVERED_TOTAL = 0
+        server.RETAIN_SECONDS = 0
+        server.SPILL_DIR = None
+        server.SPILL_AFTER = 0
+        self.dir.cleanup()
+
+    def send(self, to_username, count):
+        return [server.send_message("alice", to_username, f"message {i}", "2025-02-14-00:00:00")[1].message_id for i in range(count)]
+
+    def test_per_user_limit(self):
+        server.RETAIN_DELIVERED = 2
+        undelivered = self.send("bob", 2)
+        server.login("bob", "password", None)
+        delivered = self.send("bob", 3)
+        # The oldest delivered message is dropped, the undelivered ones are kept whatever their age
+        self.assertEqual(list(server.accounts["bob"]["messageHistory"]), undelivered + delivered[1:])
+
+    def test_global_and_age_limits(self):
+        server.RETAIN_DELIVERED_TOTAL = 3
+        trimmed = server.mailbox_stats["trimmed_messages"]
+        server.login("bob", "password", None)
+        server.login("carol", "password", None)
+        to_bob = self.send("bob", 2)
+        to_carol = self.send("carol", 2)
+        self.assertEqual(list(server.accounts["bob"]["messageHistory"]), to_bob[1:])
+        self.assertEqual(list(server.accounts["carol"]["messageHistory"]), to_carol)
+        server.RETAIN_SECONDS = 60
+        server.trim_delivered(time.time() + 61)
+        self.assertEqual(server.accounts["bob"]["messageHistory"], {})
+        self.assertEqual(server.accounts["carol"]["messageHistory"], {})
+        self.assertEqual(server.mailbox_stats["trimmed_messages"] - trimmed, 4)
+
+    def test_spill_and_read_back(self):
+        server.SPILL_DIR = self.dir.name
+        server.SPILL_AFTER = 2
+        ids = self.send("bob", 6)
+        self.assertEqual(list(server.accounts["bob"]["undelivered"]), ids[:2])
+        self.assertEqual(len(server.accounts["bob"]["spill"]), 4)
+        # Spilled messages can be deleted without reading them back
+        self.assertEqual(server.delete_message("bob", ids[3])[0], True)
+        read = server.read_message("bob", 4)[1]
+        self.assertEqual([m.message_id for m in read["messages"]], [ids[0], ids[1], ids[2], ids[4]])
+        self.assertEqual(len(server.accounts["bob"]["spill"]), 1)
+        # A snapshot holds the messages still on disk
+        snapshot = server.snapshot_state()
+        self.assertEqual([m[0] for m in snapshot["accounts"]["bob"][1]], [ids[0], ids[1], ids[2], ids[4], ids[5]])
+        server.delete_account("bob")
+        self.assertEqual(os.listdir(self.dir.name), [])
+
+    def test_spill_survives_restart(self):
+        server.SPILL_DIR = os.path.join(self.dir.name, "spill")
+        server.SPILL_AFTER = 1
+        server.restore_state(None, [])
+        server.open_journal(os.path.join(self.dir.name, "journal"))
+        server.create_account("bob", "password")
+        ids = self.send("bob", 3)
+        server.delete_message("bob", ids[2])
+        server.journal.close()
+        server.journal = None
+        server.open_journal(os.path.join(self.dir.name, "journal"))
+        read = server.read_message("bob", 5)[1]
+        self.assertEqual([m.message for m in read["messages"]], ["message 0", "message 1"])
+
+    def open_journal(self):
+        server.restore_state(None, [])
+        server.open_journal(os.path.join(self.dir.name, "journal"))
+        server.create_account("bob", "password")
+
+    def restart(self):
+        server.journal.close()
+        server.journal = None
+        server.open_journal(os.path.join(self.dir.name, "journal"))
+
+    def test_failed_push_after_spill(self):
+        server.SPILL_DIR = os.path.join(self.dir.name, "spill")
+        server.SPILL_AFTER = 1
+        self.open_journal()
+        ids = self.send("bob", 3)
+        server.login("bob", "password", None)
+        pushed = server.send_message("alice", "bob", "pushed", "2025-02-14-00:00:00")[1]
+        # The live push failed, and the message goes behind the older ones waiting in the spill file
+        server.mark_undelivered("bob", pushed)
+        self.assertEqual([m.message_id for m in server.read_message("bob", 10)[1]["messages"]], ids + [pushed.message_id])
+        self.restart()
+        self.assertEqual([m.message_id for m in server.read_message("bob", 10)[1]["messages"]], ids + [pushed.message_id])
+
+    def test_backlog_delivered_after_restart(self):
+        server.SPILL_DIR = os.path.join(self.dir.name, "spill")
+        server.SPILL_AFTER = 2
+        self.open_journal()
+        ids = self.send("bob", 3)
+        server.login("bob", "password", None)
+        # The whole backlog is sent, including the message that was read back from the spill file
+        chunk = []
+        while True:
+            chunk = [m.message_id for m in server.read_backlog("bob", 2, chunk)[1]["messages"]]
+            if not chunk:
+                break
+        self.assertEqual(server.read_message("bob", 10)[1]["num_read"], 0)
+        # On replay the last message is spilled again before it is marked delivered
+        self.restart()
+        self.assertEqual(server.read_message("bob", 10)[1]["num_read"], 0)
+        self.assertEqual([(m.message_id, m.delivered) for m in server.accounts["bob"]["messageHistory"].values()],
+                         [(message_id, True) for message_id in ids])
+
+if __name__ == '__main__':
+    unittest.main()
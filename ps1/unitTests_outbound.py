@@ -0,0 +1,48 @@
+import unittest
+import socket
+from outbound import OutboundQueue, ReplyBuilder, MIN_SEGMENT
+
+class TestOutbound(unittest.TestCase):
+    def test_reply_builder(self):
+        body = "✓".encode("utf-8") * MIN_SEGMENT
+        builder = ReplyBuilder()
+        builder.text("RET2 ")
+        builder.segment(b"hi", 2)
+        builder.text(" ")
+        builder.segment(body, MIN_SEGMENT)
+        builder.raw(b"\x00\x01")
+        segments = builder.finish()
+        # The short segment is copied into the framing, the long one is kept as it is
+        self.assertEqual(segments, [b"RET2 hi ", body, b"\x00\x01"])
+        self.assertIs(segments[1], body)
+        self.assertEqual(builder.num_bytes, len(b"".join(segments)))
+        self.assertEqual(builder.num_chars, len("RET2 hi ") + MIN_SEGMENT)
+
+    def test_send_partially(self):
+        sender, receiver = socket.socketpair()
+        sender.setblocking(False)
+        sender.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        payload = [b"a" * 1000, bytes(range(256)) * 1000, b"end"]
+        expected = b"".join(payload)
+        queue = OutboundQueue()
+        queue.append(payload)
+        queue.append(bytearray(b"!"))
+        expected += b"!"
+        self.assertEqual(len(queue), len(expected))
+
+        received = bytearray()
+        while queue:
+            try:
+                queue.send(sender)
+            except BlockingIOError:
+                pass
+            received += receiver.recv(65536)
+        while len(received) < len(expected):
+            received += receiver.recv(65536)
+        self.assertEqual(bytes(received), expected)
+        self.assertEqual(len(queue), 0)
+        sender.close()
+        receiver.close()
+
+if __name__ == '__main__':
+    unittest.main()
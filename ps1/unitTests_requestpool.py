@@ -0,0 +1,74 @@
+import unittest
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import server
+
+class TestRequestPool(unittest.TestCase):
+    def setUp(self):
+        server.request_pool = ThreadPoolExecutor(4, thread_name_prefix="request")
+        self.wakeup_reader, server.wakeup_writer = socket.socketpair()
+        server.wakeup_writer.setblocking(False)
+        self.lsock = socket.create_server(("127.0.0.1", 0))
+        self.client = socket.create_connection(self.lsock.getsockname())
+        self.client.settimeout(10)
+        with server.state_lock:
+            server.accept_wrapper(self.lsock)
+
+        # The select loop of serve_selector, for the client connection only
+        self.stopped = threading.Event()
+
+        def run_loop():
+            while not self.stopped.is_set():
+                events = server.sel.select(timeout=0.05)
+                with server.state_lock:
+                    server.service_events(events)
+
+        self.thread = threading.Thread(target=run_loop, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.stopped.set()
+        self.thread.join()
+        server.request_pool.shutdown()
+        server.request_pool = None
+        with server.state_lock:
+            for sock in list(server.connections_by_id.values()):
+                server.close_connection(sock, server.connection_data(sock))
+        server.wakeup_writer.close()
+        server.wakeup_writer = None
+        self.wakeup_reader.close()
+        self.client.close()
+        self.lsock.close()
+        server.accounts.clear()
+        server.account_index.clear()
+
+    def read_replies(self, num):
+        buf = b""
+        replies = []
+        while len(replies) < num:
+            buf += self.client.recv(65536)
+            # Every reply here is ascii, so its length prefix counts bytes
+            while buf[:1].isdigit():
+                digits = len(buf) - len(buf.lstrip(b"0123456789"))
+                if digits == len(buf):
+                    break
+                end = digits + int(buf[:digits])
+                if end > len(buf):
+                    break
+                replies.append(buf[digits:end].decode("utf-8"))
+                buf = buf[end:]
+        return replies
+
+    def test_replies_keep_request_order(self):
+        # Every request depends on the one before it, so running two of them out of order fails one of them
+        requests = []
+        for i in range(50):
+            requests += [f"CRuser{i} password", f"LIuser{i} password", f"LOuser{i}", f"DAuser{i}"]
+        self.client.sendall("".join(str(len(request)) + request for request in requests).encode("utf-8"))
+        replies = self.read_replies(len(requests))
+        self.assertEqual([reply[:3] for reply in replies], ["CRT", "LIT", "LOT", "DAT"] * 50)
+        self.assertEqual(server.accounts, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+import selectors
+import socket
+import struct
+import server
+
+class TestSelectorLoop(unittest.TestCase):
+    def setUp(self):
+        self.lsock = socket.create_server(("127.0.0.1", 0))
+        self.clients = []
+        for _ in range(2):
+            self.clients.append(socket.create_connection(self.lsock.getsockname()))
+            server.accept_wrapper(self.lsock)
+
+    def tearDown(self):
+        for sock in list(server.connections_by_id.values()):
+            server.close_connection(sock, server.connection_data(sock))
+        for sock in self.clients + [self.lsock]:
+            sock.close()
+        server.accounts.clear()
+        server.account_index.clear()
+
+    def send(self, client, request):
+        client.sendall((str(len(request)) + request).encode("utf-8"))
+
+    def serve(self, client, reply):
+        # Runs the select loop until the client was sent the reply
+        received = b""
+        client.setblocking(False)
+        for _ in range(100):
+            server.service_events(server.sel.select(timeout=0.1))
+            try:
+                received += client.recv(4096)
+            except BlockingIOError:
+                pass
+            if reply in received:
+                return received
+        self.fail(f"no {reply!r} in {received!r}")
+
+    def test_closed_in_same_batch(self):
+        sender, receiver = self.clients
+        sender_sock, receiver_sock = server.connections_by_id.values()
+        self.send(sender, "CRuser1 password")
+        self.serve(sender, b"CRT")
+        self.send(sender, "CRuser2 password")
+        self.serve(sender, b"CRT")
+        self.send(receiver, "LIuser2 password")
+        self.serve(receiver, b"LIT")
+
+        # The receiver resets its connection, so the push to it fails and closes it while its own read event
+        # waits later in the batch
+        receiver.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        receiver.close()
+        self.send(sender, "SEuser1 user2 2023-10-10-10:00:00 hello")
+        while len(server.sel.select(timeout=1)) < 2:
+            pass
+        server.service_events([(server.sel.get_key(sock), selectors.EVENT_READ) for sock in (sender_sock, receiver_sock)])
+        self.assertEqual(list(server.connections_by_id.values()), [sender_sock])
+
+        # The server keeps serving, and the message was left for RE
+        self.send(sender, "REuser2 1")
+        self.assertIn(b"hello", self.serve(sender, b"RET1"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import unittest
+import selectors
+import socket
+import threading
+import time
+from unittest import mock
+import shards
+import server
+from messagestore import Message
+
+class TestShards(unittest.TestCase):
+    def setUp(self):
+        first, second = socket.socketpair()
+        self.caller = shards.Mesh(0, {1: shards.Channel(1, first)})
+        self.owner = shards.Mesh(1, {0: shards.Channel(0, second)})
+        self.notifications = []
+
+        def deliver(to_username, message):
+            # Notifications sent before the result must reach the caller first
+            self.owner.notify(0, {"op": "directory", "username": to_username})
+            return [True, Message(7, "alice", "2025-02-14-00:00:00", message, False)]
+
+        def fail(text):
+            raise ValueError(text)
+
+        def slow(text):
+            time.sleep(0.3)
+            return text
+
+        self.stopped = threading.Event()
+        selector = selectors.DefaultSelector()
+        self.owner.serve(selector, {"deliver": deliver, "fail": fail, "slow": slow}, lambda worker, message: None)
+
+        def run_owner():
+            while not self.stopped.is_set():
+                for key, mask in selector.select(timeout=0.05):
+                    self.owner.service(key.data, mask)
+
+        self.thread = threading.Thread(target=run_owner, daemon=True)
+        self.thread.start()
+        self.selector = selectors.DefaultSelector()
+        self.caller.serve(self.selector, {}, lambda worker, message: self.notifications.append((worker, message)))
+
+    def tearDown(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def wait(self, done, seconds):
+        """Services the caller's channel like the select loop, until done returns True or the time is up."""
+        end = time.monotonic() + seconds
+        while not done() and time.monotonic() < end:
+            for key, mask in self.selector.select(timeout=0.05):
+                self.caller.service(key.data, mask)
+            self.caller.expire_calls(time.monotonic())
+
+    def test_call(self):
+        results = []
+        self.caller.call(1, "deliver", ["bob", "héllo ✓" * 100], lambda result, error: results.append((result, error, list(self.notifications))))
+        self.caller.call(1, "fail", ["bad request"], lambda result, error: results.append((result, error)))
+        # The call returns before the owner answers
+        self.assertEqual(results, [])
+        self.wait(lambda: len(results) == 2, 5)
+        result, error, notifications = results[0]
+        self.assertIsNone(error)
+        self.assertEqual((result[1].message_id, result[1].sender, result[1].message), (7, "alice", "héllo ✓" * 100))
+        self.assertEqual(notifications, [(1, {"op": "directory", "username": "bob"})])
+        self.assertIsNone(results[1][0])
+        self.assertIsInstance(results[1][1], ValueError)
+        self.assertEqual(self.caller.stats["calls_sent"], 2)
+        self.assertEqual(self.owner.stats["calls_served"], 2)
+        self.assertEqual(self.caller.calls, {})
+
+    def test_timeout(self):
+        results = []
+        with mock.patch.object(shards, "CALL_TIMEOUT", 0.1):
+            self.caller.call(1, "slow", ["late"], lambda result, error: results.append((result, error)))
+            self.assertAlmostEqual(self.caller.time_to_next_deadline(time.monotonic()), 0.1, delta=0.05)
+            self.wait(lambda: results, 5)
+        self.assertIsNone(results[0][0])
+        self.assertIsInstance(results[0][1], TimeoutError)
+        self.assertEqual(self.caller.stats["call_timeouts"], 1)
+        self.assertIsNone(self.caller.time_to_next_deadline(time.monotonic()))
+        # The result that arrives after the call timed out is dropped
+        self.wait(lambda: False, 0.5)
+        self.assertEqual(len(results), 1)
+
+    def test_encode(self):
+        self.assertEqual(shards.decode_value({"$connection": [2, 5]}), shards.RemoteConnection(2, 5))
+        frame = shards.encode({"op": "call", "id": 1, "function": "login", "args": ["bob", "pw", shards.RemoteConnection(2, 5)]})
+        self.assertIn(b'{"$connection": [2, 5]}', frame)
+
+class TestOwner(unittest.TestCase):
+    def tearDown(self):
+        server.accounts.clear()
+        server.account_index.clear()
+
+    def test_remote_connection_closed(self):
+        server.create_account("bob", "password")
+        server.login("bob", "password", shards.RemoteConnection(2, 5))
+        # Another connection of the worker that held the login closing changes nothing
+        server.handle_shard_message(2, {"op": "closed", "username": "bob", "conn_id": 6})
+        self.assertTrue(server.accounts["bob"]["loggedIn"])
+        # The user is logged out once the connection it logged in from closes
+        server.handle_shard_message(2, {"op": "closed", "username": "bob", "conn_id": 5})
+        self.assertFalse(server.accounts["bob"]["loggedIn"])
+        self.assertIsNone(server.accounts["bob"]["socket"])
+
+    def test_carry_out_request(self):
+        # Requests another worker parked are carried out for its connection
+        conn = shards.RemoteConnection(2, 5)
+        self.assertEqual(server.carry_out_request("CR", {"username": "bob", "password": "password"}, conn), [True, ""])
+        self.assertEqual(server.carry_out_request("LI", {"username": "bob", "password": "password", "backlog": True}, conn), [True, ""])
+        self.assertEqual(server.accounts["bob"]["socket"], conn)
+        with mock.patch.object(shards, "mesh") as mesh:
+            call_info = server.carry_out_request("SB", {"from_username": "alice", "timestamp": "t", "items": [["bob", "hi"], ["carol", "hi"]]}, conn)
+        self.assertEqual(server.batch_statuses(call_info[1]), ["T", "ER1"])
+        # bob is pushed to by the worker that holds the connection, without waiting for it
+        mesh.notify.assert_called_once_with(2, {"op": "push", "pushes": [["bob", 5, call_info[1][0][1]]]})
+        mesh.call.assert_not_called()
+
+    def test_undelivered(self):
+        # A push the worker holding the connection could not send is left for RE
+        server.create_account("bob", "password")
+        server.login("bob", "password", shards.RemoteConnection(2, 5))
+        stored = server.send_message("alice", "bob", "hello", "t")[1]
+        self.assertEqual(server.read_message("bob", 10)[1]["num_read"], 0)
+        server.handle_shard_message(2, {"op": "undelivered", "messages": [["bob", stored]]})
+        self.assertEqual([message.message for message in server.read_message("bob", 10)[1]["messages"]], ["hello"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+from timerwheel import TimerWheel
+
+class TestTimerWheel(unittest.TestCase):
+    def test_expires_on_time(self):
+        wheel = TimerWheel(tick=1.0, num_slots=8)
+        wheel.schedule("a", 2.5)
+        wheel.schedule("b", 4.0)
+        self.assertEqual(len(wheel), 2)
+        # Keys never expire before their deadline
+        self.assertEqual(wheel.advance(2.9), [])
+        self.assertEqual(wheel.advance(3.0), ["a"])
+        self.assertEqual(wheel.advance(3.5), [])
+        self.assertEqual(wheel.advance(4.0), ["b"])
+        self.assertEqual(len(wheel), 0)
+
+    def test_deadlines_past_one_turn(self):
+        wheel = TimerWheel(tick=1.0, num_slots=4)
+        wheel.schedule("far", 10.0)
+        wheel.schedule("near", 2.0)
+        # "far" shares a slot with "near" but is due two turns later
+        self.assertEqual(wheel.advance(2.0), ["near"])
+        self.assertEqual(wheel.advance(9.0), [])
+        self.assertEqual(wheel.advance(10.0), ["far"])
+
+    def test_stall_longer_than_a_turn(self):
+        wheel = TimerWheel(tick=1.0, num_slots=4)
+        for deadline in range(1, 9):
+            wheel.schedule(deadline, deadline)
+        # Every slot is visited once, and everything that is due expires
+        self.assertEqual(sorted(wheel.advance(100.0)), list(range(1, 9)))
+        self.assertEqual(len(wheel), 0)
+
+    def test_past_deadline_and_next_tick(self):
+        wheel = TimerWheel(tick=0.5, now=10.2)
+        self.assertAlmostEqual(wheel.time_to_next_tick(10.2), 0.3)
+        # A deadline that already passed expires on the next tick
+        wheel.schedule("late", 3.0)
+        self.assertEqual(wheel.advance(10.4), [])
+        self.assertEqual(wheel.advance(10.5), ["late"])
+
+if __name__ == '__main__':
+    unittest.main()
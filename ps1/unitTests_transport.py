@@ -0,0 +1,57 @@
+import unittest
+import errno
+import os
+import socket
+import tempfile
+import transport
+
+class TestTransport(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "server.sock")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_addresses(self):
+        self.assertEqual(transport.unix_path("unix:/tmp/ps1.sock"), "/tmp/ps1.sock")
+        self.assertIsNone(transport.unix_path("127.0.0.1"))
+        self.assertEqual(transport.format_address("unix:/tmp/ps1.sock", 54400), "unix:/tmp/ps1.sock")
+        self.assertEqual(transport.format_address("127.0.0.1", 54400), "127.0.0.1:54400")
+
+    def test_connect_unix(self):
+        # A socket left behind by a server that did not shut down cleanly is replaced
+        transport.listen_unix(self.path, 8).close()
+        lsock = transport.listen_unix(self.path, 8)
+        client = transport.connect(transport.UNIX_PREFIX + self.path, 0, timeout=5)
+        lsock.setblocking(True)
+        conn, _ = lsock.accept()
+        client.sendall(b"3CRT")
+        self.assertEqual(conn.recv(4), b"3CRT")
+        self.assertEqual(client.family, socket.AF_UNIX)
+        for sock in (conn, client, lsock):
+            sock.close()
+
+    def test_keep_live_socket(self):
+        # A server that is running keeps its socket, and a second one fails to start
+        lsock = transport.listen_unix(self.path, 8)
+        with self.assertRaises(OSError) as raised:
+            transport.listen_unix(self.path, 8)
+        self.assertEqual(raised.exception.errno, errno.EADDRINUSE)
+        client = transport.connect(transport.UNIX_PREFIX + self.path, 0, timeout=5)
+        lsock.setblocking(True)
+        conn, _ = lsock.accept()
+        for sock in (conn, client, lsock):
+            sock.close()
+
+    def test_keep_other_files(self):
+        # Anything at the path that is not a socket is left alone
+        with open(self.path, "w") as f:
+            f.write("data")
+        with self.assertRaises(OSError):
+            transport.listen_unix(self.path, 8)
+        with open(self.path) as f:
+            self.assertEqual(f.read(), "data")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,11 @@
 import unittest
-import socket
+import codecs
+import time
 import os
 from dotenv import load_dotenv
+import wire_v2
+import compression
+import transport
 
 load_dotenv()
 
@@ -10,8 +14,8 @@ PORT = int(os.environ.get("PORT_SERVER_TESTING"))
 
 class TestServerMethods(unittest.TestCase):
     def setUp(self):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect((HOST, PORT))
+        # HOST_SERVER_TESTING may be "unix:<path>" to test over the server's Unix domain socket
+        self.sock = transport.connect(HOST, PORT)
 
     def tearDown(self):
         self.sock.close()
@@ -29,15 +33,15 @@ class TestServerMethods(unittest.TestCase):
             recv_data = self.sock.recv(1)
         num_bytes = int(str_bytes)
 
-        # Reads the next num_bytes bytes to get the full message
-        response = recv_data
-        cur_bytes = 1
-        while(cur_bytes < num_bytes):
-            recv_data = self.sock.recv(num_bytes - cur_bytes)
+        # Reads the next num_bytes bytes to get the full message. The length counts characters, and a
+        # multibyte character can be split between two reads, so they are decoded incrementally.
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        response = decoder.decode(recv_data)
+        while(len(response) < num_bytes):
+            recv_data = self.sock.recv(num_bytes - len(response))
             if recv_data:
-                response += recv_data
-                cur_bytes += len(recv_data.decode("utf-8"))
-        return response.decode("utf-8")
+                response += decoder.decode(recv_data)
+        return response
 
     def send_request(self, request):
         request = str(len(request)) + request
@@ -272,5 +276,303 @@ class TestServerMethods(unittest.TestCase):
         response = self.send_request(request)
         self.assertEqual(response[0:3], "DAT")
 
+    def test_read_message_after_delete(self):
+        # Create two accounts and login to just the sender account
+        self.send_request("CRuser1 password1")
+        self.send_request("CRuser2 password2")
+        self.send_request("LIuser1 password1")
+
+        # Send three messages while the recipient is logged out
+        for text in ["first", "second", "third"]:
+            response = self.send_request("SEuser1 user2 2023-10-10-10:00:00 " + text)
+            self.assertEqual(response[0:3], "SET")
+
+        # Delete the second message, and reading should return the others in the order they were sent
+        response = self.send_request("REuser2 3")
+        second_id = response.split(" ")[5]
+        response = self.send_request("DMuser2 " + second_id)
+        self.assertEqual(response[0:3], "DMT")
+        response = self.send_request("REuser2 3")
+        self.assertEqual(response[0:4], "RET2")
+        self.assertIn("5first", response)
+        self.assertIn("5third", response)
+        self.assertNotIn("second", response)
+
+        # Reading fewer messages than are waiting only returns the oldest ones
+        response = self.send_request("REuser2 1")
+        self.assertEqual(response[0:4], "RET1")
+        self.assertNotIn("third", response)
+
+        # Delete account to clean up
+        self.assertEqual(self.send_request("DAuser1")[0:3], "DAT")
+        self.assertEqual(self.send_request("DAuser2")[0:3], "DAT")
+
+    def test_send_batch(self):
+        self.send_request("CRuser1 password1")
+        self.send_request("CRuser2 password2")
+        self.send_request("CRuser3 password3")
+
+        # Send several messages in one request, and each one gets its own status
+        messages = [("user2", "first message"), ("user4", "lost"), ("user3", "second")]
+        request = "SBuser1 2023-10-10-10:00:00 3" + "".join(f" {to} {len(text)} {text}" for to, text in messages)
+        self.assertEqual(self.send_request(request), "SBTT ER1 T")
+
+        # Send one message to many users, including a logged in user who gets it pushed right away
+        self.send_request("LIuser1 password1")
+        request = "SMuser1 2023-10-10-10:00:00 3 user2 user4 user1 hello everyone"
+        self.sock.sendall((str(len(request)) + request).encode('utf-8'))
+        self.assertEqual(self.read_message()[0:3], "SEL")
+        self.assertEqual(self.read_message(), "SMTT ER1 T")
+
+        response = self.send_request("REuser2 5")
+        self.assertEqual(response[0:4], "RET2")
+        self.assertIn("first message", response)
+        self.assertIn("hello everyone", response)
+
+        # Malformed batches are rejected as a whole
+        self.assertEqual(self.send_request("SBuser1 2023-10-10-10:00:00 2 user2 50 too short"), "ER0")
+
+        # Delete account to clean up
+        self.assertEqual(self.send_request("DAuser1")[0:3], "DAT")
+        self.assertEqual(self.send_request("DAuser2")[0:3], "DAT")
+        self.assertEqual(self.send_request("DAuser3")[0:3], "DAT")
+
+    def test_search_accounts(self):
+        for username in ["searchb", "searcha", "searchc", "other"]:
+            self.send_request(f"CR{username} password")
+
+        # Pages come back in sorted order with the cursor of the next page first
+        self.assertEqual(self.send_request("LSsearch  2"), "LSTsearchb searcha searchb")
+        self.assertEqual(self.send_request("LSsearch searchb 2"), "LST searchc")
+        self.assertEqual(self.send_request("LSnobody  2"), "LST")
+
+        # Delete account to clean up
+        for username in ["searchb", "searcha", "searchc", "other"]:
+            self.assertEqual(self.send_request(f"DA{username}")[0:3], "DAT")
+
+    def test_directory_subscription(self):
+        # Subscribe, and the reply is the directory version followed by every username
+        self.send_request("CRuser1 password1")
+        version, *accounts = self.send_request("SU")[3:].split(" ")
+        self.assertIn("user1", accounts)
+
+        # Account changes made by another client are pushed with the next directory versions
+        other = transport.connect(HOST, PORT)
+        try:
+            for request in ["CRuser2 password2", "DAuser2"]:
+                other.sendall((str(len(request)) + request).encode('utf-8'))
+            self.assertEqual(self.read_message(), f"ACA{int(version) + 1} user2")
+            self.assertEqual(self.read_message(), f"ACD{int(version) + 2} user2")
+        finally:
+            other.close()
+
+        # Delete account to clean up, which is pushed to this client too, ahead of the reply
+        request = "DAuser1"
+        self.sock.sendall((str(len(request)) + request).encode('utf-8'))
+        self.assertEqual(self.read_message(), f"ACD{int(version) + 3} user1")
+        self.assertEqual(self.read_message(), "DAT")
+
+    def test_server_stats(self):
+        self.send_request("CRuser1 password1")
+        self.send_request("CRuser1 password1")
+
+        # The reply is space separated name value pairs
+        fields = self.send_request("ST")[3:].split(" ")
+        stats = dict(zip(fields[0::2], fields[1::2]))
+        self.assertGreaterEqual(int(stats["CR.count"]), 2)
+        self.assertGreaterEqual(int(stats["CR.errors"]), 1)
+        self.assertGreater(float(stats["CR.p99_us"]), 0)
+        self.assertGreater(int(stats["bytes_in"]), 0)
+        self.assertGreaterEqual(int(stats["connections"]), 1)
+
+        # Delete account to clean up
+        self.assertEqual(self.send_request("DAuser1")[0:3], "DAT")
+
+    def read_message_v2(self):
+        # Reads one version 2 frame and returns its (opcode, request id, fields). Frames that arrive in the
+        # same read are kept for the next call.
+        if not hasattr(self, "v2_frames"):
+            self.v2_buf = bytearray()
+            self.v2_frames = []
+        while not self.v2_frames:
+            self.v2_buf += self.sock.recv(4096)
+            self.v2_frames += wire_v2.extract_frames(self.v2_buf, max_decompressed=1024 * 1024)
+        return self.v2_frames.pop(0)
+
+    def send_request_v2(self, opcode, request_id, fields):
+        self.sock.sendall(wire_v2.encode_frame(opcode, request_id, fields))
+        return self.read_message_v2()
+
+    def test_wire_v2(self):
+        # Negotiate version 2, and unsupported versions should be rejected
+        self.assertEqual(self.send_request("VE9")[0:3], "ER5")
+        self.assertEqual(self.send_request("VE2"), "VET2")
+
+        # Replies echo the request id
+        self.assertEqual(self.send_request_v2("CR", 1, ["user1", "password1"]), ("CRT", 1, []))
+        self.assertEqual(self.send_request_v2("CR", 2, ["user2", "password2"]), ("CRT", 2, []))
+        self.assertEqual(self.send_request_v2("LI", 3, ["user1", "password1"]), ("LIT", 3, []))
+        opcode, request_id, fields = self.send_request_v2("LI", 4, ["user1", "wrongpassword"])
+        self.assertEqual((opcode, request_id), ("ER2", 4))
+        self.assertEqual(fields, ["ER2: incorrect password"])
+
+        # Message bodies with spaces and multibyte characters survive the trip
+        text = "héllo wörld  ✓"
+        self.assertEqual(self.send_request_v2("SE", 5, ["user1", "user2", "2023-10-10 10:00:00", text]), ("SET", 5, []))
+        opcode, request_id, fields = self.send_request_v2("RE", 6, ["user2", 5])
+        self.assertEqual((opcode, request_id, fields[0]), ("RET", 6, "1"))
+        self.assertEqual(fields[2:], ["user1", "2023-10-10 10:00:00", text])
+
+        # Batches reply with one status per message, and the logged in user gets a v2 push
+        fields = ["user2", "2023-10-10 10:00:00", "same text", "user1", "user9", "user2"]
+        self.sock.sendall(wire_v2.encode_frame("SM", 7, fields))
+        opcode, request_id, fields = self.read_message_v2()
+        self.assertEqual((opcode, request_id, fields[1:]), ("SEL", 0, ["user2", "2023-10-10 10:00:00", "same text"]))
+        self.assertEqual(self.read_message_v2(), ("SMT", 7, ["T", "ER1", "T"]))
+        fields = ["user1", "2023-10-10 10:00:00", "user2", "one", "user9", "two"]
+        self.assertEqual(self.send_request_v2("SB", 8, fields), ("SBT", 8, ["T", "ER1"]))
+
+        # On a compressed connection large frames are compressed both ways
+        self.assertEqual(self.send_request_v2("CM", 11, ["zlib"]), ("CMT", 11, ["zlib"]))
+        text = "✓ compressible " * 200
+        frame = wire_v2.compress_frame(wire_v2.encode_frame("SE", 12, ["user1", "user2", "2023-10-10 10:00:00", text]), 1024)
+        self.assertTrue(wire_v2.HEADER.unpack_from(frame)[0] & wire_v2.COMPRESSED_FLAG)
+        self.sock.sendall(frame)
+        self.assertEqual(self.read_message_v2(), ("SET", 12, []))
+        self.sock.sendall(wire_v2.encode_frame("RE", 13, ["user2", 10]))
+        self.assertEqual(self.read_message_v2()[2][-1], text)
+
+        # Delete account to clean up
+        self.assertEqual(self.send_request_v2("DA", 9, ["user1"])[0], "DAT")
+        self.assertEqual(self.send_request_v2("DA", 10, ["user2"])[0], "DAT")
+
+    def read_compressed_message(self):
+        # Reads one frame on a connection that negotiated compression, and returns its body and whether
+        # it was compressed
+        recv_data = self.sock.recv(1)
+        compressed = recv_data == b"Z"
+        str_bytes = "" if compressed else recv_data.decode("utf-8")
+        recv_data = self.sock.recv(1)
+        while recv_data.isdigit():
+            str_bytes += recv_data.decode("utf-8")
+            recv_data = self.sock.recv(1)
+        if compressed:
+            # The byte length is followed by a space and then the compressed body
+            body = b""
+            while len(body) < int(str_bytes):
+                body += self.sock.recv(int(str_bytes) - len(body))
+            return compression.decompress(body, 1024 * 1024).decode("utf-8"), True
+        response = recv_data
+        while len(response.decode("utf-8")) < int(str_bytes):
+            response += self.sock.recv(int(str_bytes) - len(response.decode("utf-8")))
+        return response.decode("utf-8"), False
+
+    def test_compression(self):
+        self.assertEqual(self.send_request("CMgzip")[0:3], "ER5")
+        self.assertEqual(self.send_request("CMzlib"), "CMTzlib")
+        self.send_request("CRuser1 password1")
+        self.send_request("CRuser2 password2")
+
+        # A large message is sent compressed, and comes back compressed in the RE reply
+        text = "all work and no play makes jack a dull boy " * 100
+        request = ("SEuser1 user2 2023-10-10-10:00:00 " + text).encode('utf-8')
+        request = compression.compress_frame(str(len(request)).encode('utf-8') + request, 1024)
+        self.assertEqual(request[0:1], b"Z")
+        self.sock.sendall(request)
+        self.assertEqual(self.read_compressed_message(), ("SET", False))
+        self.sock.sendall(b"9REuser2 1")
+        response, compressed = self.read_compressed_message()
+        self.assertTrue(compressed)
+        self.assertEqual(response[0:4], "RET1")
+        self.assertTrue(response.endswith(text))
+
+        # Delete account to clean up
+        for request in [b"7DAuser1", b"7DAuser2"]:
+            self.sock.sendall(request)
+            self.assertEqual(self.read_compressed_message(), ("DAT", False))
+
+    def test_pipelined_requests(self):
+        # Send two requests in a single write, and the server should answer both in order
+        requests = ["CRuser1 password1", "LIuser1 password1"]
+        payload = "".join(str(len(request)) + request for request in requests)
+        self.sock.sendall(payload.encode('utf-8'))
+        self.assertEqual(self.read_message()[0:3], "CRT")
+        self.assertEqual(self.read_message()[0:3], "LIT")
+
+        # Send a request split across two writes, and the server should wait for the rest of it
+        request = "DAuser1"
+        request = str(len(request)) + request
+        self.sock.sendall(request[:4].encode('utf-8'))
+        time.sleep(0.1)
+        self.sock.sendall(request[4:].encode('utf-8'))
+        self.assertEqual(self.read_message()[0:3], "DAT")
+
+    def test_request_ids(self):
+        # Tagged requests get replies tagged with the same id, untagged requests get untagged replies
+        self.assertEqual(self.send_request("#7 CRuser1 password1"), "#7 CRT")
+        self.assertEqual(self.send_request("CRuser2 password2"), "CRT")
+        self.assertEqual(self.send_request("#8 LIuser1 password1"), "#8 LIT")
+
+        # A burst of sends in one write, with every reply matched to its request by id and the
+        # pushes to the logged in receiver carrying no id
+        requests = [f"#{100 + i} SEuser2 user1 2023-10-10-10:00:00 message {i}" for i in range(5)]
+        self.sock.sendall("".join(str(len(request)) + request for request in requests).encode('utf-8'))
+        replies = [self.read_message() for _ in range(10)]
+        self.assertEqual(sorted(reply for reply in replies if reply[0] == "#"), [f"#{100 + i} SET" for i in range(5)])
+        self.assertEqual(len([reply for reply in replies if reply[0:3] == "SEL"]), 5)
+
+        self.assertEqual(self.send_request("#9"), "ER0")
+        self.assertEqual(self.send_request("#10 DAuser1"), "#10 DAT")
+        self.assertEqual(self.send_request("#11 DAuser2"), "#11 DAT")
+
+    def test_read_long_messages(self):
+        # Messages long enough to be sent from their stored bytes, with multibyte characters counted as one each
+        self.send_request("CRuser1 password1")
+        self.send_request("CRuser2 password2")
+        self.send_request("LIuser1 password1")
+        texts = ["a" * 1000, "héllo wörld ✓ " * 50, "short"]
+        for text in texts:
+            self.assertEqual(self.send_request("SEuser1 user2 2023-10-10-10:00:00 " + text)[0:3], "SET")
+
+        response = self.send_request("#5 REuser2 3")
+        self.assertEqual(response[0:7], "#5 RET3")
+        rest = response[7:]
+        for text in texts:
+            _, message_id, sender, timestamp, rest = rest.split(" ", 4)
+            self.assertEqual((sender, timestamp), ("user1", "2023-10-10-10:00:00"))
+            length = str(len(text))
+            self.assertEqual(rest[:len(length)], length)
+            self.assertEqual(rest[len(length):len(length) + len(text)], text)
+            rest = rest[len(length) + len(text):]
+        self.assertEqual(rest, "")
+
+        self.send_request("DAuser1")
+        self.send_request("DAuser2")
+
+    def test_login_backlog(self):
+        # The undelivered messages follow LIT in REB pushes, and an empty REB ends them
+        self.send_request("CRuser1 password1")
+        self.send_request("CRuser2 password2")
+        for i in range(3):
+            self.send_request("SEuser1 user2 2023-10-10-10:00:00 message " + str(i))
+        self.assertEqual(self.send_request("LIuser2 password2 B"), "LIT")
+        response = self.read_message()
+        self.assertEqual(response[0:4], "REB3")
+        self.assertEqual(response.count(" user1 2023-10-10-10:00:00 9message "), 3)
+        self.assertEqual(self.read_message(), "REB0")
+
+        # The messages sent are marked delivered, so RE finds none left
+        self.assertEqual(self.send_request("REuser2 3"), "RET0")
+        self.send_request("DAuser1")
+        self.send_request("DAuser2")
+
+    def test_malformed_requests(self):
+        # A request with missing fields, or about an account that does not exist, only fails itself
+        self.assertEqual(self.send_request("CRabc"), "ER0")
+        self.assertEqual(self.send_request("REnobody 3"), "ER0")
+        self.assertEqual(self.send_request("#4 LSprefix"), "#4 ER0")
+        self.assertEqual(self.send_request("CRuser1 password1"), "CRT")
+        self.assertEqual(self.send_request("DAuser1"), "DAT")
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,227 @@
+# Version 2 of the custom wire protocol
+#
+# Every v2 frame starts with a fixed-size binary header followed by the frame body:
+#   body length (4 bytes, big endian) | opcode (3 ascii bytes, nul padded) | request id (4 bytes, big endian)
+# The body is a sequence of fields, each one a 4 byte big endian byte length followed by that many bytes
+# of utf-8 text. Numbers are sent as decimal text fields.
+#
+# A connection starts out speaking version 1. The client switches it to version 2 by sending the v1 request
+# "VE2" and waiting for the v1 reply "VET2". Servers that do not know about v2 reply "ER0", in which case the
+# client keeps speaking version 1.
+#
+# On a connection that negotiated compression (see compression.py), a frame whose body is compressed has
+# COMPRESSED_FLAG set in its body length, and the rest of the body length counts the compressed bytes.
+
+import struct
+import compression
+
+HEADER = struct.Struct("!I3sI")
+FIELD_LENGTH = struct.Struct("!I")
+COMPRESSED_FLAG = 0x80000000
+
+# Field names of each request, in the order they are sent. They match the keys of the json requests.
+REQUEST_FIELDS = {
+    "CR": ["username", "password"],
+    "LI": ["username", "password"],
+    "LO": ["username"],
+    "LA": [],
+    "LS": ["prefix", "cursor", "limit"],
+    "SU": [],
+    "ST": [],
+    "CM": ["codec"],
+    "SE": ["from_username", "to_username", "timestamp", "message"],
+    "RE": ["username", "number"],
+    "DM": ["username", "id"],
+    "DA": ["username"],
+}
+
+# Batch requests carry a variable number of fields, so they are not listed above:
+#   SB: from_username, timestamp, then a to_username, message pair for every message
+#   SM: from_username, timestamp, message, then every to_username
+# Their replies carry one status field per message, in request order: "T" or the error code.
+
+def encode_frame(opcode, request_id, fields):
+    """
+    Encodes a v2 frame.
+
+    Parameters
+    ----------
+    opcode: str
+        The 2 letter request code or 3 letter reply code
+    request_id: int
+        The id of the request, echoed back in its reply. Pushes that do not answer a request use 0.
+    fields: list
+        The fields of the frame. Each one can be str, bytes or int.
+
+    Returns
+    -------
+    bytes
+        The encoded frame
+    """
+    return frame(opcode, request_id, encode_fields(fields))
+
+def encode_fields(fields):
+    """
+    Encodes fields into (part of) a v2 frame body. Bodies can be built up by joining encoded runs of
+    fields, which lets fields shared by many frames be encoded only once.
+
+    Parameters
+    ----------
+    fields: list
+        The fields to encode. Each one can be str, bytes or int.
+
+    Returns
+    -------
+    bytes
+        The encoded fields
+    """
+    parts = []
+    for field in fields:
+        if isinstance(field, int):
+            field = str(field)
+        if isinstance(field, str):
+            field = field.encode("utf-8")
+        parts.append(FIELD_LENGTH.pack(len(field)))
+        parts.append(field)
+    return b"".join(parts)
+
+def frame(opcode, request_id, body):
+    """Puts the v2 header in front of an already encoded frame body."""
+    return HEADER.pack(len(body), opcode.encode("ascii"), request_id) + body
+
+def decode_fields(body):
+    """
+    Splits the body of a v2 frame into its fields.
+
+    Parameters
+    ----------
+    body: bytes-like
+        The frame body
+
+    Returns
+    -------
+    list
+        The fields, decoded as str
+
+    Raises
+    ------
+    ValueError
+        If a field runs past the end of the body
+    """
+    fields = []
+    pos = 0
+    while pos < len(body):
+        if pos + FIELD_LENGTH.size > len(body):
+            raise ValueError("truncated field length")
+        (length,) = FIELD_LENGTH.unpack_from(body, pos)
+        pos += FIELD_LENGTH.size
+        if pos + length > len(body):
+            raise ValueError("field runs past the end of the frame")
+        fields.append(str(body[pos:pos + length], "utf-8"))
+        pos += length
+    return fields
+
+def extract_frames(buf, max_decompressed=None):
+    """
+    Pulls every complete v2 frame out of a receive buffer.
+
+    Parameters
+    ----------
+    buf: bytearray
+        The receive buffer of a connection. Complete frames are removed from the front of it, and any
+        partial frame is left in place until the rest of it arrives.
+    max_decompressed: int or None
+        The most bytes a compressed frame body may decompress to, or None if the connection did not
+        negotiate compression
+
+    Returns
+    -------
+    list
+        A (opcode, request id, fields) tuple for every complete frame, in the order they were received.
+
+    Raises
+    ------
+    ValueError
+        If a frame body is malformed, or is compressed on a connection that did not negotiate compression
+    """
+    frames = []
+    start = 0
+    view = memoryview(buf)
+    try:
+        while len(buf) - start >= HEADER.size:
+            length, opcode, request_id = HEADER.unpack_from(buf, start)
+            compressed = length & COMPRESSED_FLAG
+            end = start + HEADER.size + (length & ~COMPRESSED_FLAG)
+            if end > len(buf):
+                break
+            if not compressed:
+                fields = decode_fields(view[start + HEADER.size:end])
+            elif max_decompressed is None:
+                raise ValueError("compressed frame on an uncompressed connection")
+            else:
+                fields = decode_fields(compression.decompress(view[start + HEADER.size:end], max_decompressed))
+            frames.append((opcode.rstrip(b"\0").decode("ascii"), request_id, fields))
+            start = end
+    finally:
+        view.release()
+    del buf[:start]
+    return frames
+
+def compress_frame(frame, threshold, level=6):
+    """
+    Compresses a v2 frame if its body is at least threshold bytes and compresses well.
+
+    Parameters
+    ----------
+    frame: bytes
+        The encoded frame
+    threshold: int
+        The smallest body, in bytes, worth compressing
+
+    Returns
+    -------
+    bytes
+        The compressed frame, or frame itself if it was left alone
+    """
+    if len(frame) - HEADER.size < threshold:
+        return frame
+    compressed = compression.compress(memoryview(frame)[HEADER.size:], level)
+    if compressed is None:
+        return frame
+    length, opcode, request_id = HEADER.unpack_from(frame)
+    return HEADER.pack(len(compressed) | COMPRESSED_FLAG, opcode, request_id) + compressed
+
+def request_fields(request):
+    """
+    Lists the fields of a request given in the same dict form as a json request.
+
+    Parameters
+    ----------
+    request: dict
+        The request, with a "type" key and one key per field
+
+    Returns
+    -------
+    list
+        The request's fields in the order they are sent
+    """
+    return [request[name] for name in REQUEST_FIELDS[request["type"]]]
+
+def v1_request_fields(message):
+    """
+    Splits a version 1 request body, such as "SEalice bob 2025-02-14 hi there", into its opcode and fields.
+
+    Parameters
+    ----------
+    message: str
+        The v1 request without its length prefix
+
+    Returns
+    -------
+    tuple
+        The 2 letter opcode and the list of fields. Only the last field may contain spaces.
+    """
+    opcode = message[:2]
+    num_fields = len(REQUEST_FIELDS[opcode])
+    fields = message[2:].split(" ", num_fields - 1) if num_fields else []
+    return opcode, fields
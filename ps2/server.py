@@ -10,9 +10,12 @@ import message_server_pb2_grpc
 import threading
 
 from concurrent import futures
+import eventlog
 
 load_dotenv()
 
+log = eventlog.get_logger("ps2.server")
+
 # GRPC code
 class MessageServer(message_server_pb2_grpc.MessageServerServicer):
     """Provides methods that implement functionality of the message server."""
@@ -42,7 +45,7 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
             reply.success is True or False, and indicates if the account was created successfully
             reply.errorMessage is an empty string on success and an error message on failure
         """
-        print("Trying to create account for ", request.username)
+        log.info("create_account", username=request.username)
         with self.lock:
             if request.username not in self.accounts:
                 # add in the socket connection
@@ -75,7 +78,7 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
             reply.success is True or False, and indicates if the account was created successfully
             reply.errorMessage is an empty string on success and an error message on failure
         """
-        print("Trying to login ", request.username)
+        log.info("login", username=request.username)
         with self.lock:
             if request.username not in self.accounts:
                 # error: account with that username does not exist
@@ -106,7 +109,7 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
             reply.success is True or False, and indicates if the account was created successfully
             reply.errorMessage is an empty string on success and an error message on failure
         """
-        print("Trying to logout ", request.username)
+        log.info("logout", username=request.username)
         with self.lock:
             if request.username not in self.accounts:
                 # error: account with that username does not exist
@@ -161,7 +164,7 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
             reply.success is True or False, and indicates if the message was sent successfully to the other user
             reply.errorMessage is an empty string on success and an error message on failure
         """
-        print("Sending message from ", request.fromUser, " to ", request.toUser)
+        log.info("send_message", from_username=request.fromUser, to_username=request.toUser)
         with self.lock:
             if request.toUser not in self.accounts:
                 return message_server_pb2.SendMessageReplyToSender(success=False, errorMessage="ER1: account with that username does not exist")
@@ -203,7 +206,7 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
             reply.messages is a list of messages objects
                 Each message has the following keys: messageId, fromUser, time, message.
         """
-        print("Reading ", request.numMessages, " messages for ", request.username)
+        log.info("read_message", username=request.username, number=request.numMessages)
         with self.lock:
             if request.username not in self.accounts:
                 return message_server_pb2.ReadMessagesReply(success=False, numRead=0, messages=[])
@@ -252,7 +255,7 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
             reply.messages is a list of messages objects
                 Each message has the following keys: messageId, fromUser, time, message.
         """
-        print("Getting instantaneous messages for ", request.username)
+        log.info("get_instant_messages", username=request.username)
         with self.lock:
             if request.username not in self.instantMessages:
                 return message_server_pb2.InstantaneousMessagesReply(success=False)
@@ -294,7 +297,7 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
             reply.success is True or False, and indicates if the user deleted the requested message successfully
             reply.errorMessage is an empty string on success and an error message on failure
         """
-        print("Deleting message", request.messageId, "from", request.username)
+        log.info("delete_message", username=request.username, message_id=request.messageId)
         with self.lock:
             if request.username not in self.accounts:
                 return message_server_pb2.DeleteMessagesReply(success=False, errorMessage="ER3: attempting to delete a message from an account that does not exist")
@@ -321,7 +324,7 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
             reply.success is True or False, and indicates if the user deleted the requested message successfully
             reply.errorMessage is an empty string on success and an error message on failure
         """
-        print("Deleting account ", request.username)
+        log.info("delete_account", username=request.username)
         with self.lock:
             if request.username not in self.accounts:
                 return message_server_pb2.DeleteAccountReply(success=False, errorMessage="ER1: attempting to delete an account that does not exist")
@@ -342,5 +345,5 @@ def serve():
     server.wait_for_termination()
 
 if __name__ == "__main__":
-    print("Starting server")
+    log.info("starting")
     serve()
\ No newline at end of file
@@ -0,0 +1,155 @@
+# Structured, sampled logging that never blocks the caller
+#
+# Servers log events, such as "send_message", with keyword fields instead of printing. A log call checks the
+# level and the event's sample rate, then puts the record on a bounded queue and returns. A background
+# thread takes records off the queue, writes them as one json object per line, and flushes once per batch.
+# If the queue is full the record is dropped and counted, so a slow terminal or disk never slows down a
+# request handler.
+#
+# Every server in this repository has a copy of this file next to it, which must stay identical to the others
+# (unitTests_eventlog.py in ps1 checks). It is configured through the environment:
+#   LOG_LEVEL      - debug, info (default), warning or error
+#   LOG_SAMPLE     - per-event sample rates, such as "send_message=0.01,read_message=0.1" (default: log all)
+#   LOG_FILE       - file to append records to (default: standard output)
+#   LOG_QUEUE_SIZE - most records waiting to be written before new ones are dropped (default 10000)
+
+import atexit
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+
+def parse_sample_rates(spec):
+    """Parses a LOG_SAMPLE string, such as "send_message=0.01,read_message=0.1", into a dict."""
+    rates = {}
+    for item in spec.split(","):
+        if "=" in item:
+            event, rate = item.split("=", 1)
+            rates[event.strip()] = float(rate)
+    return rates
+
+class EventLog:
+    """
+    Hands structured log records to a background writer thread.
+
+    Attributes:
+    - level (int): Records below this level are skipped before they are built.
+    - sample_rates (dict): Maps an event name to the fraction of its records that are kept.
+    - dropped (int): Records dropped because the queue was full.
+    """
+    def __init__(self, stream=None, level="info", sample_rates=None, queue_size=10000):
+        self.stream = stream if stream is not None else sys.stdout
+        self.level = LEVELS[level]
+        self.sample_rates = sample_rates or {}
+        self.dropped = 0
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stopped = False
+        self.writer = threading.Thread(target=self.run_writer, daemon=True)
+        self.writer.start()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self.after_fork)
+
+    def after_fork(self):
+        """Starts a writer thread in a forked child, which only inherits the thread that forked it."""
+        # Records queued before the fork are the parent's to write
+        self.queue = queue.Queue(maxsize=self.queue.maxsize)
+        if not self.stopped:
+            self.writer = threading.Thread(target=self.run_writer, daemon=True)
+            self.writer.start()
+
+    def log(self, level, logger, event, fields):
+        if LEVELS[level] < self.level or self.stopped:
+            return
+        rate = self.sample_rates.get(event)
+        if rate is not None and random.random() >= rate:
+            return
+        try:
+            self.queue.put_nowait((time.time(), level, logger, event, fields))
+        except queue.Full:
+            self.dropped += 1
+
+    def run_writer(self):
+        while True:
+            record = self.queue.get()
+            lines = []
+            stop = False
+            # Write everything that piled up while the last batch was being written in one go
+            while record is not None:
+                lines.append(self.format(record))
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            if record is None:
+                stop = True
+            if lines:
+                try:
+                    self.stream.write("".join(lines))
+                    self.stream.flush()
+                except (OSError, ValueError):
+                    # The stream went away, for example a closed terminal. Keep draining the queue.
+                    pass
+            if stop:
+                return
+
+    def format(self, record):
+        timestamp, level, logger, event, fields = record
+        line = {"ts": round(timestamp, 6), "level": level, "logger": logger, "event": event}
+        line.update(fields)
+        return json.dumps(line, default=str) + "\n"
+
+    def close(self):
+        """Writes out every queued record and stops the writer thread."""
+        if self.stopped:
+            return
+        self.stopped = True
+        # Blocks only if the queue is full, which the writer is busy emptying
+        self.queue.put(None)
+        self.writer.join()
+
+class Logger:
+    """
+    A named source of log records, such as one server.
+
+    Example: log.info("send_message", from_username="alice", to_username="bob") writes
+    {"ts": ..., "level": "info", "logger": "ps1.server", "event": "send_message", "from_username": "alice", ...}
+    """
+    def __init__(self, name, event_log):
+        self.name = name
+        self.event_log = event_log
+
+    def debug(self, event, **fields):
+        self.event_log.log("debug", self.name, event, fields)
+
+    def info(self, event, **fields):
+        self.event_log.log("info", self.name, event, fields)
+
+    def warning(self, event, **fields):
+        self.event_log.log("warning", self.name, event, fields)
+
+    def error(self, event, **fields):
+        self.event_log.log("error", self.name, event, fields)
+
+event_log = None
+
+def get_logger(name):
+    """
+    Returns a Logger writing to the process-wide EventLog, which is started from the environment the first
+    time it is needed and closed when the process exits.
+    """
+    global event_log
+    if event_log is None:
+        log_file = os.environ.get("LOG_FILE")
+        event_log = EventLog(
+            stream=open(log_file, "a", encoding="utf-8") if log_file else None,
+            level=os.environ.get("LOG_LEVEL", "info").lower(),
+            sample_rates=parse_sample_rates(os.environ.get("LOG_SAMPLE", "")),
+            queue_size=int(os.environ.get("LOG_QUEUE_SIZE", 10000)),
+        )
+        atexit.register(event_log.close)
+    return Logger(name, event_log)
@@ -10,9 +10,12 @@ import threading
 import time
 from concurrent import futures
 import sqlite3
+import eventlog
 
 load_dotenv()
 
+log = eventlog.get_logger("ps4.server")
+
 # GRPC code
 class MessageServer(message_server_pb2_grpc.MessageServerServicer):
     """Provides methods that implement functionality of the message server."""
@@ -30,7 +33,7 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
             5002 : os.environ.get("SERVER5002"),
             5003 : os.environ.get("SERVER5003"),
         }
-        print("Connected to the database")
+        log.info("database_connected", path=self.db_filename)
 
         # Creates table for users if it doesn't exist
         self.cursor.execute("""CREATE TABLE IF NOT EXISTS users (
@@ -54,7 +57,7 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
             REFERENCES users (username)
         );""")
         self.connection.commit()
-        print("Database set up completed")
+        log.info("database_ready")
 
         # Lock for preventing race conditions
         self.lock = threading.Lock()
@@ -92,7 +95,7 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
             reply.success is True or False, and indicates if the account was created successfully
             reply.errorMessage is an empty string on success and an error message on failure
         """
-        print("Trying to create account for ", request.username)
+        log.info("create_account", username=request.username)
         # If the server is not the master, simply return an error back to the client
         if not self.is_master:
             return message_server_pb2.CreateReply(success=False, errorMessage="ER0: connection error")
@@ -131,7 +134,7 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
             reply.success is True or False, and indicates if the account was created successfully
             reply.errorMessage is an empty string on success and an error message on failure
         """
-        print("Trying to login ", request.username)
+        log.info("login", username=request.username)
         # If the server is not the master, simply return an error back to the client
         if not self.is_master:
             return message_server_pb2.LoginReply(success=False, errorMessage="ER0: connection error")
@@ -173,7 +176,7 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
             reply.success is True or False, and indicates if the account was created successfully
             reply.errorMessage is an empty string on success and an error message on failure
         """
-        print("Trying to logout ", request.username)
+        log.info("logout", username=request.username)
         # If the server is not the master, simply return an error back to the client
         if not self.is_master:
             return message_server_pb2.LogoutReply(success=False, errorMessage="ER0: connection error")
@@ -251,7 +254,7 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
             reply.success is True or False, and indicates if the message was sent successfully to the other user
             reply.errorMessage is an empty string on success and an error message on failure
         """
-        print("Sending message from ", request.fromUser, " to ", request.toUser)
+        log.info("send_message", from_username=request.fromUser, to_username=request.toUser)
         # If the server is not the master, simply return an error back to the client
         if not self.is_master:
             return message_server_pb2.SendMessageReplyToSender(success=False, errorMessage="ER0: connection error")
@@ -272,7 +275,7 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
             # If the recieving user is logged in, the message should be marked as for instant delivery
             instant = 0
             if response[0][2] == 1:
-                print("instant message")
+                log.debug("instant_message", to_username=request.toUser)
                 instant = 1
             self.cursor.execute(f'INSERT INTO messages (sender_username, recipient_username, message, timestamp, instant, delivered) VALUES ("{request.fromUser}", "{request.toUser}", "{request.message}", "{request.time}", {instant}, 0)')
             self.connection.commit()
@@ -304,7 +307,7 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
             reply.messages is a list of messages objects
                 Each message has the following keys: messageId, fromUser, time, message.
         """
-        print("Reading ", request.numMessages, " messages for ", request.username)
+        log.info("read_message", username=request.username, number=request.numMessages)
         # If the server is not the master, simply return an error back to the client
         if not self.is_master:
             return message_server_pb2.ReadMessagesReply(success=False, numRead=0, messages=[])
@@ -360,7 +363,7 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
             reply.messages is a list of messages objects
                 Each message has the following keys: messageId, fromUser, time, message.
         """
-        print("Getting instant messages for ", request.username)
+        log.info("get_instant_messages", username=request.username)
         # If the server is not the master, simply return an error back to the client
         if not self.is_master:
             return message_server_pb2.InstantaneousMessagesReply(success=False, numRead=0, messages=[])
@@ -416,7 +419,7 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
             reply.success is True or False, and indicates if the user deleted the requested message successfully
             reply.errorMessage is an empty string on success and an error message on failure
         """
-        print("Deleting message", request.messageId, "from", request.username)
+        log.info("delete_message", username=request.username, message_id=request.messageId)
         # If the server is not the master, simply return an error back to the client
         if not self.is_master:
             return message_server_pb2.DeleteMessagesReply(success=False, errorMessage="ER0: connection error")
@@ -462,7 +465,7 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
             reply.success is True or False, and indicates if the user deleted the requested message successfully
             reply.errorMessage is an empty string on success and an error message on failure
         """
-        print("Deleting account ", request.username)
+        log.info("delete_account", username=request.username)
         # If the server is not the master, simply return an error back to the client
         if not self.is_master:
             return message_server_pb2.DeleteAccountReply(success=False, errorMessage="ER0: connection error")
@@ -517,10 +520,10 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
             try:
                 if port != self.port:
                     self.commit(port, query, params)
-                    print(f"Committed to port {port}")
+                    log.debug("replica_committed", port=port)
             except Exception as e:
                 self.disconnect(port)
-                print(f"Could not commit to port {port}")
+                log.warning("replica_commit_failed", port=port)
 
 
     def commit(self, port, query, params):
@@ -549,7 +552,7 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
                     self.connections.pop(port)
             return reply.success
         except Exception as e:
-            print(f"Could not commit to port {port}")
+            log.warning("replica_commit_failed", port=port)
             return False
 
 
@@ -571,7 +574,7 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
                 self.cursor.execute(query, params)
                 self.connection.commit()
                 reply = message_server_pb2.CommitReply(success=True)
-                print(f"Committed: {query} with params {params}")
+                log.debug("commit_applied", query=query, params=list(params))
                 return reply
             except Exception as e:
                 reply = message_server_pb2.CommitReply(success=False, errorMessage=f"Could not commit: {e}")
@@ -587,9 +590,9 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
 
         try:
             reply = self.connections[port].Disconnect(request)
-            print(f"Disconnected from port {port}")
+            log.info("disconnected", port=port)
         except Exception as e:
-            print(f"Could not disconnect from port {port}: {e}")
+            log.warning("disconnect_failed", port=port, error=str(e))
             reply = message_server_pb2.DisconnectReply(success=False, errorMessage=f"Could not disconnect: {e}")
 
         if port in self.channels:
@@ -605,13 +608,13 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
 
     def Disconnect(self, request: message_server_pb2.DisconnectRequest, context):
         port = request.requesterPort
-        print(f"Received disconnect request from {port}")
+        log.info("disconnect_requested", port=port)
         if port in self.connections:
             del self.connections[port]
         if port in self.channels:
             self.channels[port].close()
             del self.channels[port]
-        print("Disconnect successful")
+        log.info("disconnect_handled", port=port)
         reply = message_server_pb2.DisconnectReply(success=True, errorMessage="")
         if request.isMaster:
             self.find_master()
@@ -623,9 +626,9 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
             if port != self.port:
                 try:
                     self.disconnect(port)
-                    print(f"Disconnected from port {port}")
+                    log.info("disconnected", port=port)
                 except Exception as e:
-                    print(f"Could not disconnect from port {port}")
+                    log.warning("disconnect_failed", port=port)
 
 
     def is_master_helper(self, port):
@@ -634,7 +637,7 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
             reply = self.connections[port].IsMaster(request)
             return reply.isMaster
         except Exception as e:
-            print(f"Could not check if {port} is master")
+            log.warning("master_check_failed", port=port)
             return False
 
     def IsMaster(self, request, context):
@@ -651,21 +654,21 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
         2. A connection to a server fails
         3. A server detects the master is unreachable
         """
-        print("Finding new master")
+        log.info("finding_master")
         # active ports
         active_ports = list(self.connections.keys()) + [self.port]
         active_ports.sort()
-        print("Active ports:", active_ports)
+        log.info("active_ports", ports=active_ports)
 
         new_master = active_ports[0]
         self.current_master = new_master
 
         if new_master == self.port:
             self.is_master = True
-            print("I am now the master")
+            log.info("master_elected", port=new_master, is_self=True)
         else:
             self.is_master = False
-            print("Port {} is the new master".format(new_master))
+            log.info("master_elected", port=new_master, is_self=False)
 
 
     def add_connect(self, port):
@@ -675,10 +678,10 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
         )
         try:
             reply = self.connections[port].AddConnect(request)
-            print(f"Connected to port {port}")
+            log.info("connected", port=port)
             return reply.success
         except Exception as e:
-            print(f"Could not connect to port {port}")
+            log.warning("connect_failed", port=port)
             return False
 
 
@@ -688,14 +691,14 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
             self.channels[requestPort] = grpc.insecure_channel(f'{self.ips[requestPort]}:{requestPort}')
             self.connections[requestPort] = message_server_pb2_grpc.MessageServerStub(self.channels[requestPort])
             reply = message_server_pb2.AddConnectReply(success=True)
-            print(f"Connected to port {requestPort}")
+            log.info("connected", port=requestPort)
             self.find_master()
             return reply
         except Exception as e:
             # Better error handling
             error_type = type(e).__name__
             error_msg = str(e) if str(e) else "No error message"
-            print(f"Error in AddConnect: {error_type}, Message: {error_msg}")
+            log.error("add_connect_failed", port=requestPort, error_type=error_type, error=error_msg)
             reply = message_server_pb2.AddConnectReply(success=False,
                                     errorMessage=f"Could not connect: {error_type}: {error_msg}")
             return reply
@@ -711,11 +714,11 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
                         self.channels[port] = channel
                         self.connections[port] = message_server_pb2_grpc.MessageServerStub(channel)
                         self.add_connect(port)
-                        print(f"Connected to port {port} from {self.port}")
+                        log.info("connected", port=port, from_port=self.port)
                     else:
-                        print(f"Could not connect to port {port}")
+                        log.warning("connect_failed", port=port)
                 except Exception as e:
-                    print(f"Could not connect to port {port}")
+                    log.warning("connect_failed", port=port)
         # find master in all dbs
         self.find_master()
         threading.Thread(target=self.heart_beat, daemon=True).start()
@@ -741,10 +744,10 @@ class MessageServer(message_server_pb2_grpc.MessageServerServicer):
                     request = message_server_pb2.IsMasterRequest()
                     response = self.connections[self.current_master].IsMaster(request, timeout=3)
                     if not response.isMaster:
-                        print("Master reported not master anymore.")
+                        log.warning("master_stepped_down", port=self.current_master)
                         self.find_master()
                 except Exception as e:
-                    print(f"Master heartbeat failed for port {self.current_master}: {e}")
+                    log.warning("master_heartbeat_failed", port=self.current_master, error=str(e))
                     self.disconnect(self.current_master)
                     self.find_master()
 
@@ -766,5 +769,5 @@ def serve():
         message_server.disconnect_all()
 
 if __name__ == "__main__":
-    print("Starting server")
+    log.info("starting")
     serve()
\ No newline at end of file